@@ -8,18 +8,22 @@ import redis
 DB_ERROR_STR = "DB error"
 REQ_ERROR_STR = "Requests error"
 GATEWAY_URL = os.environ['GATEWAY_URL']
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 64))     # Per worker, covers its request threads and background threads
+REDIS_POOL_TIMEOUT = int(os.environ.get("REDIS_POOL_TIMEOUT", 10))           # Seconds a request waits for a free connection
 
 ID_COUNTER = "id-counter"
 
 app = Flask("ids-service")
 
-db: redis.Redis = redis.Redis(
+# Connections are handed out per command or pipeline, so threads and greenlets never share one
+db: redis.Redis = redis.Redis(connection_pool=redis.BlockingConnectionPool(
     host=os.environ['REDIS_HOST'],
     port=int(os.environ['REDIS_PORT']),
     password=os.environ['REDIS_PASSWORD'],
-    db=int(os.environ['REDIS_DB'])
-)
-pipeline_db = db.pipeline()
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
+))
 
 
 def close_db_connection():
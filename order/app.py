@@ -1,33 +1,117 @@
 import os
+import hashlib
 import logging
 import atexit
+import socket
+import threading
 import random
 import uuid
 import redis
 import requests
 from enum import Enum
-from copy import deepcopy
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from time import perf_counter, sleep, time
 from ast import literal_eval
 
-from msgspec import msgpack, Struct
-from flask import Flask, jsonify, abort, Response, request
+from msgspec import msgpack, json, Struct, MsgspecError
+from flask import Flask, jsonify, abort, Response, request, stream_with_context
+from werkzeug.exceptions import HTTPException
 from datetime import datetime
 
+from sharding import ShardedRedis, parse_nodes, redis_client, node_clients, client_for
+from catalog import BloomFilter, PriceCatalog
+from saga import SagaBus, bus_client, CHECKOUT_STREAM, OUTCOME_STREAM
+
 DB_ERROR_STR = "DB error"
 REQ_ERROR_STR = "Requests error"
+LOG_PAGE_SIZE = 500
+LOG_PAGE_MAX = 10000
+RECOVERY_INTERVAL = int(os.environ.get("RECOVERY_INTERVAL", 300))   # Seconds between two background recovery runs
+RECOVERY_GRACE = int(os.environ.get("RECOVERY_GRACE", 60))          # Seconds before an unfinished transaction counts as abandoned
+RECOVERY_CHECKPOINT_KEY = "{recovery}:checkpoint"
+RECOVERY_OPEN_KEY = "{recovery}:open"
+RECOVERY_STATS_KEY = "{recovery}:stats"
+RECOVERY_LEADER_KEY = "recovery:leader"
+RECOVERY_LEASE = int(os.environ.get("RECOVERY_LEASE", 15))          # Seconds the recovery leader holds its lease without renewing it
+RECOVERY_CLAIM_TTL = 600                                            # Seconds a recovered transaction stays claimed
+RECOVERY_READY_LAG = int(os.environ.get("RECOVERY_READY_LAG", RECOVERY_INTERVAL + RECOVERY_GRACE + 2 * RECOVERY_LEASE))
+RECOVERY_WORKERS = int(os.environ.get("RECOVERY_WORKERS", 8))       # Threads that recover partitions of the backlog in parallel
+RECOVERY_BATCH_SIZE = 1000                                          # Redis commands sent per pipeline round trip
+COMPENSATION_QUEUE_KEY = "{compensation}:queue"   # Sorted set of job ids scored by their next attempt time
+COMPENSATION_JOBS_KEY = "{compensation}:jobs"     # Hash of job id to CompensationJob
+COMPENSATION_DEAD_KEY = "{compensation}:dead"     # Hash of the jobs that ran out of attempts
+COMPENSATION_STATS_KEY = "{compensation}:stats"
+COMPENSATION_MAX_ATTEMPTS = int(os.environ.get("COMPENSATION_MAX_ATTEMPTS", 10))
+COMPENSATION_BASE_DELAY = float(os.environ.get("COMPENSATION_BASE_DELAY", 1))      # Seconds before the first retry
+COMPENSATION_MAX_DELAY = float(os.environ.get("COMPENSATION_MAX_DELAY", 300))      # Upper bound of the backoff in seconds
+COMPENSATION_POLL_INTERVAL = float(os.environ.get("COMPENSATION_POLL_INTERVAL", 1))
+COMPENSATION_CLAIM_TIMEOUT = 30                                                     # Seconds a claimed job is hidden from other workers
+COMPENSATION_BATCH_SIZE = 100
+SETTLE_ATTEMPTS = int(os.environ.get("SETTLE_ATTEMPTS", 3))         # Tries of a settle whose answer was lost, the settles are idempotent
+SETTLE_RETRY_DELAY = 0.1                                            # Seconds before the first retry of a settle, doubled per retry
+FIND_MANY_MAX = 100000                                              # Ids accepted by one find_many request
+FIND_MANY_CHUNK = 500                                               # Ids read with one MGET
+CHECKOUT_MANY_MAX = 1000                                            # Orders accepted by one checkout_many request
+CHECKOUT_MANY_WORKERS = int(os.environ.get("CHECKOUT_MANY_WORKERS", 16))   # Threads that finish the orders of one checkout_many request
+STREAM_MIMETYPES = {"ndjson": "application/x-ndjson", "msgpack": "application/x-msgpack"}
 GATEWAY_URL = os.environ['GATEWAY_URL']
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 64))     # Per worker, covers its request threads and background threads
+REDIS_POOL_TIMEOUT = int(os.environ.get("REDIS_POOL_TIMEOUT", 10))           # Seconds a request waits for a free connection
+# "host:port,host:port" spreads the keys over several Redis nodes, defaults to the single REDIS_HOST
+REDIS_NODES = parse_nodes(os.environ.get("REDIS_NODES") or f"{os.environ['REDIS_HOST']}:{os.environ['REDIS_PORT']}")
+REDIS_REPLICA_NODES = parse_nodes(os.environ.get("REDIS_REPLICA_NODES", ""))   # One replica per node of REDIS_NODES, in the same order
+REDIS_READ_POLICY = os.environ.get("REDIS_READ_POLICY", "master")              # master, replica, or bounded: replica while it lags at most REDIS_MAX_STALENESS
+REDIS_MAX_STALENESS = float(os.environ.get("REDIS_MAX_STALENESS", 1))          # Seconds
+REPLICA_CHECK_INTERVAL = 0.5                                                   # Seconds between two heartbeats
+REPLICA_HEARTBEAT_KEY = "reads:heartbeat"
+READ_STATS_KEY = "reads:stats"
+ENTITY_CACHE_BYTES = int(os.environ.get("ENTITY_CACHE_BYTES", 0))   # Per worker memory for decoded entities, 0 disables the cache
+CACHE_ENTRY_OVERHEAD = 200                                         # Rough bytes of a cached entry besides its encoded value
+CACHE_HISTORY = 10000                                              # Recent invalidations remembered to reject racing fills
+CACHE_CHANNEL = "cache:invalidate"
+PRICE_CATALOG_PATH = os.environ.get("PRICE_CATALOG_PATH", "/dev/shm/order-price-catalog")   # Shared by the workers of a node
+PRICE_CATALOG_SLOTS = int(os.environ.get("PRICE_CATALOG_SLOTS", 1 << 20))   # Power of two, 24 bytes each, 0 disables the price table
+USER_FILTER_PATH = os.environ.get("USER_FILTER_PATH", "/dev/shm/order-user-filter")          # Shared by the workers of a node
+USER_FILTER_BITS = int(os.environ.get("USER_FILTER_BITS", 1 << 24))         # 16 bits per expected user, 0 disables the user filter
+PAID_ORDER_MAX_AGE = int(os.environ.get("PAID_ORDER_MAX_AGE", 0))          # Seconds clients and the gateway may reuse a paid order, 0 always revalidates
+CATALOG_REFRESH = float(os.environ.get("CATALOG_REFRESH", 1))               # Seconds between two pulls of the stock and payment feeds
+CATALOG_PAGE = 10000
+NEGATIVE_CACHE_SIZE = int(os.environ.get("NEGATIVE_CACHE_SIZE", 10000))     # Per worker, missing users and items, 0 disables the cache
+NEGATIVE_CACHE_TTL = float(os.environ.get("NEGATIVE_CACHE_TTL", 30))        # Seconds a missing user or item is rejected without asking
+SAGA_BUS = os.environ.get("SAGA_BUS", "")                           # host:port of the Redis node with the checkout streams, empty checks out over HTTP
+SAGA_HOLD_TTL = float(os.environ.get("SAGA_HOLD_TTL", 60))          # Seconds stock and payment hold for an event-driven checkout
+SAGA_WAIT = float(os.environ.get("SAGA_WAIT", 10))                  # Seconds a checkout request waits for its saga, which goes on without it
+SAGA_KEEP = 86400                                                   # Seconds the state of a saga is kept
+SAGA_STATS_KEY = "saga:stats"
+SAGA_PENDING_KEY = "{sagas}:pending"                                # Sorted set of pending sagas scored by their deadline
+SAGA_SWEEP_INTERVAL = float(os.environ.get("SAGA_SWEEP_INTERVAL", 1))
+SAGA_SWEEP_BATCH = 100
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+PROCESS_STARTED = datetime.now()
 
 app = Flask("order-service")
 
-db: redis.Redis = redis.Redis(
-    host=os.environ['REDIS_HOST'],
-    port=int(os.environ['REDIS_PORT']),
+db: redis.Redis | ShardedRedis = redis_client(
+    REDIS_NODES,
     password=os.environ['REDIS_PASSWORD'],
-    db=int(os.environ['REDIS_DB'])
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
 )
-pipeline_db = db.pipeline()
+# Reads that tolerate staleness can go to the replicas, see reader()
+replica_db: redis.Redis | ShardedRedis | None = redis_client(
+    REDIS_REPLICA_NODES,
+    password=os.environ['REDIS_PASSWORD'],
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
+) if REDIS_REPLICA_NODES else None
+
+
+# With SAGA_BUS the checkouts run as a saga of events between the services, see saga.py
+saga_bus: SagaBus | None = SagaBus(bus_client(SAGA_BUS, os.environ['REDIS_PASSWORD']), "order", WORKER_ID, app.logger) if SAGA_BUS else None
 
 
 def close_db_connection():
@@ -44,6 +128,13 @@ class OrderValue(Struct):
     total_cost: int
 
 
+class OrderDelta(Struct, omit_defaults=True):
+    # Undo information of one order update, independent of the size of the order
+    items: list[tuple[str, int]] = []   # Lines appended to the order
+    cost: int = 0                       # Added to the total cost
+    old_paid: bool | None = None        # Paid flag before the update, None when unchanged
+
+
 class LogType(str, Enum):
     CREATE      = "Create"
     UPDATE      = "Update"
@@ -63,14 +154,23 @@ class LogOrderValue(Struct):
     type: LogType | None = None
     status: LogStatus | None = None
     order_id: str | None = None
-    old_ordervalue: OrderValue | None = None
+    old_ordervalue: OrderValue | None = None           # Before-image, only in the UPDATE logs of older versions and the recovery seed
+    delta: OrderDelta | None = None                    # The change made by an UPDATE, recovery applies its inverse
     from_url: str | None = None
     to_url: str | None = None
 
 
-def send_post_request(url: str):
+class CompensationJob(Struct):
+    id: str
+    url: str
+    check_url: str | None = None    # Settle that is sent again first, the job is only owed when it answers 200
+    attempts: int = 0
+    last_error: str | None = None
+
+
+def send_post_request(url: str, data: bytes | None = None):
     try:
-        response = requests.post(url)
+        response = requests.post(url, data=data)
     except requests.exceptions.RequestException as exc:
         abort(400, exc)
     else:
@@ -86,28 +186,454 @@ def send_get_request(url: str):
         return response
 
 
-def get_order_from_db(order_id: str, log_id: str | None = None) -> OrderValue | None:
+def get_order_from_db(order_id: str, log_id: str | None = None, stale_ok: bool = False) -> OrderValue | None:
+    return get_tagged_order(order_id, log_id, stale_ok)[0]
+
+
+def get_tagged_order(order_id: str, log_id: str | None = None, stale_ok: bool = False) -> tuple[OrderValue, str]:
+    # Only reads that tolerate staleness are served from the cache
+    use_cache = stale_ok and entity_cache is not None
+    if use_cache:
+        cached: tuple[OrderValue, str] | None = entity_cache.get_tagged(order_id)
+        if cached is not None:
+            return cached
+        generation = entity_cache.generation
+    
     try:
-        entry: bytes = db.get(order_id)
+        # Cache misses read the master, a lagging replica could refill the cache with a value that was just invalidated
+        raw_entry: bytes = reader(stale_ok and not use_cache).get(order_id)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
     
-    entry: OrderValue | None = msgpack.decode(entry, type=OrderValue) if entry else None
+    if not raw_entry:
+        abort_order_not_found(order_id, log_id)
+    entry: OrderValue = msgpack.decode(raw_entry, type=OrderValue)
+    etag = entity_etag(raw_entry)
+    if use_cache:
+        entity_cache.put(order_id, entry, len(raw_entry), generation, etag)
+    return entry, etag
+
+
+def abort_order_not_found(order_id: str, log_id: str | None = None):
+    log_key = get_key(order_id)
+    error_log = LogOrderValue(
+        id=log_id if log_id else str(uuid.uuid4()),
+        type=LogType.SENT,
+        order_id=order_id,
+        from_url=request.url,
+        to_url=request.referrer,
+        status=LogStatus.FAILURE,
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+    )
+    db.set(log_key, msgpack.encode(error_log))
+    abort(400, f"Order: {order_id} not found! Log key: {log_key}")
+
+########################################################################################################################
+#   START OF READ ROUTING FUNCTIONS
+########################################################################################################################
+read_counts: Counter = Counter()
+read_counts_lock = threading.Lock()
+replica_staleness: float | None = None
+
+
+def use_replica(stale_ok: bool) -> bool:
+    # Reads that need read-your-writes always go to the master
+    replica = stale_ok and bool(REDIS_REPLICA_NODES) and (
+        REDIS_READ_POLICY == "replica"
+        or (REDIS_READ_POLICY == "bounded" and replica_staleness is not None and replica_staleness <= REDIS_MAX_STALENESS)
+    )
+    with read_counts_lock:
+        read_counts["replica" if replica else "master"] += 1
+    return replica
+
+
+def reader(stale_ok: bool = False) -> redis.Redis | ShardedRedis:
+    return replica_db if use_replica(stale_ok) else db
+
+
+def measure_replica_staleness() -> float | None:
+    # Every master gets a heartbeat with the current time, its replica is as stale as the heartbeat it has seen
+    now = datetime.now().timestamp()
+    for node in node_clients(db):
+        node.set(REPLICA_HEARTBEAT_KEY, now)
+    
+    staleness = 0.0
+    for node in node_clients(replica_db):
+        heartbeat = node.get(REPLICA_HEARTBEAT_KEY)
+        if heartbeat is None:
+            return None
+        staleness = max(staleness, datetime.now().timestamp() - float(heartbeat))
+    return staleness
+
+
+def replica_monitor_loop():
+    global replica_staleness
+    while not recovery_stop.wait(REPLICA_CHECK_INTERVAL):
+        try:
+            if replica_db is not None:
+                replica_staleness = measure_replica_staleness()
+            
+            # Share the read counts of this worker with the other workers
+            with read_counts_lock:
+                counts = dict(read_counts)
+                read_counts.clear()
+            if counts:
+                pipeline_db = db.pipeline(transaction=False)
+                for target, count in counts.items():
+                    pipeline_db.hincrby(READ_STATS_KEY, target, count)
+                pipeline_db.execute()
+        except redis.exceptions.RedisError as exc:
+            replica_staleness = None
+            app.logger.error(f"Checking the replicas failed: {exc}")
+
+
+@app.get('/reads/status')
+def reads_status():
+    stats = {key.decode('utf-8'): int(value) for key, value in db.hgetall(READ_STATS_KEY).items()}
+    total = sum(stats.values())
+    return jsonify({
+        "policy": REDIS_READ_POLICY,
+        "replicas": len(REDIS_REPLICA_NODES),
+        "max_staleness_seconds": REDIS_MAX_STALENESS,
+        "replica_staleness_seconds": replica_staleness,
+        "reads_master": stats.get("master", 0),
+        "reads_replica": stats.get("replica", 0),
+        "replica_share": stats.get("replica", 0) / total if total else 0.0,
+    }), 200
+
+########################################################################################################################
+#   START OF COALESCING FUNCTIONS
+########################################################################################################################
+class FlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    """Lets concurrent calls with the same key wait for the call that is already in flight and share its result."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: dict[str, FlightCall] = {}
+        self.stats: Counter = Counter()
+
+    def count(self, collapsed: bool):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["collapsed"] += collapsed
+
+    def do(self, key: str, fetch):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = FlightCall()
+            self.stats["requests"] += 1
+            self.stats["collapsed"] += not leader
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fetch()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+stock_flight = SingleFlight()     # Concurrent lookups of an item with the stock service
+
+
+@app.get('/coalescing/status')
+def coalescing_status():
+    status = {"worker": WORKER_ID}
+    for name, flight in (("stock_lookups", stock_flight),):
+        with flight.lock:
+            status[name] = {
+                "requests": flight.stats["requests"],
+                "collapsed": flight.stats["collapsed"],
+                "in_flight": len(flight.calls),
+            }
+    return jsonify(status), 200
+
+########################################################################################################################
+#   START OF CACHE FUNCTIONS
+########################################################################################################################
+class EntityCache:
+    """LRU cache of decoded entities, bounded by the size of their encoded values."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, tuple[Struct, int, str]] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # Every invalidation bumps the generation, a fill that started before an invalidation of its key is dropped
+        self.generation = 0
+        self.invalidated: OrderedDict[str, int] = OrderedDict()
+        self.invalidated_floor = 0
+        self.stats: Counter = Counter()
+        self.staleness_total = 0.0
+        self.staleness_max = 0.0
+
+    def get(self, key: str) -> Struct | None:
+        tagged = self.get_tagged(key)
+        return tagged[0] if tagged is not None else None
+
+    def get_tagged(self, key: str) -> tuple[Struct, str] | None:
+        # The entity with the ETag it was stored with
+        with self.lock:
+            entry = self.entries.get(key)
+            self.stats["hits" if entry is not None else "misses"] += 1
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0], entry[2]
+
+    def put(self, key: str, value: Struct, encoded_size: int, generation: int, etag: str):
+        size = encoded_size + CACHE_ENTRY_OVERHEAD
+        with self.lock:
+            if self.invalidated.get(key, self.invalidated_floor) > generation or size > self.max_bytes:
+                return
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size, etag)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.stats["evictions"] += 1
+
+    def invalidate(self, keys: list[str], published_at: float):
+        with self.lock:
+            self.generation += 1
+            if not keys:
+                self.entries.clear()
+                self.size = 0
+                self.invalidated.clear()
+                self.invalidated_floor = self.generation
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.size -= entry[1]
+                self.invalidated[key] = self.generation
+                self.invalidated.move_to_end(key)
+            while len(self.invalidated) > CACHE_HISTORY:
+                self.invalidated_floor = self.invalidated.popitem(last=False)[1]
+            
+            # The staleness is how long a cached copy could outlive the write that replaced it
+            staleness = max(datetime.now().timestamp() - published_at, 0.0)
+            self.stats["invalidations"] += 1
+            self.staleness_total += staleness
+            self.staleness_max = max(self.staleness_max, staleness)
+
+    def clear(self):
+        self.invalidate([], datetime.now().timestamp())
+
+
+entity_cache: EntityCache | None = EntityCache(ENTITY_CACHE_BYTES) if ENTITY_CACHE_BYTES else None
+
+
+def publish_invalidation(*keys: str):
+    # Without keys every cached entity is dropped
+    if entity_cache is not None:
+        db.publish(CACHE_CHANNEL, msgpack.encode((datetime.now().timestamp(), list(keys))))
+
+
+def cache_invalidation_loop():
+    while not recovery_stop.is_set():
+        pubsub = client_for(db, CACHE_CHANNEL).pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(CACHE_CHANNEL)
+            # Invalidations published while not subscribed are lost, so start over from an empty cache
+            entity_cache.clear()
+            while not recovery_stop.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    published_at, keys = msgpack.decode(message["data"])
+                    entity_cache.invalidate(keys, published_at)
+        except redis.exceptions.RedisError as exc:
+            app.logger.error(f"Cache invalidation subscription failed: {exc}")
+            entity_cache.clear()
+            recovery_stop.wait(1)
+        finally:
+            pubsub.close()
+
+
+@app.get('/cache/status')
+def cache_status():
+    if entity_cache is None:
+        return jsonify({"enabled": False}), 200
     
-    if entry is None:
-        log_key = get_key()
-        error_log = LogOrderValue(
-            id=log_id if log_id else str(uuid.uuid4()),
-            type=LogType.SENT,
-            order_id=order_id,
-            from_url=request.url,
-            to_url=request.referrer,
-            status=LogStatus.FAILURE,
-            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
-        )
-        db.set(log_key, msgpack.encode(error_log))
-        abort(400, f"Order: {order_id} not found! Log key: {log_key}")
-    return entry
+    with entity_cache.lock:
+        stats = dict(entity_cache.stats)
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        invalidations = stats.get("invalidations", 0)
+        return jsonify({
+            "enabled": True,
+            "worker": WORKER_ID,
+            "entries": len(entity_cache.entries),
+            "bytes": entity_cache.size,
+            "max_bytes": entity_cache.max_bytes,
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),
+            "hit_ratio": stats.get("hits", 0) / lookups if lookups else 0.0,
+            "evictions": stats.get("evictions", 0),
+            "invalidations": invalidations,
+            "staleness_avg_seconds": entity_cache.staleness_total / invalidations if invalidations else 0.0,
+            "staleness_max_seconds": entity_cache.staleness_max,
+        }), 200
+
+def entity_etag(raw_entry: bytes) -> str:
+    # Every write that changes the entity changes its stored bytes, the digest is taken once per read from Redis and kept
+    # with the cached entity
+    return hashlib.blake2b(raw_entry, digest_size=8).hexdigest()
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # If-None-Match compares weakly, W/"x" matches "x"
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/").strip('"') for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def validator_headers(etag: str, max_age: int = 0) -> dict[str, str]:
+    # Clients and the gateway revalidate with If-None-Match, only immutable entities may be reused without asking
+    return {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={max_age}, immutable" if max_age else "no-cache",
+    }
+
+########################################################################################################################
+#   START OF CATALOG FUNCTIONS
+########################################################################################################################
+class NegativeCache:
+    """Users and items the payment and stock services reported as missing, forgotten after a while."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, float] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, key: str):
+        with self.lock:
+            self.entries[key] = perf_counter() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is not None and expires < perf_counter():
+                del self.entries[key]
+                return False
+            return expires is not None
+
+
+price_catalog: PriceCatalog | None = PriceCatalog(PRICE_CATALOG_PATH, PRICE_CATALOG_SLOTS) if PRICE_CATALOG_SLOTS else None
+user_filter: BloomFilter | None = BloomFilter(USER_FILTER_PATH, USER_FILTER_BITS) if USER_FILTER_BITS else None
+negative_cache: NegativeCache | None = NegativeCache(NEGATIVE_CACHE_SIZE, NEGATIVE_CACHE_TTL) if NEGATIVE_CACHE_SIZE else None
+catalog_counts: Counter = Counter()
+catalog_counts_lock = threading.Lock()
+
+
+def count_check(outcome: str):
+    with catalog_counts_lock:
+        catalog_counts[outcome] += 1
+
+
+def item_price(item_id: str) -> int | None:
+    # None when the item is not in the shared price table, the caller then asks the stock service
+    price = price_catalog.price(item_id) if price_catalog is not None else None
+    count_check("item_local" if price is not None else "item_remote")
+    return price
+
+
+def user_known(user_id: str) -> bool | None:
+    # Users in the filter exist, up to its rare false positives, the others are checked with the payment service
+    if user_filter is not None and user_filter.might_contain(user_id):
+        count_check("user_local")
+        return True
+    count_check("user_remote")
+    return None
+
+
+def known_missing(kind: str, key: str) -> bool:
+    missing = negative_cache is not None and f"{kind}:{key}" in negative_cache
+    if missing:
+        count_check(f"{kind}_rejected")
+    return missing
+
+
+def remember_missing(kind: str, key: str, reply):
+    # Only "not found" replies are cached, a failing service is asked again on the next request
+    if negative_cache is not None and reply.status_code == 400 and "not found" in reply.text:
+        negative_cache.add(f"{kind}:{key}")
+
+
+def refresh_catalog(table: PriceCatalog | BloomFilter, url: str, field: str) -> int:
+    # Pulls a feed from the last position in the table until it is caught up
+    pulled = 0
+    while True:
+        reply = requests.get(url, params={"since": table.last_id(), "count": CATALOG_PAGE}, timeout=REDIS_POOL_TIMEOUT)
+        reply.raise_for_status()
+        feed = reply.json()
+        table.update(feed[field], feed["last_id"], feed["reset"])
+        pulled += len(feed[field])
+        if len(feed[field]) < CATALOG_PAGE:
+            return pulled
+
+
+def catalog_loop():
+    feeds = [
+        (price_catalog, f"{GATEWAY_URL}/stock/catalog", "prices"),
+        (user_filter, f"{GATEWAY_URL}/payment/catalog", "users"),
+    ]
+    while not recovery_stop.is_set():
+        for table, url, field in feeds:
+            # One worker per node fills a table, the others only read it
+            if table is not None and table.try_become_writer():
+                try:
+                    refresh_catalog(table, url, field)
+                except (requests.exceptions.RequestException, ValueError, KeyError) as exc:
+                    app.logger.error(f"Refresh from {url} failed: {exc}")
+        recovery_stop.wait(CATALOG_REFRESH)
+
+
+@app.get('/catalog/status')
+def price_catalog_status():
+    with catalog_counts_lock:
+        checks = dict(catalog_counts)
+    status = {"enabled": price_catalog is not None, "worker": WORKER_ID, "checks": checks}
+    if price_catalog is not None:
+        status.update({
+            "writer": price_catalog.writer,
+            "items": price_catalog.used(),
+            "slots": price_catalog.slots,
+            "last_id": price_catalog.last_id(),
+        })
+    if user_filter is not None:
+        status["user_filter"] = {
+            "writer": user_filter.writer,
+            "users": user_filter.used(),
+            "bits": user_filter.bits,
+            "last_id": user_filter.last_id(),
+        }
+    if negative_cache is not None:
+        status["negative_cache"] = {"entries": len(negative_cache.entries), "ttl": negative_cache.ttl}
+    return jsonify(status), 200
 
 ########################################################################################################################
 #   START OF LOG FUNCTIONS
@@ -124,6 +650,11 @@ def format_log_entry(log_entry: LogOrderValue) -> dict:
             "user_id": log_entry.old_ordervalue.user_id if log_entry.old_ordervalue else None,
             "total_cost": log_entry.old_ordervalue.total_cost if log_entry.old_ordervalue else None
         },
+        "delta": {
+            "items": log_entry.delta.items,
+            "cost": log_entry.delta.cost,
+            "old_paid": log_entry.delta.old_paid
+        } if log_entry.delta else None,
         "url": {
             "from": log_entry.from_url,
             "to": log_entry.to_url
@@ -143,9 +674,88 @@ def sort_logs(logs: list[dict]):
     return log_dict
 
 
+class LogFilters(Struct):
+    type: str | None = None
+    status: str | None = None
+    order_id: str | None = None
+    since: str | None = None
+    until: str | None = None
+
+
+def log_key_timestamp(log_key: str) -> str:
+    # Log keys look like "log:<YYYYmmddHHMMSSffffff><counter>"
+    return log_key.split(":")[-1][:20]
+
+
+def parse_log_filters() -> LogFilters:
+    since = request.args.get("since")
+    until = request.args.get("until")
+    return LogFilters(
+        type=request.args.get("type"),
+        status=request.args.get("status"),
+        order_id=request.args.get("order_id"),
+        # Allow prefixes such as "20240601" or "2024060112" for the time range
+        since=since.ljust(20, "0") if since else None,
+        until=until.ljust(20, "9") if until else None,
+    )
+
+
+def log_matches_filters(log: dict, filters: LogFilters) -> bool:
+    if filters.type is not None and log["type"] != filters.type:
+        return False
+    if filters.status is not None and log["status"] != filters.status:
+        return False
+    if filters.order_id is not None and log["order_id"] != filters.order_id:
+        return False
+    return True
+
+
+def log_key_in_range(log_key: str, filters: LogFilters) -> bool:
+    timestamp_str = log_key_timestamp(log_key)
+    if filters.since is not None and timestamp_str < filters.since:
+        return False
+    if filters.until is not None and timestamp_str > filters.until:
+        return False
+    return True
+
+
+def scan_log_keys(batch_size: int = LOG_PAGE_SIZE, read_db: redis.Redis | ShardedRedis | None = None):
+    # Walk the log keys with SCAN so the whole keyspace is never loaded at once
+    batch: list[str] = []
+    for key in (read_db or db).scan_iter(match="log:*", count=batch_size):
+        batch.append(key.decode('utf-8'))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def fetch_logs(log_keys: list[str], filters: LogFilters, read_db: redis.Redis | ShardedRedis | None = None) -> list[dict]:
+    # Filter on the timestamp embedded in the key before fetching anything
+    log_keys = [key for key in log_keys if log_key_in_range(key, filters)]
+    if not log_keys:
+        return []
+
+    logs = []
+    for key, raw_data in zip(log_keys, (read_db or db).mget(log_keys)):
+        if not raw_data:
+            continue
+        log = format_log_entry(msgpack.decode(raw_data, type=LogOrderValue))
+        if log_matches_filters(log, filters):
+            logs.append({"id": key, "log": log})
+    return logs
+
+
+def encode_stream_chunk(records: list, stream_format: str) -> bytes:
+    if stream_format == "msgpack":
+        return b"".join(msgpack.encode(record) for record in records)
+    return b"".join(json.encode(record) + b"\n" for record in records)
+
+
 def get_log_from_db(log_id: str) -> LogOrderValue | None:
     try:
-        entry: bytes = db.get(log_id)
+        entry: bytes = reader(stale_ok=True).get(log_id)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
     entry: LogOrderValue | None = msgpack.decode(entry, type=LogOrderValue) if entry else None
@@ -156,7 +766,7 @@ def get_log_from_db(log_id: str) -> LogOrderValue | None:
 
 @app.get('/log_count')
 def get_log_count():
-    return Response(str(len(db.keys("log:*"))), status=200)
+    return Response(str(len(reader(stale_ok=True).keys("log:*"))), status=200)
 
 
 @app.get('/log/<log_id>')
@@ -170,10 +780,11 @@ def find_log(log_id: str):
 def find_all_logs():
     try:
         # Retrieve all keys starting with "log:" from Redis
-        log_keys = [key.decode('utf-8') for key in db.keys("log:*")]
+        read_db = reader(stale_ok=True)
+        log_keys = [key.decode('utf-8') for key in read_db.keys("log:*")]
 
         # Retrieve values corresponding to the keys
-        logs = [{"id": key, "log": msgpack.decode(db.get(key))} for key in log_keys]
+        logs = [{"id": key, "log": msgpack.decode(read_db.get(key))} for key in log_keys]
 
         return jsonify({'logs': logs}), 200
     except redis.exceptions.RedisError:
@@ -185,30 +796,15 @@ def find_all_logs_time(time: datetime, min_diff: int = 5):
         # Calculate the range
         lower_bound: datetime = time - timedelta(minutes=min_diff)
         upper_bound: datetime = time
+        filters = LogFilters(
+            since=lower_bound.strftime("%Y%m%d%H%M%S%f"),
+            until=upper_bound.strftime("%Y%m%d%H%M%S%f"),
+        )
 
-        # Create a broad pattern to fetch all potential keys
-        broad_pattern = "log:*"
-        
-        # Retrieve all keys matching the broad pattern
-        potential_keys = [key.decode('utf-8') for key in db.keys(broad_pattern)]
-
-        # Filter keys based on the timestamp
+        # Fetch the logs within the range batch by batch
         logs = []
-        for key in potential_keys:
-            timestamp_str = key.split(":")[-1][:20]
-            key_timestamp: datetime = datetime.strptime(timestamp_str, "%Y%m%d%H%M%S%f")
-            
-            if lower_bound > key_timestamp or upper_bound < key_timestamp:
-                continue
-            
-            raw_data = db.get(key)
-            
-            if not raw_data:
-                continue
-            
-            # Decode the raw data into a LogOrderValue object
-            log_entry = msgpack.decode(raw_data, type=LogOrderValue)
-            logs.append({"id": key, "log": format_log_entry(log_entry)})
+        for log_keys in scan_log_keys():
+            logs.extend(fetch_logs(log_keys, filters))
 
         return logs
     except redis.exceptions.RedisError:
@@ -221,7 +817,41 @@ def find_sorted_logs(min_diff: int):
     logs = find_all_logs_time(time, int(min_diff))
     sorted_logs = sort_logs(logs)
     
-    return jsonify(sorted_logs), 200    
+    return jsonify(sorted_logs), 200
+
+@app.get('/logs/page')
+def find_logs_page():
+    cursor = int(request.args.get("cursor", 0))
+    count = min(int(request.args.get("count", LOG_PAGE_SIZE)), LOG_PAGE_MAX)
+    filters = parse_log_filters()
+
+    try:
+        read_db = reader(stale_ok=True)
+        next_cursor, log_keys = read_db.scan(cursor=cursor, match="log:*", count=count)
+        logs = fetch_logs([key.decode('utf-8') for key in log_keys], filters, read_db)
+    except redis.exceptions.RedisError:
+        return abort(500, 'Failed to retrieve logs from the database')
+
+    # A returned cursor of 0 means that the whole log has been walked
+    return jsonify({"logs": logs, "cursor": next_cursor}), 200
+
+
+@app.get('/logs/stream')
+def stream_logs():
+    stream_format = request.args.get("format", "ndjson")
+    if stream_format not in STREAM_MIMETYPES:
+        return abort(400, f"Unknown stream format: {stream_format}")
+    filters = parse_log_filters()
+
+    read_db = reader(stale_ok=True)
+    
+    def generate():
+        for log_keys in scan_log_keys(read_db=read_db):
+            chunk = encode_stream_chunk(fetch_logs(log_keys, filters, read_db), stream_format)
+            if chunk:
+                yield chunk
+
+    return Response(stream_with_context(generate()), mimetype=STREAM_MIMETYPES[stream_format])
 
 
 # For testing purposes only
@@ -254,7 +884,7 @@ def create_order_benchmark(user_id: str):
 
 @app.get('/find/<order_id>/benchmark')
 def find_order_benchmark(order_id: str):
-    entry: OrderValue = db.get(order_id)
+    entry: OrderValue = reader(stale_ok=True).get(order_id)
     order_entry: OrderValue | None = msgpack.decode(entry, type=OrderValue) if entry else None
     
     if order_entry is None:
@@ -268,16 +898,21 @@ def add_item_benchmark(order_id: str, item_id: str, quantity: int):
     entry: OrderValue = db.get(order_id)
     order_entry = msgpack.decode(entry, type=OrderValue)
     
-    item_json = send_get_request(f"{GATEWAY_URL}/stock/find/{item_id}/benchmark").json()
+    price = item_price(item_id)
+    if price is None:
+        request_url = f"{GATEWAY_URL}/stock/find/{item_id}/benchmark"
+        price = stock_flight.do(request_url, lambda: send_get_request(request_url)).json()["price"]
     
     order_entry.items.append((item_id, int(quantity)))
-    order_entry.total_cost += int(quantity) * item_json["price"]
+    order_entry.total_cost += int(quantity) * price
     
     try:
         db.set(order_id, msgpack.encode(order_entry))
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
     
+    publish_invalidation(order_id)
+
     return Response(f"Item: {item_id} added to: {order_id} price updated to: {order_entry.total_cost}", status=200)
 
 
@@ -318,6 +953,8 @@ def checkout_benchmark(order_id: str):
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
 
+    publish_invalidation(order_id)
+
     return Response(f"Checkout successful", status=200)
 
 ########################################################################################################################
@@ -327,14 +964,20 @@ def checkout_benchmark(order_id: str):
 def create_order(user_id: str):
     log_id = str(uuid.uuid4())
     
-    # Url for the request to the payment service
-    request_url = f"{GATEWAY_URL}/payment/find_user/{user_id}"
-
-    # Send request to the payment service to check if the user exists
-    payment_reply = send_get_request(request_url)
+    # Users in the user filter exist and recently missing users are rejected, only the others are checked remotely
+    user_exists = user_known(user_id)
+    if user_exists is None and not known_missing("user", user_id):
+        # Url for the request to the payment service
+        request_url = f"{GATEWAY_URL}/payment/find_user/{user_id}"
+
+        # Send request to the payment service to check if the user exists
+        payment_reply = send_get_request(request_url)
+        user_exists = payment_reply.status_code == 200
+        if not user_exists:
+            remember_missing("user", user_id, payment_reply)
     
     # Request failed because user does not exist
-    if payment_reply.status_code != 200:        
+    if not user_exists:        
         return abort(400, f"User: {user_id} does not exist!")
     
     # Create the order
@@ -355,7 +998,8 @@ def create_order(user_id: str):
     )
     
     # Set the log entry and the order value in the pipeline
-    log_key = get_key()
+    log_key = get_key(order_id)
+    pipeline_db = db.pipeline()
     pipeline_db.set(log_key, msgpack.encode(create_payload))
     pipeline_db.set(order_id, msgpack.encode(order_value))
     try:
@@ -369,7 +1013,7 @@ def create_order(user_id: str):
             status=LogStatus.FAILURE,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
         )
-        db.set(get_key(), msgpack.encode(error_payload))
+        db.set(get_key(order_id), msgpack.encode(error_payload))
         
         pipeline_db.discard()
         
@@ -384,14 +1028,19 @@ def create_order(user_id: str):
         status=LogStatus.SUCCESS,
         dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
     )
-    db.set(get_key(), msgpack.encode(sent_payload_to_user))
+    db.set(get_key(order_id), msgpack.encode(sent_payload_to_user))
     
     return jsonify({'order_id': order_id, 'log_id': log_id}), 200
 
 
 @app.get('/find/<order_id>')
 def find_order(order_id: str):
-    order_entry: OrderValue = get_order_from_db(order_id)
+    order_entry, etag = get_tagged_order(order_id, stale_ok=True)
+    
+    # A paid order no longer changes, so it can be cached for PAID_ORDER_MAX_AGE seconds
+    headers = validator_headers(etag, max_age=PAID_ORDER_MAX_AGE if order_entry.paid else 0)
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status=304, headers=headers)
     
     # Return the order
     return jsonify(
@@ -402,21 +1051,109 @@ def find_order(order_id: str):
             "user_id": order_entry.user_id,
             "total_cost": order_entry.total_cost,
         }
-    ), 200
+    ), 200, headers
+
+
+@app.post('/find_many')
+def find_many_orders():
+    # The body is a JSON list of order ids, the entries are streamed in the order of the ids, one MGET per chunk
+    stream_format = request.args.get("format", "ndjson")
+    if stream_format not in STREAM_MIMETYPES:
+        return abort(400, f"Unknown stream format: {stream_format}")
+    try:
+        order_ids: list[str] = json.decode(request.get_data(), type=list[str])
+    except MsgspecError:
+        return abort(400, "Expected a JSON list of order ids")
+    if len(order_ids) > FIND_MANY_MAX:
+        return abort(400, f"At most {FIND_MANY_MAX} order ids per request")
+    
+    read_db = reader(stale_ok=True)
+    decoder = msgpack.Decoder(OrderValue)
+    
+    def generate():
+        for start in range(0, len(order_ids), FIND_MANY_CHUNK):
+            chunk_ids = order_ids[start:start + FIND_MANY_CHUNK]
+            try:
+                entries: list[bytes | None] = read_db.mget(chunk_ids)
+            except redis.exceptions.RedisError:
+                # The status line is already sent, so the failure is reported per entry
+                yield encode_stream_chunk([{"order_id": order_id, "found": False, "error": DB_ERROR_STR} for order_id in chunk_ids], stream_format)
+                continue
+            # Missing ids are only reported, unlike a single find they do not write a failure log
+            yield encode_stream_chunk(
+                [order_record(order_id, decoder.decode(entry) if entry else None) for order_id, entry in zip(chunk_ids, entries)],
+                stream_format
+            )
+    
+    return Response(stream_with_context(generate()), mimetype=STREAM_MIMETYPES[stream_format])
+
+
+def order_record(order_id: str, entry: OrderValue | None) -> dict:
+    if entry is None:
+        return {"order_id": order_id, "found": False}
+    return {
+        "order_id": order_id,
+        "found": True,
+        "paid": entry.paid,
+        "items": entry.items,
+        "user_id": entry.user_id,
+        "total_cost": entry.total_cost,
+    }
 
 
 @app.post('/addItem/<order_id>/<item_id>/<quantity>')
 def add_item(order_id: str, item_id: str, quantity: int):
     log_id = str(uuid.uuid4())
 
-    # Url for the request to the stock service
-    request_url = f"{GATEWAY_URL}/stock/find/{item_id}"
+    # Items in the shared price table exist, the others are checked with the stock service
+    price = item_price(item_id)
+    if price is None:
+        # Url for the request to the stock service
+        request_url = f"{GATEWAY_URL}/stock/find/{item_id}"
 
-    # Send request to the stock service to check if the item exists
-    stock_reply = send_get_request(request_url)
+        # Send request to the stock service to check if the item exists, unless it was recently reported missing
+        # Concurrent lookups of the same item share one request
+        stock_reply = None if known_missing("item", item_id) else stock_flight.do(request_url, lambda: send_get_request(request_url))
 
-    # Request failed because item does not exist
-    if stock_reply.status_code != 200:
+        # Request failed because item does not exist
+        if stock_reply is None or stock_reply.status_code != 200:
+            if stock_reply is not None:
+                remember_missing("item", item_id, stock_reply)
+            error_payload = LogOrderValue(
+                id=log_id,
+                type=LogType.SENT,
+                from_url=request.url,
+                to_url=request.referrer,
+                status=LogStatus.FAILURE,
+                dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+            )
+            db.set(get_key(order_id), msgpack.encode(error_payload))
+            return abort(400, f"Item: {item_id} does not exist!")
+        price = stock_reply.json()["price"]
+
+    # Get the order from the database
+    order_entry: OrderValue = get_order_from_db(order_id)
+    
+    # Locally update the order locally
+    order_entry.items.append((item_id, int(quantity)))
+    order_entry.total_cost += int(quantity) * price
+
+    # Create a log entry for the update request, with the added line instead of the whole order
+    update_payload = LogOrderValue(
+        id=log_id,
+        type=LogType.UPDATE,
+        order_id=order_id,
+        delta=OrderDelta(items=[(item_id, int(quantity))], cost=int(quantity) * price),
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+    )
+
+    # Set the log entry and the updated order value in the pipeline
+    pipeline_db = db.pipeline()
+    pipeline_db.set(get_key(order_id), msgpack.encode(update_payload))
+    pipeline_db.set(order_id, msgpack.encode(order_entry))
+    try:
+        pipeline_db.execute()
+    except redis.exceptions.RedisError:
         error_payload = LogOrderValue(
             id=log_id,
             type=LogType.SENT,
@@ -425,29 +1162,111 @@ def add_item(order_id: str, item_id: str, quantity: int):
             status=LogStatus.FAILURE,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
         )
-        db.set(get_key(), msgpack.encode(error_payload))
-        return abort(400, f"Item: {item_id} does not exist!")
+        db.set(get_key(order_id), msgpack.encode(error_payload))
+        
+        pipeline_db.discard()
+        
+        return abort(400, DB_ERROR_STR)
+
+    publish_invalidation(order_id)
 
-    # Get the order from the database and create a copy of it for rollback purposes
+    # Create a log for the sent response
+    sent_payload_to_user = LogOrderValue(
+        id=log_id,
+        type=LogType.SENT,
+        from_url=request.url,
+        to_url=request.referrer,
+        order_id=order_id,
+        status=LogStatus.SUCCESS,
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+    )
+    db.set(get_key(order_id), msgpack.encode(sent_payload_to_user))
+
+    return Response(f"Item: {item_id} added to: {order_id} total price updated to: {order_entry.total_cost}, log_id: {log_id}", status=200)
+
+
+def fetch_item_prices(item_ids: list[str]) -> tuple[dict[str, int], list[str]]:
+    # Prices from the shared price table, the other items are read with one bulk request to the stock service
+    prices: dict[str, int] = {}
+    missing: list[str] = []
+    unknown: list[str] = []
+    for item_id in dict.fromkeys(item_ids):
+        price = item_price(item_id)
+        if price is not None:
+            prices[item_id] = price
+        elif known_missing("item", item_id):
+            missing.append(item_id)
+        else:
+            unknown.append(item_id)
+    if not unknown:
+        return prices, missing
+    
+    try:
+        stock_reply = requests.post(f"{GATEWAY_URL}/stock/find_many", data=json.encode(unknown), stream=True)
+    except requests.exceptions.RequestException:
+        return abort(400, REQ_ERROR_STR)
+    if stock_reply.status_code != 200:
+        return abort(400, REQ_ERROR_STR)
+    
+    for line in stock_reply.iter_lines():
+        if not line:
+            continue
+        entry: dict = json.decode(line)
+        if entry["found"]:
+            prices[entry["item_id"]] = entry["price"]
+        elif "error" in entry:
+            return abort(400, DB_ERROR_STR)
+        else:
+            missing.append(entry["item_id"])
+            if negative_cache is not None:
+                negative_cache.add(f"item:{entry['item_id']}")
+    return prices, missing
+
+
+@app.post('/addItems/<order_id>')
+def add_items(order_id: str):
+    # The body is a JSON list of [item_id, quantity] pairs, added with one order update and one UPDATE log
+    log_id = str(uuid.uuid4())
+    try:
+        lines: list[tuple[str, int]] = json.decode(request.get_data(), type=list[tuple[str, int]])
+    except MsgspecError:
+        return abort(400, "Expected a JSON list of [item_id, quantity] pairs")
+    
+    prices, missing = fetch_item_prices([item_id for item_id, _ in lines])
+    
+    # Request failed because some items do not exist, none of the items are added
+    if missing:
+        error_payload = LogOrderValue(
+            id=log_id,
+            type=LogType.SENT,
+            from_url=request.url,
+            to_url=request.referrer,
+            status=LogStatus.FAILURE,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+        )
+        db.set(get_key(order_id), msgpack.encode(error_payload))
+        return abort(400, f"Items: {', '.join(missing)} do not exist!")
+    
+    # Get the order from the database
     order_entry: OrderValue = get_order_from_db(order_id)
-    old_order_entry = deepcopy(order_entry)
     
-    # Locally update the order locally
-    item_json: dict = stock_reply.json()
-    order_entry.items.append((item_id, int(quantity)))
-    order_entry.total_cost += int(quantity) * item_json["price"]
-
-    # Create a log entry for the update request
+    # Locally update the order
+    added_cost = sum(quantity * prices[item_id] for item_id, quantity in lines)
+    order_entry.items.extend(lines)
+    order_entry.total_cost += added_cost
+    
+    # Create a single log entry for all the added items
     update_payload = LogOrderValue(
         id=log_id,
         type=LogType.UPDATE,
         order_id=order_id,
-        old_ordervalue=old_order_entry,
+        delta=OrderDelta(items=lines, cost=added_cost),
         dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
     )
-
+    
     # Set the log entry and the updated order value in the pipeline
-    pipeline_db.set(get_key(), msgpack.encode(update_payload))
+    pipeline_db = db.pipeline()
+    pipeline_db.set(get_key(order_id), msgpack.encode(update_payload))
     pipeline_db.set(order_id, msgpack.encode(order_entry))
     try:
         pipeline_db.execute()
@@ -460,12 +1279,14 @@ def add_item(order_id: str, item_id: str, quantity: int):
             status=LogStatus.FAILURE,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
         )
-        db.set(get_key(), msgpack.encode(error_payload))
+        db.set(get_key(order_id), msgpack.encode(error_payload))
         
         pipeline_db.discard()
         
         return abort(400, DB_ERROR_STR)
-
+    
+    publish_invalidation(order_id)
+    
     # Create a log for the sent response
     sent_payload_to_user = LogOrderValue(
         id=log_id,
@@ -476,12 +1297,14 @@ def add_item(order_id: str, item_id: str, quantity: int):
         status=LogStatus.SUCCESS,
         dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
     )
-    db.set(get_key(), msgpack.encode(sent_payload_to_user))
-
-    return Response(f"Item: {item_id} added to: {order_id} total price updated to: {order_entry.total_cost}, log_id: {log_id}", status=200)
+    db.set(get_key(order_id), msgpack.encode(sent_payload_to_user))
+    
+    return Response(f"{len(lines)} items added to: {order_id} total price updated to: {order_entry.total_cost}, log_id: {log_id}", status=200)
 
 
-def rollback_stock(removed_items: list[tuple[str, int]], log_id: str | None = None):    
+def rollback_stock(removed_items: list[tuple[str, int]], log_id: str | None = None, order_id: str | None = None, to_url: str | None = None):    
+    # Outside of a request, e.g. in the threads of checkout_many, the caller passes the url of its request
+    to_url = to_url or request.url
     error_flag = False
     for item_id, quantity in removed_items:
         url = f"{GATEWAY_URL}/stock/add/{item_id}/{quantity}"
@@ -495,11 +1318,11 @@ def rollback_stock(removed_items: list[tuple[str, int]], log_id: str | None = No
             id=log_id,
             type=LogType.RECEIVED,
             from_url=url,
-            to_url=request.url,
+            to_url=to_url,
             status=LogStatus.SUCCESS if rollback_resp_status == 200 else LogStatus.FAILURE,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
         )
-        db.set(get_key(), msgpack.encode(received_payload_from_stock))
+        db.set(get_key(order_id), msgpack.encode(received_payload_from_stock))
         
         # If one of the rollbacks failed, set the error flag to True
         if rollback_resp_status != 200: # No log on purpose since the fault tolerance should reroll again
@@ -510,82 +1333,341 @@ def rollback_stock(removed_items: list[tuple[str, int]], log_id: str | None = No
         return abort(400, f"Failed to rollback")
 
 
+def place_hold(url: str, data: bytes | None = None) -> tuple[int, str]:
+    # A request that fails counts as refused, a hold it placed anyway is given back by the sweeper of its service
+    try:
+        reply = requests.post(url, data=data)
+    except requests.exceptions.RequestException as exc:
+        return 400, str(exc)
+    return reply.status_code, reply.text
+
+
+def settle_hold(service: str, action: str, hold_id: str, order_id: str) -> bool | None:
+    # Confirms, captures, releases or voids a hold of a checkout, a release that fails is done by the sweeper of the service.
+    # Settling is idempotent, so a request without an answer is sent again. None when no answer came back at all, the
+    # hold may or may not be settled
+    url = f"{GATEWAY_URL}/{service}/{action}/{hold_id}"
+    reply_status = None
+    for attempt in range(SETTLE_ATTEMPTS):
+        if attempt:
+            sleep(SETTLE_RETRY_DELAY * 2 ** (attempt - 1))
+        try:
+            reply_status = requests.post(url).status_code
+        except requests.exceptions.RequestException:
+            reply_status = None
+        if reply_status is not None and reply_status < 500:
+            break
+    
+    received_payload = LogOrderValue(
+        id=hold_id,
+        type=LogType.RECEIVED,
+        from_url=url,
+        to_url=request.url,
+        status=LogStatus.SUCCESS if reply_status == 200 else LogStatus.FAILURE,
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+    )
+    db.set(get_key(order_id), msgpack.encode(received_payload))
+    if reply_status is None or reply_status >= 500:
+        return None
+    return reply_status == 200
+
+
+########################################################################################################################
+#   START OF SAGA FUNCTIONS
+########################################################################################################################
+def saga_key(saga_id: str, order_id: str) -> str:
+    # A saga lives on the node of its order, so the order is marked paid in the same transaction that completes the saga
+    return f"saga:{saga_id}{{{order_id}}}"
+
+
+def saga_result_key(saga_id: str, order_id: str) -> str:
+    return f"saga:{saga_id}:result{{{order_id}}}"
+
+
+def checkout_with_events(order_id: str, order_entry: OrderValue, items_quantities: dict[str, int], saga_id: str):
+    # The holds are decided by the events of stock and payment, half of the hold time is left to settle them
+    key = saga_key(saga_id, order_id)
+    try:
+        pipeline_db = db.pipeline()
+        deadline = time() + SAGA_HOLD_TTL / 2
+        pipeline_db.hset(key, mapping={"state": "pending", "deadline": deadline})
+        pipeline_db.expire(key, SAGA_KEEP)
+        pipeline_db.execute()
+        
+        # The sweeper of the recovery leader cancels the saga when no outcome decided it by its deadline
+        db.zadd(SAGA_PENDING_KEY, {msgpack.encode([saga_id, order_id]): deadline})
+        saga_bus.publish(CHECKOUT_STREAM, {
+            "type": "requested",
+            "saga_id": saga_id,
+            "order_id": order_id,
+            "user_id": order_entry.user_id,
+            "total_cost": order_entry.total_cost,
+            "items": list(items_quantities.items()),
+            "ttl": SAGA_HOLD_TTL,
+        })
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    
+    # The saga finishes without this request, which only waits for its outcome when asked to
+    if request.args.get("wait") == "0":
+        return jsonify({"saga_id": saga_id, "state": "pending"}), 202
+    result = client_for(db, key).blpop([saga_result_key(saga_id, order_id)], timeout=SAGA_WAIT)
+    if result is None:
+        return jsonify({"saga_id": saga_id, "state": "pending"}), 202
+    
+    state, detail = msgpack.decode(result[1])
+    if state != "completed":
+        return abort(400, detail)
+    return Response(f"Checkout successful, saga: {saga_id}", status=200)
+
+
+def complete_saga(saga_id: str, order_id: str) -> bool:
+    # Marks the order paid and the saga completed in one transaction, only while the saga is still pending, returns
+    # whether this call decided the saga
+    key = saga_key(saga_id, order_id)
+    update_key, sent_key = get_key(order_id), get_key(order_id)
+    with client_for(db, key).pipeline() as pipeline_db:
+        while True:
+            try:
+                pipeline_db.watch(key, order_id)
+                raw_order: bytes | None = pipeline_db.get(order_id)
+                if pipeline_db.hget(key, "state") != b"pending":
+                    pipeline_db.reset()
+                    return False
+                if not raw_order:
+                    pipeline_db.reset()
+                    return cancel_saga(saga_id, order_id, f"Order: {order_id} not found!")
+                
+                order_entry: OrderValue = msgpack.decode(raw_order, type=OrderValue)
+                delta = OrderDelta(old_paid=order_entry.paid)
+                order_entry.paid = True
+                update_payload = LogOrderValue(
+                    id=saga_id,
+                    type=LogType.UPDATE,
+                    order_id=order_id,
+                    delta=delta,
+                    dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+                )
+                sent_payload = LogOrderValue(
+                    id=saga_id,
+                    type=LogType.SENT,
+                    from_url=OUTCOME_STREAM,
+                    to_url=CHECKOUT_STREAM,
+                    order_id=order_id,
+                    status=LogStatus.SUCCESS,
+                    dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+                )
+                pipeline_db.multi()
+                pipeline_db.set(update_key, msgpack.encode(update_payload))
+                pipeline_db.set(order_id, msgpack.encode(order_entry))
+                pipeline_db.hset(key, "state", "completed")
+                pipeline_db.set(sent_key, msgpack.encode(sent_payload))
+                pipeline_db.execute()
+                break
+            except redis.exceptions.WatchError:
+                continue
+    
+    publish_invalidation(order_id)
+    return True
+
+
+def cancel_saga(saga_id: str, order_id: str, reason: str) -> bool:
+    key = saga_key(saga_id, order_id)
+    with client_for(db, key).pipeline() as pipeline_db:
+        while True:
+            try:
+                pipeline_db.watch(key)
+                if pipeline_db.hget(key, "state") != b"pending":
+                    pipeline_db.reset()
+                    return False
+                pipeline_db.multi()
+                pipeline_db.hset(key, mapping={"state": "cancelled", "reason": reason})
+                pipeline_db.execute()
+                return True
+            except redis.exceptions.WatchError:
+                continue
+
+
+def handle_saga_outcome(event: dict):
+    saga_id, order_id = event["saga_id"], event["order_id"]
+    key = saga_key(saga_id, order_id)
+    
+    # Only the first outcome of a service counts, a redelivered event changes nothing. Outcomes of a saga that expired
+    # are dropped, their holds expire as well
+    if not db.exists(key):
+        return
+    db.hsetnx(key, event["service"], msgpack.encode([event["ok"], event["detail"]]))
+    saga: dict[bytes, bytes] = db.hgetall(key)
+    
+    outcomes = [msgpack.decode(saga[service]) for service in (b"stock", b"payment") if service in saga]
+    failures = [detail for ok, detail in outcomes if not ok]
+    if saga[b"state"] == b"pending":
+        if failures:
+            decided = cancel_saga(saga_id, order_id, failures[0])
+        elif len(outcomes) < 2:
+            return
+        elif time() > float(saga[b"deadline"]):
+            decided = cancel_saga(saga_id, order_id, "Checkout holds expired")
+        else:
+            decided = complete_saga(saga_id, order_id)
+        
+        saga = db.hgetall(key)
+        if decided:
+            answer_saga(saga_id, order_id, saga)
+    
+    # A decided saga announces its decision again for every later outcome, so a hold placed after the cancellation, or
+    # an announcement lost with a crashed worker, still reaches stock and payment
+    saga_bus.publish(CHECKOUT_STREAM, {"type": saga[b"state"].decode('utf-8'), "saga_id": saga_id, "order_id": order_id})
+
+
+def answer_saga(saga_id: str, order_id: str, saga: dict[bytes, bytes]):
+    # Only the worker that decided the saga answers the waiting checkout request and takes it off the pending sagas
+    state, reason = saga[b"state"].decode('utf-8'), saga.get(b"reason", b"").decode('utf-8')
+    pipeline_result = db.pipeline()
+    pipeline_result.hincrby(SAGA_STATS_KEY, state, 1)
+    pipeline_result.rpush(saga_result_key(saga_id, order_id), msgpack.encode([state, reason]))
+    pipeline_result.expire(saga_result_key(saga_id, order_id), int(SAGA_WAIT) + 1)
+    pipeline_result.zrem(SAGA_PENDING_KEY, msgpack.encode([saga_id, order_id]))
+    pipeline_result.execute()
+
+
+def sweep_sagas() -> int:
+    # Cancels the sagas that are still pending after their deadline because an outcome never arrived, stock and payment
+    # give their holds back on the cancellation. A saga decided in the meantime is only taken off the pending sagas
+    cancelled = 0
+    for member in db.zrangebyscore(SAGA_PENDING_KEY, "-inf", time(), start=0, num=SAGA_SWEEP_BATCH):
+        saga_id, order_id = msgpack.decode(member)
+        if cancel_saga(saga_id, order_id, "Checkout timed out"):
+            answer_saga(saga_id, order_id, db.hgetall(saga_key(saga_id, order_id)))
+            saga_bus.publish(CHECKOUT_STREAM, {"type": "cancelled", "saga_id": saga_id, "order_id": order_id})
+            cancelled += 1
+        else:
+            db.zrem(SAGA_PENDING_KEY, member)
+    if cancelled:
+        db.hincrby(SAGA_STATS_KEY, "timed_out", cancelled)
+    return cancelled
+
+
+def saga_sweep_loop():
+    while not recovery_stop.wait(SAGA_SWEEP_INTERVAL):
+        # Only the worker that holds the recovery lease sweeps
+        if not recovery_leader.is_set():
+            continue
+        try:
+            sweep_sagas()
+        except redis.exceptions.RedisError as exc:
+            app.logger.error(f"Sweeping the sagas failed: {exc}")
+
+
+@app.get('/saga/<order_id>/<saga_id>')
+def find_saga(order_id: str, saga_id: str):
+    saga: dict[bytes, bytes] = db.hgetall(saga_key(saga_id, order_id))
+    if not saga:
+        return abort(400, f"Saga: {saga_id} not found!")
+    return jsonify({
+        "saga_id": saga_id,
+        "order_id": order_id,
+        "state": saga[b"state"].decode('utf-8'),
+        "reason": saga.get(b"reason", b"").decode('utf-8') or None,
+        **{service: msgpack.decode(saga[service.encode()]) for service in ("stock", "payment") if service.encode() in saga},
+    }), 200
+
+
+@app.get('/saga/status')
+def saga_status():
+    if saga_bus is None:
+        return jsonify({"enabled": False}), 200
+    stats = {key.decode('utf-8'): int(value) for key, value in db.hgetall(SAGA_STATS_KEY).items()}
+    return jsonify({"enabled": True, **saga_bus.status(OUTCOME_STREAM), **stats, "pending_sagas": db.zcard(SAGA_PENDING_KEY)}), 200
+
+
 @app.post('/checkout/<order_id>')
 def checkout(order_id: str):
     app.logger.debug(f"Checking out {order_id}") # Keep this for benchmarking purposes
     
     log_id = str(uuid.uuid4())
 
-    # Get the order from the database and create a copy of it for rollback purposes
+    # Get the order from the database
     order_entry: OrderValue = get_order_from_db(order_id)
-    old_order_entry = deepcopy(order_entry)
 
     # get the quantity per item
     items_quantities: dict[str, int] = defaultdict(int)
     for item_id, quantity in order_entry.items:
         items_quantities[item_id] += quantity
 
-    # The removed items will contain the items that we already have successfully subtracted stock from for rollback purposes.
-    removed_items: list[tuple[str, int]] = []
-    for item_id, quantity in items_quantities.items():
-
-        # Url for the request to the stock service
-        request_url = f"{GATEWAY_URL}/stock/subtract/{item_id}/{quantity}"
-
-        # Send request to the stock service to subtract the stock
-        stock_reply = send_post_request(request_url)
-        stock_reply_status = stock_reply.status_code
-
-        # Create a log entry for the received response (success or failure)
-        received_payload_from_stock = LogOrderValue(
+    if saga_bus is not None:
+        return checkout_with_events(order_id, order_entry, items_quantities, log_id)
+
+    # Hold the stock of all items and the credit of the user at the same time, both services give their hold back when
+    # the checkout never settles it
+    reserve_url = f"{GATEWAY_URL}/stock/reserve/{log_id}"
+    authorize_url = f"{GATEWAY_URL}/payment/authorize/{log_id}/{order_entry.user_id}/{order_entry.total_cost}"
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        authorize_future = executor.submit(place_hold, authorize_url)
+        stock_reply_status, stock_reply_text = place_hold(reserve_url, json.encode(list(items_quantities.items())))
+        payment_reply_status, _ = authorize_future.result()
+
+    # Create a log entry per received response (success or failure)
+    for reply_url, reply_status in ((reserve_url, stock_reply_status), (authorize_url, payment_reply_status)):
+        received_payload = LogOrderValue(
             id=log_id,
             type=LogType.RECEIVED,
-            from_url=request_url,
+            from_url=reply_url,
             to_url=request.url,
-            status=LogStatus.SUCCESS if stock_reply_status == 200 else LogStatus.FAILURE,
+            status=LogStatus.SUCCESS if reply_status == 200 else LogStatus.FAILURE,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
         )
-        db.set(get_key(), msgpack.encode(received_payload_from_stock))
-
-        # If the stock request failed, rollback the stock, create a log, and return an error
+        db.set(get_key(order_id), msgpack.encode(received_payload))
+
+    # If one of the holds failed, give the other one back, create a log, and return an error
+    if stock_reply_status != 200 or payment_reply_status != 200:
+        if stock_reply_status == 200:
+            settle_hold("stock", "release", log_id, order_id)
+        if payment_reply_status == 200:
+            settle_hold("payment", "void", log_id, order_id)
+        
+        error_payload = LogOrderValue(
+            id=log_id,
+            type=LogType.SENT,
+            from_url=request.url,
+            to_url=request.referrer,
+            status=LogStatus.FAILURE,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+        )
+        db.set(get_key(order_id), msgpack.encode(error_payload))
+        
         if stock_reply_status != 200:
-            rollback_stock(removed_items, log_id)
-            
-            error_payload = LogOrderValue(
-                id=log_id,
-                type=LogType.SENT,
-                from_url=request.url,
-                to_url=request.referrer,
-                status=LogStatus.FAILURE,
-                dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
-            )
-            db.set(get_key(), msgpack.encode(error_payload))
-            
-            return abort(400, f'Out of stock on item_id: {item_id}')
+            return abort(400, f'Out of stock: {stock_reply_text}')
+        return abort(400, "User out of credit")
+
+    # Keep the held stock, when the reservation expired in the meantime its stock is back and the credit is given back.
+    # Without an answer the stock may be confirmed, the checkout is left unfinished and the recovery finds out
+    stock_confirmed = settle_hold("stock", "confirm", log_id, order_id)
+    if stock_confirmed is None:
+        return abort(400, "Stock reservation not settled, the checkout is rolled back by the recovery")
+    if not stock_confirmed:
+        settle_hold("payment", "void", log_id, order_id)
         
-        removed_items.append((item_id, quantity))
-
-    # Url for the request to the payment service
-    payment_request_url = f"{GATEWAY_URL}/payment/pay/{order_entry.user_id}/{order_entry.total_cost}"
-
-    # Send request to the payment service to pay for the order
-    payment_reply = send_post_request(payment_request_url)
-    payment_reply_status = payment_reply.status_code
-
-    # Create a log entry for the received response (success or failure)
-    received_payload_from_payment = LogOrderValue(
-        id=log_id,
-        type=LogType.RECEIVED,
-        from_url=payment_request_url,
-        to_url=request.url,
-        status=LogStatus.SUCCESS if payment_reply_status == 200 else LogStatus.FAILURE,
-        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
-    )
-    db.set(get_key(), msgpack.encode(received_payload_from_payment))
-
-    # If the payment request failed, rollback the stock, create a log, and return an error
-    if payment_reply_status != 200:
-        rollback_stock(removed_items, log_id)
+        error_payload = LogOrderValue(
+            id=log_id,
+            type=LogType.SENT,
+            from_url=request.url,
+            to_url=request.referrer,
+            status=LogStatus.FAILURE,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+        )
+        db.set(get_key(order_id), msgpack.encode(error_payload))
+        
+        return abort(400, "Stock reservation expired")
+
+    # Take the held credit last, when the authorization expired in the meantime the credit is back and the confirmed
+    # stock is added again, a rollback that fails is retried by the compensation queue after the recovery finds its log.
+    # Without an answer the credit may be taken, the checkout is left unfinished and the recovery finds out
+    payment_captured = settle_hold("payment", "capture", log_id, order_id)
+    if payment_captured is None:
+        return abort(400, "Payment authorization not settled, the checkout is rolled back by the recovery")
+    if not payment_captured:
+        rollback_stock(list(items_quantities.items()), log_id, order_id)
         
         error_payload = LogOrderValue(
             id=log_id,
@@ -595,11 +1677,12 @@ def checkout(order_id: str):
             status=LogStatus.FAILURE,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
         )
-        db.set(get_key(), msgpack.encode(error_payload))
+        db.set(get_key(order_id), msgpack.encode(error_payload))
         
-        abort(400, "User out of credit")
+        return abort(400, "Payment authorization expired")
 
     # Locally update the order
+    delta = OrderDelta(old_paid=order_entry.paid)
     order_entry.paid = True
     
     # Create a log entry for the update request
@@ -607,12 +1690,13 @@ def checkout(order_id: str):
         id=log_id,
         type=LogType.UPDATE,
         order_id=order_id,
-        old_ordervalue=old_order_entry,
+        delta=delta,
         dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
     )
     
     # Set the log entry and the updated order value in the pipeline
-    log_key = get_key()
+    log_key = get_key(order_id)
+    pipeline_db = db.pipeline()
     pipeline_db.set(log_key, msgpack.encode(update_payload))
     pipeline_db.set(order_id, msgpack.encode(order_entry))
 
@@ -627,12 +1711,14 @@ def checkout(order_id: str):
             status=LogStatus.FAILURE,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
         )
-        db.set(get_key(), msgpack.encode(error_payload))
+        db.set(get_key(order_id), msgpack.encode(error_payload))
         
         pipeline_db.discard()
         
         return abort(400, DB_ERROR_STR)
 
+    publish_invalidation(order_id)
+
     # Create a log for the sent response
     sent_payload_to_user = LogOrderValue(
         id=log_id,
@@ -643,19 +1729,164 @@ def checkout(order_id: str):
         status=LogStatus.SUCCESS,
         dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
     )
-    db.set(get_key(), msgpack.encode(sent_payload_to_user))
+    db.set(get_key(order_id), msgpack.encode(sent_payload_to_user))
 
     app.logger.debug("Checkout successful") # Keep this for benchmarking purposes
     return Response(f"Checkout successful, log: {log_key}", status=200)
 
-# Function to get an idempotent key from the ID service
-def get_key():
+def send_batch_request(url: str, body: list) -> dict[str, dict] | None:
+    # Posts a JSON batch to a *_many endpoint and returns its per-key results, None when the whole request failed
+    try:
+        reply = requests.post(url, data=json.encode(body))
+    except requests.exceptions.RequestException:
+        return None
+    if reply.status_code != 200:
+        return None
+    return {result["key"]: result for result in json.decode(reply.content)}
+
+
+@app.post('/checkout_many')
+def checkout_many():
+    # The body is a JSON list of order ids, every order is checked out completely or not at all and keeps its own logs
+    try:
+        order_ids: list[str] = json.decode(request.get_data(), type=list[str])
+    except MsgspecError:
+        return abort(400, "Expected a JSON list of order ids")
+    if len(order_ids) > CHECKOUT_MANY_MAX:
+        return abort(400, f"At most {CHECKOUT_MANY_MAX} orders per request")
+    order_ids = list(dict.fromkeys(order_ids))
+    
+    try:
+        raw_entries: list[bytes | None] = db.mget(order_ids) if order_ids else []
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    orders: dict[str, OrderValue] = {
+        order_id: msgpack.decode(raw_entry, type=OrderValue) for order_id, raw_entry in zip(order_ids, raw_entries) if raw_entry
+    }
+    outcomes: dict[str, dict] = {
+        order_id: {"order_id": order_id, "success": False, "error": f"Order: {order_id} not found!"}
+        for order_id in order_ids if order_id not in orders
+    }
+    log_ids: dict[str, str] = {order_id: str(uuid.uuid4()) for order_id in orders}
+    to_url, referrer = request.url, request.referrer
+    
+    # get the quantity per item of every order
+    items_quantities: dict[str, list[tuple[str, int]]] = {}
+    for order_id, order_entry in orders.items():
+        quantities: dict[str, int] = defaultdict(int)
+        for item_id, quantity in order_entry.items:
+            quantities[item_id] += quantity
+        items_quantities[order_id] = list(quantities.items())
+    
+    def fail_order(order_id: str, error: str):
+        error_payload = LogOrderValue(
+            id=log_ids[order_id],
+            type=LogType.SENT,
+            from_url=to_url,
+            to_url=referrer,
+            status=LogStatus.FAILURE,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+        )
+        db.set(get_key(order_id), msgpack.encode(error_payload))
+        outcomes[order_id] = {"order_id": order_id, "success": False, "error": error}
+    
+    def received(order_id: str, from_url: str, result: dict | None):
+        # Create a log entry for the received response (success or failure)
+        received_payload = LogOrderValue(
+            id=log_ids[order_id],
+            type=LogType.RECEIVED,
+            from_url=from_url,
+            to_url=to_url,
+            status=LogStatus.SUCCESS if result is not None and result["success"] else LogStatus.FAILURE,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+        )
+        db.set(get_key(order_id), msgpack.encode(received_payload))
+    
+    def settle_stock(order_id: str) -> bool:
+        result = stock_results.get(order_id) if stock_results is not None else None
+        received(order_id, stock_url, result)
+        if result is None or not result["success"]:
+            fail_order(order_id, result["error"] if result is not None else REQ_ERROR_STR)
+            return False
+        return True
+    
+    def settle_payment(order_id: str):
+        result = payment_results.get(order_id) if payment_results is not None else None
+        received(order_id, payment_url, result)
+        
+        # If the payment failed, rollback the stock of this order only, the failed rollbacks are compensated by the recovery
+        if result is None or not result["success"]:
+            try:
+                rollback_stock(items_quantities[order_id], log_ids[order_id], order_id, to_url)
+            except HTTPException:
+                pass
+            fail_order(order_id, result["error"] if result is not None else REQ_ERROR_STR)
+            return
+        
+        # Locally update the order
+        order_entry = orders[order_id]
+        delta = OrderDelta(old_paid=order_entry.paid)
+        order_entry.paid = True
+        
+        # Create a log entry for the update request
+        update_payload = LogOrderValue(
+            id=log_ids[order_id],
+            type=LogType.UPDATE,
+            order_id=order_id,
+            delta=delta,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+        )
+        
+        # Set the log entry and the updated order value in the pipeline
+        log_key = get_key(order_id)
+        pipeline_db = db.pipeline()
+        pipeline_db.set(log_key, msgpack.encode(update_payload))
+        pipeline_db.set(order_id, msgpack.encode(order_entry))
+        try:
+            pipeline_db.execute()
+        except redis.exceptions.RedisError:
+            pipeline_db.discard()
+            fail_order(order_id, DB_ERROR_STR)
+            return
+        
+        publish_invalidation(order_id)
+        
+        # Create a log for the sent response
+        sent_payload_to_user = LogOrderValue(
+            id=log_ids[order_id],
+            type=LogType.SENT,
+            from_url=to_url,
+            to_url=referrer,
+            order_id=order_id,
+            status=LogStatus.SUCCESS,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"),
+        )
+        db.set(get_key(order_id), msgpack.encode(sent_payload_to_user))
+        outcomes[order_id] = {"order_id": order_id, "success": True, "log_key": log_key}
+    
+    # One stock request for all orders, the stock service groups the subtractions per item
+    stock_url = f"{GATEWAY_URL}/stock/subtract_many"
+    stock_results = send_batch_request(stock_url, [[order_id, items_quantities[order_id]] for order_id in orders])
+    
+    with ThreadPoolExecutor(max_workers=CHECKOUT_MANY_WORKERS) as executor:
+        reserved = [order_id for order_id, success in zip(orders, executor.map(settle_stock, orders)) if success]
+        
+        # One payment request for the orders that got their stock, the payment service groups the payments per user
+        payment_url = f"{GATEWAY_URL}/payment/pay_many"
+        payment_results = send_batch_request(payment_url, [[order_id, orders[order_id].user_id, orders[order_id].total_cost] for order_id in reserved])
+        list(executor.map(settle_payment, reserved))
+    
+    app.logger.debug(f"Checked out {sum(outcome['success'] for outcome in outcomes.values())} of {len(order_ids)} orders") # Keep this for benchmarking purposes
+    return jsonify([outcomes[order_id] for order_id in order_ids]), 200
+
+# Function to get an idempotent key from the ID service, the hash tag keeps the log on the shard of its entity
+def get_key(hash_tag: str | None = None):
     try:
         response = requests.get(f"{GATEWAY_URL}/ids/create")
     except requests.exceptions.RequestException:
         abort(400, REQ_ERROR_STR)
     else:
-        return response.text
+        return f"{response.text}{{{hash_tag}}}" if hash_tag else response.text
 
 # Can ignore
 @app.post('/batch_init/<n>/<n_items>/<n_users>/<item_price>')
@@ -681,70 +1912,577 @@ def batch_init_users(n: int, n_items: int, n_users: int, item_price: int):
         db.mset(kv_pairs)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
+    publish_invalidation()
     return jsonify({"msg": "Batch init for orders successful"})
 
+# Can ignore, seeds a backlog of unfinished transactions for the recovery benchmark
+@app.post('/recovery/seed/<n>')
+def seed_recovery_backlog(n: int):
+    n = int(n)
+    item_id = request.args.get("item_id")
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    
+    pipeline_seed = db.pipeline(transaction=False)
+    for i in range(n):
+        order_id = f"recovery-seed-{i}"
+        if item_id is not None:
+            # A checkout that failed to give back the stock of the item
+            log_payload = LogOrderValue(
+                id=str(uuid.uuid4()),
+                type=LogType.RECEIVED,
+                from_url=f"{GATEWAY_URL}/stock/add/{item_id}/1",
+                to_url=f"{GATEWAY_URL}/orders/checkout/{order_id}",
+                status=LogStatus.FAILURE,
+                dateTime=timestamp,
+            )
+        else:
+            log_payload = LogOrderValue(
+                id=str(uuid.uuid4()),
+                type=LogType.UPDATE,
+                order_id=order_id,
+                old_ordervalue=OrderValue(paid=False, items=[], user_id="recovery-seed", total_cost=0),
+                dateTime=timestamp,
+            )
+            pipeline_seed.set(order_id, msgpack.encode(OrderValue(paid=True, items=[], user_id="recovery-seed", total_cost=0)))
+        pipeline_seed.set(f"log:{timestamp}seed{i}{{recovery-seed-{i}}}", msgpack.encode(log_payload))
+        if len(pipeline_seed) >= RECOVERY_BATCH_SIZE:
+            pipeline_seed.execute()
+    try:
+        pipeline_seed.execute()
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    publish_invalidation()
+    return jsonify({"msg": f"Seeded {n} unfinished transactions"})
+
 # Function to call the fault tolerance function for testing purposes
 @app.get('/fault_tolerance/<min_diff>')
 def test_fault_tolerance(min_diff: int):
-    fix_fault_tolerance(int(min_diff))
+    compensation_ids = fix_fault_tolerance(int(min_diff))
+    
+    # Give the queued compensations a first attempt right away, so tests can check the result
+    attempt_compensations(compensation_ids)
     return jsonify({"msg": "Fault Tollerance Successful"}), 200
 
 # Fault tolerance function
-def fix_fault_tolerance(min_diff: int = 5):
+def fix_fault_tolerance(min_diff: int = 5) -> list[str]:
     time: datetime = datetime.now()
     logs = find_all_logs_time(time, int(min_diff))
     sorted_logs = sort_logs(logs)
     
     # Loop through log arrays with the same log_id
+    unfinished: list[list[dict]] = []
     for _, log_list in sorted_logs.items():
-        last_log = log_list[-1]["log"]
-        
         # Check if the last log was finished 'properly'
-        if last_log["status"] in [LogStatus.SUCCESS, LogStatus.FAILURE] and last_log["type"] == LogType.SENT: # If log was finished properly
+        if is_transaction_finished(log_list): # If log was finished properly
             continue
         
-        # Check if the last log was a checkout log
-        if last_log["url"]["from"] is not None and last_log["url"]["to"] is not None:
-            if "checkout" in last_log["url"]["from"] or "checkout" in last_log["url"]["to"]: # If log was a checkout
-                for log_entry in reversed(log_list):
-                    log = log_entry["log"]
-                    log_type = log["type"]
-                    log_status = log["status"]
-                    
-                    # If the log was a checkout log and failed during the rollback, rollback the stock again
-                    if (log_type == LogType.RECEIVED and log_status == LogStatus.FAILURE) and "stock/add" in log["url"]["from"]:
-                        rollback_flag = True
-                        rollback_url = GATEWAY_URL + "/stock/add/" + log["url"]["from"].split("add/")[1]
-                        rollback_counter = 0
-                        while rollback_flag:
-                            try:
-                                rollback_resp = requests.post(rollback_url)
-                                if rollback_resp.status_code == 200:
-                                    rollback_flag = False
-                            except Exception as e:
-                                app.logger.error(f"Rollback attempt failed: {e}")
-                                if rollback_counter > 10:
-                                    return abort(400, "Failed to rollback")
-                                rollback_counter += 1
-                    
-                    db.delete(log_entry["id"])
-                
-                continue
+        unfinished.append(log_list)
+    
+    return recover_transactions(unfinished)
+
+
+# Rollback the changes of an unfinished transaction and delete its logs
+def recover_transaction(log_list: list[dict], pipeline_recovery: redis.client.Pipeline, orders: dict[str, OrderValue | None]):
+    # orders holds the current value of the orders with delta logs, it follows the rollbacks queued in the pipeline
+    for log_entry in reversed(log_list):
+        log = log_entry["log"]
         
-        # If the last log was not finished properly, rollback the changes (if not checkout) and delete the logs
-        for log_entry in reversed(log_list):
-            log = log_entry["log"]
-            
-            log_type = log["type"]
-            log_order_id = log["order_id"]
-            if log_type == LogType.CREATE:
-                db.delete(log_order_id)
-            elif log_type == LogType.UPDATE:
-                log_order_old = log["old_order_value"]
-                db.set(log_order_id, msgpack.encode(OrderValue(paid=log_order_old["paid"], items=log_order_old["items"], user_id=log_order_old["user_id"], total_cost=log_order_old["total_cost"])))
-            
-            db.delete(log_entry["id"])
+        log_type = log["type"]
+        log_order_id = log["order_id"]
+        if log_type == LogType.CREATE:
+            pipeline_recovery.delete(log_order_id)
+            orders[log_order_id] = None
+        elif log_type == LogType.UPDATE and log["delta"] is not None:
+            # The log and the update are written in one transaction, so the update is in the current value
+            order_entry = orders.get(log_order_id)
+            if order_entry is not None:
+                revert_delta(order_entry, log["delta"])
+                pipeline_recovery.set(log_order_id, msgpack.encode(order_entry))
+        elif log_type == LogType.UPDATE:
+            log_order_old = log["old_order_value"]
+            order_entry = OrderValue(paid=log_order_old["paid"], items=log_order_old["items"], user_id=log_order_old["user_id"], total_cost=log_order_old["total_cost"])
+            pipeline_recovery.set(log_order_id, msgpack.encode(order_entry))
+            orders[log_order_id] = order_entry
+        
+        pipeline_recovery.delete(log_entry["id"])
+
+
+def revert_delta(order_entry: OrderValue, delta: dict):
+    # Removes the last occurrence of every added line, lines added by later updates stay in the order
+    for item_id, quantity in reversed(delta["items"]):
+        for index in range(len(order_entry.items) - 1, -1, -1):
+            if tuple(order_entry.items[index]) == (item_id, quantity):
+                del order_entry.items[index]
+                break
+    order_entry.total_cost -= delta["cost"]
+    if delta["old_paid"] is not None:
+        order_entry.paid = delta["old_paid"]
+
+
+def is_checkout_transaction(log_list: list[dict]) -> bool:
+    last_log = log_list[-1]["log"]
+    if last_log["url"]["from"] is None or last_log["url"]["to"] is None:
+        return False
+    return "checkout" in last_log["url"]["from"] or "checkout" in last_log["url"]["to"]
+
+
+def get_checkout_compensations(log_list: list[dict]) -> list[CompensationJob]:
+    # The stock rollbacks and payment refunds that failed during the checkout have to be sent again, the failed log
+    # identifies the job
+    compensations = []
+    for log_entry in reversed(log_list):
+        log = log_entry["log"]
+        if not (log["type"] == LogType.RECEIVED and log["status"] == LogStatus.FAILURE):
+            continue
+        if "stock/add" in log["url"]["from"]:
+            rollback_url = GATEWAY_URL + "/stock/add/" + log["url"]["from"].split("add/")[1]
+            compensations.append(CompensationJob(id=log_entry["id"], url=rollback_url))
+        elif "payment/add_funds" in log["url"]["from"]:
+            refund_url = GATEWAY_URL + "/payment/add_funds/" + log["url"]["from"].split("add_funds/")[1]
+            compensations.append(CompensationJob(id=log_entry["id"], url=refund_url))
+    
+    # The order was updated, only the SENT log of the checkout is missing
+    if any(log_entry["log"]["type"] == LogType.UPDATE for log_entry in log_list):
+        return compensations
+    
+    # Otherwise the checkout stopped between settling its holds, the credit and the confirmed stock are given back
+    settled: dict[str, dict] = {}
+    for log_entry in log_list:
+        log = log_entry["log"]
+        if log["type"] == LogType.RECEIVED and log["status"] == LogStatus.SUCCESS:
+            for step in ("payment/authorize/", "payment/capture/", "payment/void/", "stock/confirm/"):
+                if step in log["url"]["from"]:
+                    settled[step] = log_entry
+    
+    # Settles that never got an answer may have been applied
+    attempted: dict[str, dict] = {}
+    for log_entry in log_list:
+        log = log_entry["log"]
+        if log["type"] == LogType.RECEIVED:
+            for step in ("payment/capture/", "stock/confirm/"):
+                if step in log["url"]["from"]:
+                    attempted[step] = log_entry
+    
+    authorized = settled.get("payment/authorize/")
+    captured = settled.get("payment/capture/") or attempted.get("payment/capture/")
+    if authorized is not None and captured is not None:
+        # The credit was taken, the user and the amount are in the url of the authorization. A capture without an answer
+        # is sent again by the job first, the credit is only refunded when it was captured
+        check_url = None if "payment/capture/" in settled else GATEWAY_URL + "/payment/capture/" + captured["log"]["url"]["from"].split("capture/")[1]
+        _, user_id, amount = authorized["log"]["url"]["from"].split("authorize/")[1].split("/")
+        refund_url = f"{GATEWAY_URL}/payment/add_funds/{user_id}/{amount}"
+        compensations.append(CompensationJob(id=captured["id"], url=refund_url, check_url=check_url))
+    elif authorized is not None and "payment/void/" not in settled:
+        # Voiding a hold that expired in the meantime is not an error
+        void_url = f"{GATEWAY_URL}/payment/void/{authorized['log']['id']}"
+        compensations.append(CompensationJob(id=authorized["id"], url=void_url))
+    
+    confirmed = settled.get("stock/confirm/") or attempted.get("stock/confirm/")
+    if confirmed is not None:
+        # The items of the order are added again, except the ones the checkout already logged a rollback for. A confirm
+        # without an answer is sent again by the jobs first, the stock is only given back when it was confirmed
+        check_url = None if "stock/confirm/" in settled else GATEWAY_URL + "/stock/confirm/" + confirmed["log"]["url"]["from"].split("confirm/")[1]
+        rolled_back = {
+            log_entry["log"]["url"]["from"].split("add/")[1].split("/")[0] for log_entry in log_list
+            if log_entry["log"]["type"] == LogType.RECEIVED and "stock/add/" in log_entry["log"]["url"]["from"]
+        }
+        order_id = confirmed["id"][confirmed["id"].rindex("{") + 1:-1]
+        raw_order: bytes | None = db.get(order_id)
+        items_quantities: dict[str, int] = defaultdict(int)
+        for item_id, quantity in (msgpack.decode(raw_order, type=OrderValue).items if raw_order else []):
+            items_quantities[item_id] += quantity
+        for item_id, quantity in items_quantities.items():
+            if item_id not in rolled_back:
+                rollback_url = f"{GATEWAY_URL}/stock/add/{item_id}/{quantity}"
+                compensations.append(CompensationJob(id=f"{confirmed['id']}:{item_id}", url=rollback_url, check_url=check_url))
+    return compensations
+
+
+def transaction_entity(log_list: list[dict]) -> str:
+    for log_entry in log_list:
+        if log_entry["log"]["order_id"] is not None:
+            return log_entry["log"]["order_id"]
+    return log_list[0]["log"]["id"]
+
+
+def recover_partition(partition: list[list[dict]]):
+    # Newest transactions first, so the oldest before-image of an entity is restored last
+    partition.sort(key=lambda log_list: log_list[0]["log"]["date_time"], reverse=True)
+    
+    # The orders with delta logs are read once, the inverse deltas of all their transactions are applied to that value
+    delta_order_ids = list({
+        log_entry["log"]["order_id"] for log_list in partition for log_entry in log_list
+        if log_entry["log"]["type"] == LogType.UPDATE and log_entry["log"]["delta"] is not None
+    })
+    raw_orders: list[bytes | None] = db.mget(delta_order_ids) if delta_order_ids else []
+    orders: dict[str, OrderValue | None] = {
+        order_id: msgpack.decode(raw_order, type=OrderValue) if raw_order else None for order_id, raw_order in zip(delta_order_ids, raw_orders)
+    }
+    
+    # The rollback of an order and the deletion of its logs share the hash tag of the order, so one MULTI/EXEC per node
+    # applies both or neither and a recovery that is retried after a crash never reverts a delta twice. A batch is only
+    # executed between two transactions
+    pipeline_recovery = db.pipeline()
+    for log_list in partition:
+        recover_transaction(log_list, pipeline_recovery, orders)
+        if len(pipeline_recovery) >= RECOVERY_BATCH_SIZE:
+            pipeline_recovery.execute()
+    pipeline_recovery.execute()
+    
+    publish_invalidation(*{transaction_entity(log_list) for log_list in partition})
+
+
+def recover_transactions(transactions: list[list[dict]]) -> list[str]:
+    transactions = claim_transactions(transactions)
+    
+    # Transactions on the same entity always end up in the same partition, so they are rolled back in order
+    partitions: list[list[list[dict]]] = [[] for _ in range(RECOVERY_WORKERS)]
+    for log_list in transactions:
+        if not is_checkout_transaction(log_list):
+            partitions[hash(transaction_entity(log_list)) % RECOVERY_WORKERS].append(log_list)
+    
+    with ThreadPoolExecutor(max_workers=RECOVERY_WORKERS) as executor:
+        list(executor.map(recover_partition, [partition for partition in partitions if partition]))
+    
+    # Hand the stock rollbacks, refunds and voids of the checkouts over to the compensation queue.
+    # The jobs are queued in the same transaction that deletes the logs, so a compensation is never lost or queued twice.
+    compensation_ids = []
+    pipeline_recovery = db.pipeline()
+    for log_list in transactions:
+        if not is_checkout_transaction(log_list):
+            continue
+        for compensation in get_checkout_compensations(log_list):
+            enqueue_compensation(compensation, pipeline_recovery)
+            compensation_ids.append(compensation.id)
+        pipeline_recovery.delete(*[log_entry["id"] for log_entry in log_list])
+        if len(pipeline_recovery) >= RECOVERY_BATCH_SIZE:
+            pipeline_recovery.execute()
+    pipeline_recovery.execute()
+    
+    return compensation_ids
+
+
+def claim_transactions(transactions: list[list[dict]]) -> list[list[dict]]:
+    # Claim every transaction before rolling it back, so two recoveries never roll back the same transaction twice
+    claims = []
+    for start in range(0, len(transactions), RECOVERY_BATCH_SIZE):
+        pipeline_claim = db.pipeline(transaction=False)
+        for log_list in transactions[start:start + RECOVERY_BATCH_SIZE]:
+            pipeline_claim.set(f"recovery:claim:{log_list[0]['log']['id']}", WORKER_ID, nx=True, ex=RECOVERY_CLAIM_TTL)
+        claims.extend(pipeline_claim.execute())
+    
+    claimed = [log_list for log_list, claim in zip(transactions, claims) if claim]
+    if len(claimed) < len(transactions):
+        db.hincrby(RECOVERY_STATS_KEY, "duplicate_recoveries", len(transactions) - len(claimed))
+    return claimed
+
+
+def is_transaction_finished(log_list: list[dict]) -> bool:
+    last_log = log_list[-1]["log"]
+    return last_log["status"] in [LogStatus.SUCCESS, LogStatus.FAILURE] and last_log["type"] == LogType.SENT
+
+
+def run_incremental_recovery() -> int:
+    started = perf_counter()
+    now = datetime.now()
+    
+    # Only look at logs written since the last checkpoint (or the default window on the first run)
+    checkpoint = db.get(RECOVERY_CHECKPOINT_KEY)
+    checkpoint = checkpoint.decode('utf-8') if checkpoint else (now - timedelta(minutes=5)).strftime("%Y%m%d%H%M%S%f")
+    horizon = (now - timedelta(seconds=RECOVERY_GRACE)).strftime("%Y%m%d%H%M%S%f")
+    
+    logs = []
+    read_db = reader(stale_ok=True)
+    for log_keys in scan_log_keys(read_db=read_db):
+        logs.extend(fetch_logs(log_keys, LogFilters(since=checkpoint), read_db))
+    
+    # Add the logs of the transactions that were still open during the previous run
+    seen_keys = {log["id"] for log in logs}
+    open_keys = []
+    for encoded_keys in db.hvals(RECOVERY_OPEN_KEY):
+        open_keys.extend(key for key in msgpack.decode(encoded_keys, type=list[str]) if key not in seen_keys)
+    logs.extend(fetch_logs(open_keys, LogFilters(), read_db))
+    
+    still_open: dict[str, bytes] = {}
+    abandoned: list[list[dict]] = []
+    for log_id, log_list in sort_logs(logs).items():
+        if is_transaction_finished(log_list):
+            continue
+        
+        # Transactions that logged within the grace period might still be in flight
+        if max(log_key_timestamp(log_entry["id"]) for log_entry in log_list) > horizon:
+            still_open[log_id] = msgpack.encode([log_entry["id"] for log_entry in log_list])
+            continue
+        
+        abandoned.append(log_list)
+    
+    recover_transactions(abandoned)
+    recovered = len(abandoned)
+    
+    duration = perf_counter() - started
+    
+    # The background thread uses its own pipeline so it never interleaves with a request
+    pipeline_db = db.pipeline()
+    pipeline_db.delete(RECOVERY_OPEN_KEY)
+    if still_open:
+        pipeline_db.hset(RECOVERY_OPEN_KEY, mapping=still_open)
+    pipeline_db.set(RECOVERY_CHECKPOINT_KEY, horizon)
+    pipeline_db.hset(RECOVERY_STATS_KEY, mapping={
+        "checkpoint": horizon,
+        "last_run": now.strftime("%Y%m%d%H%M%S%f"),
+        "last_run_seconds": duration,
+        "last_run_logs": len(logs),
+        "last_run_recovered": recovered,
+        "open_transactions": len(still_open),
+        "logs_per_second": len(logs) / duration if duration > 0 else 0,
+    })
+    pipeline_db.hincrby(RECOVERY_STATS_KEY, "runs", 1)
+    pipeline_db.hincrby(RECOVERY_STATS_KEY, "total_logs", len(logs))
+    pipeline_db.hincrby(RECOVERY_STATS_KEY, "total_recovered", recovered)
+    pipeline_db.execute()
+    
+    return len(still_open)
+
+
+# Extends the lease only while this worker still holds it
+renew_recovery_lease = db.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+# Gives up the lease only while this worker still holds it
+release_recovery_lease = db.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def leadership_loop():
+    while not recovery_stop.is_set():
+        try:
+            if recovery_leader.is_set():
+                is_leader = renew_recovery_lease(keys=[RECOVERY_LEADER_KEY], args=[WORKER_ID, RECOVERY_LEASE * 1000])
+            else:
+                is_leader = db.set(RECOVERY_LEADER_KEY, WORKER_ID, nx=True, px=RECOVERY_LEASE * 1000)
+        except redis.exceptions.RedisError as exc:
+            app.logger.error(f"Renewing the recovery lease failed: {exc}")
+            is_leader = False
+        
+        if is_leader:
+            recovery_leader.set()
+        else:
+            recovery_leader.clear()
+        recovery_stop.wait(RECOVERY_LEASE / 3)
+
+
+def recovery_loop():
+    first_run = True
+    while not recovery_stop.is_set():
+        # Only the worker that holds the lease recovers, all workers serve requests right away
+        if not recovery_leader.wait(timeout=1):
+            continue
+        
+        try:
+            open_transactions = run_incremental_recovery()
+        except Exception as exc:
+            app.logger.error(f"Background recovery failed: {exc}")
+            recovery_stop.wait(RECOVERY_LEASE)
+            continue
         
+        if first_run:
+            db.hset(RECOVERY_STATS_KEY, "cold_start_seconds", (datetime.now() - PROCESS_STARTED).total_seconds())
+            first_run = False
+        
+        # Come back sooner when transactions were still in flight during this run
+        recovery_stop.wait(min(RECOVERY_INTERVAL, RECOVERY_GRACE) if open_transactions else RECOVERY_INTERVAL)
+
+
+def stop_recovery():
+    recovery_stop.set()
+    if recovery_leader.is_set():
+        release_recovery_lease(keys=[RECOVERY_LEADER_KEY], args=[WORKER_ID])
+
+
+@app.get('/recovery/status')
+def recovery_status():
+    stats = {key.decode('utf-8'): value.decode('utf-8') for key, value in db.hgetall(RECOVERY_STATS_KEY).items()}
+    leader = db.get(RECOVERY_LEADER_KEY)
+    
+    # The lag is how far the checkpoint is behind the current time
+    checkpoint = stats.pop("checkpoint", None)
+    lag = (datetime.now() - datetime.strptime(checkpoint, "%Y%m%d%H%M%S%f")).total_seconds() if checkpoint else None
+    
+    return jsonify({
+        "checkpoint": checkpoint,
+        "lag_seconds": lag,
+        "interval_seconds": RECOVERY_INTERVAL,
+        "leader": leader.decode('utf-8') if leader else None,
+        "last_run": stats.pop("last_run", None),
+        **{key: float(value) for key, value in stats.items()},
+    }), 200
+
+
+@app.get('/ready')
+def readiness():
+    checkpoint = db.get(RECOVERY_CHECKPOINT_KEY)
+    lag = (datetime.now() - datetime.strptime(checkpoint.decode('utf-8'), "%Y%m%d%H%M%S%f")).total_seconds() if checkpoint else None
+    
+    # Ready once the recovery leader has caught up with the log
+    ready = lag is not None and lag <= RECOVERY_READY_LAG
+    return jsonify({"ready": ready, "lag_seconds": lag}), 200 if ready else 503
+
+
+########################################################################################################################
+#   START OF COMPENSATION FUNCTIONS
+########################################################################################################################
+# Claims a due job by pushing its next attempt back, so only one worker processes it at a time
+claim_compensation = db.register_script("""
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if score and tonumber(score) <= tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+    return 1
+end
+return 0
+""")
+
+
+def enqueue_compensation(compensation: CompensationJob, pipeline_compensation: redis.client.Pipeline):
+    pipeline_compensation.hsetnx(COMPENSATION_JOBS_KEY, compensation.id, msgpack.encode(compensation))
+    pipeline_compensation.zadd(COMPENSATION_QUEUE_KEY, {compensation.id: datetime.now().timestamp()}, nx=True)
+    pipeline_compensation.hincrby(COMPENSATION_STATS_KEY, "enqueued", 1)
+
+
+def compensation_backoff(attempts: int) -> float:
+    # Exponential backoff with jitter, so retries of many jobs do not hit the stock service at once
+    delay = min(COMPENSATION_MAX_DELAY, COMPENSATION_BASE_DELAY * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def process_compensation(job_id: str):
+    encoded_job = db.hget(COMPENSATION_JOBS_KEY, job_id)
+    if encoded_job is None:
+        db.zrem(COMPENSATION_QUEUE_KEY, job_id)
+        return
+    compensation = msgpack.decode(encoded_job, type=CompensationJob)
+    
+    # Send the stock rollback or the payment refund again, a settle that refuses with 400 took nothing to give back
+    try:
+        check_resp = requests.post(compensation.check_url, timeout=COMPENSATION_CLAIM_TIMEOUT / 2) if compensation.check_url else None
+        if check_resp is not None and check_resp.status_code != 200:
+            error = None if check_resp.status_code == 400 else f"{check_resp.status_code}: {check_resp.text[:200]}"
+        else:
+            rollback_resp = requests.post(compensation.url, timeout=COMPENSATION_CLAIM_TIMEOUT / 2)
+            error = None if rollback_resp.status_code == 200 else f"{rollback_resp.status_code}: {rollback_resp.text[:200]}"
+    except requests.exceptions.RequestException as e:
+        error = str(e)
+    
+    pipeline_compensation = db.pipeline()
+    if error is None:
+        pipeline_compensation.zrem(COMPENSATION_QUEUE_KEY, job_id)
+        pipeline_compensation.hdel(COMPENSATION_JOBS_KEY, job_id)
+        pipeline_compensation.hincrby(COMPENSATION_STATS_KEY, "succeeded", 1)
+    else:
+        compensation.attempts += 1
+        compensation.last_error = error
+        app.logger.error(f"Rollback attempt {compensation.attempts} of {job_id} failed: {error}")
+        
+        if compensation.attempts >= COMPENSATION_MAX_ATTEMPTS:
+            # Out of attempts, park the job in the dead letters for an operator
+            pipeline_compensation.zrem(COMPENSATION_QUEUE_KEY, job_id)
+            pipeline_compensation.hdel(COMPENSATION_JOBS_KEY, job_id)
+            pipeline_compensation.hset(COMPENSATION_DEAD_KEY, job_id, msgpack.encode(compensation))
+            pipeline_compensation.hincrby(COMPENSATION_STATS_KEY, "dead_lettered", 1)
+        else:
+            next_attempt = datetime.now().timestamp() + compensation_backoff(compensation.attempts)
+            pipeline_compensation.hset(COMPENSATION_JOBS_KEY, job_id, msgpack.encode(compensation))
+            pipeline_compensation.zadd(COMPENSATION_QUEUE_KEY, {job_id: next_attempt}, xx=True)
+            pipeline_compensation.hincrby(COMPENSATION_STATS_KEY, "retried", 1)
+    pipeline_compensation.execute()
+
+
+def process_compensations(job_ids: list[str]) -> list[str]:
+    now = datetime.now().timestamp()
+    pipeline_claim = db.pipeline(transaction=False)
+    for job_id in job_ids:
+        claim_compensation(keys=[COMPENSATION_QUEUE_KEY], args=[job_id, now, now + COMPENSATION_CLAIM_TIMEOUT], client=pipeline_claim)
+    claimed_job_ids = [job_id for job_id, claimed in zip(job_ids, pipeline_claim.execute()) if claimed]
+    
+    # Send the claimed compensations concurrently
+    if claimed_job_ids:
+        with ThreadPoolExecutor(max_workers=RECOVERY_WORKERS) as executor:
+            list(executor.map(process_compensation, claimed_job_ids))
+    return claimed_job_ids
+
+
+def drain_compensations() -> int:
+    now = datetime.now().timestamp()
+    due_job_ids = [job_id.decode('utf-8') for job_id in db.zrangebyscore(COMPENSATION_QUEUE_KEY, "-inf", now, start=0, num=COMPENSATION_BATCH_SIZE)]
+    return len(process_compensations(due_job_ids))
+
+
+def attempt_compensations(job_ids: list[str]):
+    claimed_job_ids = process_compensations(job_ids)
+    
+    # Wait for the jobs that another worker claimed first to get their first attempt
+    pending_job_ids = set(job_ids) - set(claimed_job_ids)
+    deadline = perf_counter() + COMPENSATION_CLAIM_TIMEOUT
+    while pending_job_ids and perf_counter() < deadline:
+        sleep(0.05)
+        pending_job_ids = {
+            job_id for job_id, encoded_job in zip(pending_job_ids, db.hmget(COMPENSATION_JOBS_KEY, list(pending_job_ids)))
+            if encoded_job is not None and msgpack.decode(encoded_job, type=CompensationJob).attempts == 0
+        }
+
+
+def compensation_loop():
+    while not recovery_stop.wait(COMPENSATION_POLL_INTERVAL):
+        try:
+            # Keep draining while there is a backlog of due jobs
+            while drain_compensations() == COMPENSATION_BATCH_SIZE:
+                pass
+        except Exception as exc:
+            app.logger.error(f"Draining the compensation queue failed: {exc}")
+
+
+@app.get('/compensations/status')
+def compensation_status():
+    now = datetime.now().timestamp()
+    stats = {key.decode('utf-8'): int(value) for key, value in db.hgetall(COMPENSATION_STATS_KEY).items()}
+    
+    oldest_due = db.zrangebyscore(COMPENSATION_QUEUE_KEY, "-inf", now, start=0, num=1, withscores=True)
+    
+    return jsonify({
+        "queued": db.zcard(COMPENSATION_QUEUE_KEY),
+        "due": db.zcount(COMPENSATION_QUEUE_KEY, "-inf", now),
+        "dead_letters": db.hlen(COMPENSATION_DEAD_KEY),
+        "oldest_due_seconds": now - oldest_due[0][1] if oldest_due else 0,
+        **stats,
+    }), 200
+
+
+@app.get('/compensations/dead')
+def find_dead_compensations():
+    dead_letters = [msgpack.decode(encoded_job, type=CompensationJob) for encoded_job in db.hvals(COMPENSATION_DEAD_KEY)]
+    return jsonify({"dead_letters": [{"id": job.id, "url": job.url, "attempts": job.attempts, "last_error": job.last_error} for job in dead_letters]}), 200
+
+
+@app.post('/compensations/dead/retry')
+def retry_dead_compensations():
+    dead_letters = [msgpack.decode(encoded_job, type=CompensationJob) for encoded_job in db.hvals(COMPENSATION_DEAD_KEY)]
+    
+    # Put the dead letters back in the queue with a fresh set of attempts
+    pipeline_compensation = db.pipeline()
+    for compensation in dead_letters:
+        pipeline_compensation.hdel(COMPENSATION_DEAD_KEY, compensation.id)
+        enqueue_compensation(CompensationJob(id=compensation.id, url=compensation.url), pipeline_compensation)
+    pipeline_compensation.execute()
+    
+    return jsonify({"msg": f"Requeued {len(dead_letters)} compensations"}), 200
+
 
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=8000, debug=True)
@@ -754,4 +2492,21 @@ else:
     app.logger.setLevel(gunicorn_logger.level)
     
     # app.logger.setLevel(logging.DEBUG)
-    fix_fault_tolerance()
+    
+    # Recover in the background every RECOVERY_INTERVAL seconds, only in the worker that holds the recovery lease
+    recovery_stop = threading.Event()
+    recovery_leader = threading.Event()
+    atexit.register(stop_recovery)
+    threading.Thread(target=leadership_loop, name="recovery-leadership", daemon=True).start()
+    threading.Thread(target=recovery_loop, name="recovery", daemon=True).start()
+    threading.Thread(target=replica_monitor_loop, name="replica-monitor", daemon=True).start()
+    if entity_cache is not None:
+        threading.Thread(target=cache_invalidation_loop, name="cache-invalidation", daemon=True).start()
+    if price_catalog is not None or user_filter is not None:
+        threading.Thread(target=catalog_loop, name="catalog", daemon=True).start()
+    
+    # Retry failed stock rollbacks in the background
+    threading.Thread(target=compensation_loop, name="compensation", daemon=True).start()
+    if saga_bus is not None:
+        threading.Thread(target=saga_bus.consume, args=(OUTCOME_STREAM, handle_saga_outcome, recovery_stop, (HTTPException,)), name="saga-consumer", daemon=True).start()
+        threading.Thread(target=saga_sweep_loop, name="saga-sweeper", daemon=True).start()
@@ -0,0 +1,413 @@
+import os
+import asyncio
+import uuid
+import httpx
+import redis
+import redis.asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from msgspec import msgpack, json
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Mount, Route
+
+# The Flask app still serves the log, recovery and benchmark endpoints and runs the background recovery and compensations
+from app import (
+    app as flask_app, OrderValue, OrderDelta, LogOrderValue, LogType, LogStatus,
+    DB_ERROR_STR, REQ_ERROR_STR, GATEWAY_URL, REDIS_NODES, REDIS_REPLICA_NODES, REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT,
+    CACHE_CHANNEL, use_replica, entity_cache, item_price, user_known, known_missing, remember_missing,
+    SingleFlight, stock_flight,
+    entity_etag, etag_matches, validator_headers, PAID_ORDER_MAX_AGE, SAGA_BUS, SETTLE_ATTEMPTS, SETTLE_RETRY_DELAY,
+)
+from sharding import AsyncShardedRedis, async_redis_client
+
+
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 512))     # Per worker, shared by all in-flight requests
+
+db: redis.asyncio.Redis | AsyncShardedRedis = async_redis_client(
+    REDIS_NODES,
+    password=os.environ['REDIS_PASSWORD'],
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
+)
+replica_db: redis.asyncio.Redis | AsyncShardedRedis | None = async_redis_client(
+    REDIS_REPLICA_NODES,
+    password=os.environ['REDIS_PASSWORD'],
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
+) if REDIS_REPLICA_NODES else None
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines, counted together with the SingleFlight of the Flask app."""
+
+    def __init__(self, counts: SingleFlight):
+        self.counts = counts
+        self.calls: dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fetch):
+        future = self.calls.get(key)
+        self.counts.count(future is not None)
+        if future is not None:
+            return await asyncio.shield(future)
+        
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fetch()
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()  # Marks the error as retrieved when no other call waited for it
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.calls[key]
+
+
+stock_lookups = AsyncSingleFlight(stock_flight)
+
+
+def abort(status_code: int, detail: str):
+    raise HTTPException(status_code=status_code, detail=str(detail))
+
+
+def now() -> str:
+    return datetime.now().strftime("%Y%m%d%H%M%S%f")
+
+
+def reader(stale_ok: bool = False) -> redis.asyncio.Redis | AsyncShardedRedis:
+    # Same routing and read counts as the Flask app
+    return replica_db if use_replica(stale_ok) else db
+
+
+async def publish_invalidation(*keys: str):
+    # Same message as the Flask app, every worker drops its cached copy of the entity
+    if entity_cache is not None:
+        await db.publish(CACHE_CHANNEL, msgpack.encode((datetime.now().timestamp(), list(keys))))
+
+
+@asynccontextmanager
+async def lifespan(_app: Starlette):
+    global http_client
+    http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS))
+    yield
+    await http_client.aclose()
+    await db.aclose()
+    if replica_db is not None:
+        await replica_db.aclose()
+
+
+async def send_post_request(url: str, data: bytes | None = None) -> httpx.Response:
+    try:
+        return await http_client.post(url, content=data)
+    except httpx.HTTPError as exc:
+        abort(400, exc)
+
+
+async def send_get_request(url: str) -> httpx.Response:
+    try:
+        return await http_client.get(url)
+    except httpx.HTTPError:
+        abort(400, REQ_ERROR_STR)
+
+
+# Function to get an idempotent key from the ID service, the hash tag keeps the log on the shard of its entity
+async def get_key(hash_tag: str | None = None) -> str:
+    response = await send_get_request(f"{GATEWAY_URL}/ids/create")
+    return f"{response.text}{{{hash_tag}}}" if hash_tag else response.text
+
+
+async def write_log(log_entry: LogOrderValue, order_id: str | None = None) -> str:
+    log_key = await get_key(order_id)
+    await db.set(log_key, msgpack.encode(log_entry))
+    return log_key
+
+
+def sent_log(request: Request, log_id: str, status: LogStatus, order_id: str | None = None) -> LogOrderValue:
+    # Log for the response sent back to the caller
+    return LogOrderValue(
+        id=log_id,
+        type=LogType.SENT,
+        from_url=str(request.url),
+        to_url=request.headers.get("referer"),
+        order_id=order_id,
+        status=status,
+        dateTime=now(),
+    )
+
+
+def received_log(request: Request, log_id: str, url: str, status_code: int | None) -> LogOrderValue:
+    # Log for a response received from another service
+    return LogOrderValue(
+        id=log_id,
+        type=LogType.RECEIVED,
+        from_url=url,
+        to_url=str(request.url),
+        status=LogStatus.SUCCESS if status_code == 200 else LogStatus.FAILURE,
+        dateTime=now(),
+    )
+
+
+async def get_order_from_db(request: Request, order_id: str, log_id: str | None = None, stale_ok: bool = False) -> OrderValue:
+    return (await get_tagged_order(request, order_id, log_id, stale_ok))[0]
+
+
+async def get_tagged_order(request: Request, order_id: str, log_id: str | None = None, stale_ok: bool = False) -> tuple[OrderValue, str]:
+    # Only reads that tolerate staleness are served from the cache of the Flask app in this worker
+    use_cache = stale_ok and entity_cache is not None
+    if use_cache:
+        cached: tuple[OrderValue, str] | None = entity_cache.get_tagged(order_id)
+        if cached is not None:
+            return cached
+        generation = entity_cache.generation
+
+    try:
+        raw_entry: bytes = await reader(stale_ok and not use_cache).get(order_id)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+
+    if not raw_entry:
+        log_key = await write_log(sent_log(request, log_id if log_id else str(uuid.uuid4()), LogStatus.FAILURE, order_id), order_id)
+        abort(400, f"Order: {order_id} not found! Log key: {log_key}")
+    entry: OrderValue = msgpack.decode(raw_entry, type=OrderValue)
+    etag = entity_etag(raw_entry)
+    if use_cache:
+        entity_cache.put(order_id, entry, len(raw_entry), generation, etag)
+    return entry, etag
+
+
+async def write_update(request: Request, log_id: str, order_id: str, update_payload: LogOrderValue, order_entry: OrderValue) -> str:
+    # Set the log entry and the order value in one transaction
+    log_key = await get_key(order_id)
+    pipeline_db = db.pipeline()
+    pipeline_db.set(log_key, msgpack.encode(update_payload))
+    pipeline_db.set(order_id, msgpack.encode(order_entry))
+    try:
+        await pipeline_db.execute()
+    except redis.exceptions.RedisError:
+        await write_log(sent_log(request, log_id, LogStatus.FAILURE), order_id)
+        return abort(400, DB_ERROR_STR)
+
+    await publish_invalidation(order_id)
+    return log_key
+
+########################################################################################################################
+#   START OF MICROSERVICE FUNCTIONS
+########################################################################################################################
+async def create_order(request: Request):
+    user_id = request.path_params["user_id"]
+    log_id = str(uuid.uuid4())
+
+    # Users in the user filter exist and recently missing users are rejected, only the others are checked remotely
+    user_exists = user_known(user_id)
+    if user_exists is None and not known_missing("user", user_id):
+        payment_reply = await send_get_request(f"{GATEWAY_URL}/payment/find_user/{user_id}")
+        user_exists = payment_reply.status_code == 200
+        if not user_exists:
+            remember_missing("user", user_id, payment_reply)
+    if not user_exists:
+        return abort(400, f"User: {user_id} does not exist!")
+
+    order_id = str(uuid.uuid4())
+    order_value = OrderValue(paid=False, items=[], user_id=user_id, total_cost=0)
+
+    # Create a log entry for the create request
+    create_payload = LogOrderValue(
+        id=log_id,
+        type=LogType.CREATE,
+        order_id=order_id,
+        dateTime=now(),
+    )
+    await write_update(request, log_id, order_id, create_payload, order_value)
+    await write_log(sent_log(request, log_id, LogStatus.SUCCESS), order_id)
+
+    return JSONResponse({'order_id': order_id, 'log_id': log_id})
+
+
+async def find_order(request: Request):
+    order_id = request.path_params["order_id"]
+    order_entry, etag = await get_tagged_order(request, order_id, stale_ok=True)
+
+    # A paid order no longer changes, so it can be cached for PAID_ORDER_MAX_AGE seconds
+    headers = validator_headers(etag, max_age=PAID_ORDER_MAX_AGE if order_entry.paid else 0)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse({
+        "order_id": order_id,
+        "paid": order_entry.paid,
+        "items": order_entry.items,
+        "user_id": order_entry.user_id,
+        "total_cost": order_entry.total_cost,
+    }, headers=headers)
+
+
+async def add_item(request: Request):
+    order_id, item_id, quantity = (request.path_params[key] for key in ("order_id", "item_id", "quantity"))
+    log_id = str(uuid.uuid4())
+
+    # Items in the shared price table exist, the others are checked with the stock service
+    price = item_price(item_id)
+    if price is None:
+        # Concurrent lookups of the same item share one request
+        request_url = f"{GATEWAY_URL}/stock/find/{item_id}"
+        stock_reply = None if known_missing("item", item_id) else await stock_lookups.do(request_url, lambda: send_get_request(request_url))
+        if stock_reply is None or stock_reply.status_code != 200:
+            if stock_reply is not None:
+                remember_missing("item", item_id, stock_reply)
+            await write_log(sent_log(request, log_id, LogStatus.FAILURE), order_id)
+            return abort(400, f"Item: {item_id} does not exist!")
+        price = stock_reply.json()["price"]
+
+    # Get the order from the database
+    order_entry: OrderValue = await get_order_from_db(request, order_id)
+
+    order_entry.items.append((item_id, int(quantity)))
+    order_entry.total_cost += int(quantity) * price
+
+    # Create a log entry for the update request, with the added line instead of the whole order
+    update_payload = LogOrderValue(
+        id=log_id,
+        type=LogType.UPDATE,
+        order_id=order_id,
+        delta=OrderDelta(items=[(item_id, int(quantity))], cost=int(quantity) * price),
+        dateTime=now(),
+    )
+    await write_update(request, log_id, order_id, update_payload, order_entry)
+    await write_log(sent_log(request, log_id, LogStatus.SUCCESS, order_id), order_id)
+
+    return PlainTextResponse(f"Item: {item_id} added to: {order_id} total price updated to: {order_entry.total_cost}, log_id: {log_id}")
+
+
+async def rollback_stock(request: Request, removed_items: list[tuple[str, int]], log_id: str, order_id: str):
+    # Same as the Flask app, a rollback that fails is retried by the compensation queue after the recovery finds its log
+    error_flag = False
+    for item_id, quantity in removed_items:
+        url = f"{GATEWAY_URL}/stock/add/{item_id}/{quantity}"
+        rollback_resp = await send_post_request(url)
+        await write_log(received_log(request, log_id, url, rollback_resp.status_code), order_id)
+        if rollback_resp.status_code != 200:
+            error_flag = True
+
+    if error_flag:
+        return abort(400, "Failed to rollback")
+
+
+async def place_hold(url: str, data: bytes | None = None) -> tuple[int, str]:
+    # Same as the Flask app, a request that fails counts as refused
+    try:
+        reply = await http_client.post(url, content=data)
+    except httpx.HTTPError as exc:
+        return 400, str(exc)
+    return reply.status_code, reply.text
+
+
+async def settle_hold(request: Request, service: str, action: str, hold_id: str, order_id: str) -> bool | None:
+    # Same as the Flask app, a request without an answer is sent again and None means the hold may or may not be settled
+    url = f"{GATEWAY_URL}/{service}/{action}/{hold_id}"
+    reply_status = None
+    for attempt in range(SETTLE_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(SETTLE_RETRY_DELAY * 2 ** (attempt - 1))
+        try:
+            reply_status = (await http_client.post(url)).status_code
+        except httpx.HTTPError:
+            reply_status = None
+        if reply_status is not None and reply_status < 500:
+            break
+    await write_log(received_log(request, hold_id, url, reply_status), order_id)
+    if reply_status is None or reply_status >= 500:
+        return None
+    return reply_status == 200
+
+
+async def checkout(request: Request):
+    order_id = request.path_params["order_id"]
+    log_id = str(uuid.uuid4())
+
+    # Get the order from the database
+    order_entry: OrderValue = await get_order_from_db(request, order_id)
+
+    items_quantities: dict[str, int] = defaultdict(int)
+    for item_id, quantity in order_entry.items:
+        items_quantities[item_id] += quantity
+
+    # Hold the stock of all items and the credit of the user at the same time, both services give their hold back when
+    # the checkout never settles it
+    reserve_url = f"{GATEWAY_URL}/stock/reserve/{log_id}"
+    authorize_url = f"{GATEWAY_URL}/payment/authorize/{log_id}/{order_entry.user_id}/{order_entry.total_cost}"
+    (stock_reply_status, stock_reply_text), (payment_reply_status, _) = await asyncio.gather(
+        place_hold(reserve_url, json.encode(list(items_quantities.items()))),
+        place_hold(authorize_url),
+    )
+    await write_log(received_log(request, log_id, reserve_url, stock_reply_status), order_id)
+    await write_log(received_log(request, log_id, authorize_url, payment_reply_status), order_id)
+
+    # If one of the holds failed, give the other one back, create a log, and return an error
+    if stock_reply_status != 200 or payment_reply_status != 200:
+        if stock_reply_status == 200:
+            await settle_hold(request, "stock", "release", log_id, order_id)
+        if payment_reply_status == 200:
+            await settle_hold(request, "payment", "void", log_id, order_id)
+        await write_log(sent_log(request, log_id, LogStatus.FAILURE), order_id)
+        if stock_reply_status != 200:
+            return abort(400, f'Out of stock: {stock_reply_text}')
+        return abort(400, "User out of credit")
+
+    # Keep the held stock, when the reservation expired in the meantime its stock is back and the credit is given back.
+    # Without an answer the checkout is left unfinished for the recovery
+    stock_confirmed = await settle_hold(request, "stock", "confirm", log_id, order_id)
+    if stock_confirmed is None:
+        return abort(400, "Stock reservation not settled, the checkout is rolled back by the recovery")
+    if not stock_confirmed:
+        await settle_hold(request, "payment", "void", log_id, order_id)
+        await write_log(sent_log(request, log_id, LogStatus.FAILURE), order_id)
+        return abort(400, "Stock reservation expired")
+
+    # Take the held credit last, when the authorization expired in the meantime the credit is back and the confirmed
+    # stock is added again. Without an answer the checkout is left unfinished for the recovery
+    payment_captured = await settle_hold(request, "payment", "capture", log_id, order_id)
+    if payment_captured is None:
+        return abort(400, "Payment authorization not settled, the checkout is rolled back by the recovery")
+    if not payment_captured:
+        await rollback_stock(request, list(items_quantities.items()), log_id, order_id)
+        await write_log(sent_log(request, log_id, LogStatus.FAILURE), order_id)
+        return abort(400, "Payment authorization expired")
+
+    delta = OrderDelta(old_paid=order_entry.paid)
+    order_entry.paid = True
+
+    # Create a log entry for the update request
+    update_payload = LogOrderValue(
+        id=log_id,
+        type=LogType.UPDATE,
+        order_id=order_id,
+        delta=delta,
+        dateTime=now(),
+    )
+    log_key = await write_update(request, log_id, order_id, update_payload, order_entry)
+    await write_log(sent_log(request, log_id, LogStatus.SUCCESS, order_id), order_id)
+
+    return PlainTextResponse(f"Checkout successful, log: {log_key}")
+
+
+app = Starlette(
+    routes=[
+        Route('/create/{user_id}', create_order, methods=["POST"]),
+        Route('/find/{order_id}', find_order, methods=["GET"]),
+        Route('/addItem/{order_id}/{item_id}/{quantity}', add_item, methods=["POST"]),
+        # With SAGA_BUS the checkout is an event-driven saga, which the Flask app starts
+        *([] if SAGA_BUS else [Route('/checkout/{order_id}', checkout, methods=["POST"])]),
+        # Every other endpoint is served by the Flask app
+        Mount('/', WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,181 @@
+"""Lookup tables shared by the workers of a node through memory mapped files.
+
+Every table is filled by a single writer per node, elected with a file lock, from a feed of another service, and read
+by all workers directly from the mapped file, so they share one copy without serializing anything. The header stores
+the last position of the feed, so a restarted worker finds the table filled and the writer resumes where it stopped.
+
+PriceCatalog is an open addressing hash table with linear probing. A slot holds a 16 byte fingerprint of the item id
+and its price, a price of -1 marks an item that no longer exists. The writer bumps a sequence number before and after
+every batch (a seqlock), readers retry while the sequence is odd or changed during their lookup.
+
+BloomFilter holds the ids of the known users. Bits are only ever set between two resets, so its readers skip the
+seqlock: a racing lookup can only miss a user, which the caller then checks with the payment service.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+
+
+HEADER = struct.Struct("<8sQQQ32s")     # Magic, sequence, size parameter, entries, last feed id
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = 8
+SLOT = struct.Struct("<16sq")           # Item id fingerprint, price
+EMPTY = bytes(16)
+DELETED = -1
+MAX_LOAD = 0.75                          # Items beyond this load are not added, their lookups go to the stock service
+READ_RETRIES = 5
+BLOOM_HASHES = 7                         # About 0.05% false positives at 16 bits per user
+
+
+def fingerprint(key: str) -> bytes:
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+
+class SharedTable:
+    MAGIC = b""
+
+    def __init__(self, path: str, parameter: int, data_size: int):
+        self.path = path
+        self.parameter = parameter
+        self.writer_fd: int | None = None
+        self.writer = False
+
+        size = HEADER.size + data_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Only the first worker of the node formats the file
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, size)
+                self.map = mmap.mmap(fd, size)
+                magic, _, table_parameter, _, _ = HEADER.unpack_from(self.map, 0)
+                if magic != self.MAGIC or table_parameter != parameter:
+                    self.map[:size] = bytes(size)
+                    HEADER.pack_into(self.map, 0, self.MAGIC, 0, parameter, 0, b"")
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def sequence(self) -> int:
+        return SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0]
+
+    def header(self) -> tuple:
+        return HEADER.unpack_from(self.map, 0)
+
+    def last_id(self) -> str:
+        return self.header()[4].rstrip(b"\0").decode('ascii') or "0"
+
+    def used(self) -> int:
+        return self.header()[3]
+
+    def try_become_writer(self) -> bool:
+        # The lock is released by the kernel when the writer process dies, another worker then takes over
+        if self.writer_fd is None:
+            self.writer_fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.writer_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self.writer = True
+        return True
+
+    def update(self, entries: list, last_id: str, reset: bool = False):
+        """Writes a batch of the feed, only the elected writer may call this."""
+        sequence = self.sequence()
+        SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, sequence + 1)
+        try:
+            used = self.used()
+            if reset:
+                self.map[HEADER.size:] = bytes(len(self.map) - HEADER.size)
+                used = 0
+            used = self.write(entries, used)
+            HEADER.pack_into(self.map, 0, self.MAGIC, sequence + 1, self.parameter, used, last_id.encode('ascii'))
+        finally:
+            SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, sequence + 2)
+
+    def write(self, entries: list, used: int) -> int:
+        raise NotImplementedError
+
+    def close(self):
+        self.map.close()
+        if self.writer_fd is not None:
+            os.close(self.writer_fd)
+
+
+class PriceCatalog(SharedTable):
+    MAGIC = b"PRICES01"
+
+    def __init__(self, path: str, slots: int):
+        if slots & (slots - 1):
+            raise ValueError(f"The number of slots must be a power of two, got {slots}")
+        self.slots = slots
+        self.mask = slots - 1
+        super().__init__(path, slots, slots * SLOT.size)
+
+    def slot_offset(self, index: int) -> int:
+        return HEADER.size + index * SLOT.size
+
+    def find(self, key: bytes) -> tuple[int, int | None]:
+        # Returns the slot of the key, or the empty slot where it would go, and its price
+        index = int.from_bytes(key[:8], "little") & self.mask
+        for _ in range(self.slots):
+            slot_key, price = SLOT.unpack_from(self.map, self.slot_offset(index))
+            if slot_key == key:
+                return index, price
+            if slot_key == EMPTY:
+                return index, None
+            index = (index + 1) & self.mask
+        return -1, None
+
+    def price(self, item_id: str) -> int | None:
+        key = fingerprint(item_id)
+        for _ in range(READ_RETRIES):
+            before = self.sequence()
+            if before & 1:
+                continue
+            _, price = self.find(key)
+            if self.sequence() == before:
+                return price if price is not None and price != DELETED else None
+        return None
+
+    def write(self, entries: list[tuple[str, int]], used: int) -> int:
+        for item_id, price in entries:
+            key = fingerprint(item_id)
+            index, current = self.find(key)
+            if index == -1 or (current is None and used >= self.slots * MAX_LOAD):
+                continue
+            # The price goes in before the key, a reader never sees a key without its price
+            SLOT.pack_into(self.map, self.slot_offset(index), key if current is not None else EMPTY, price)
+            if current is None:
+                self.map[self.slot_offset(index):self.slot_offset(index) + len(key)] = key
+                used += 1
+        return used
+
+
+class BloomFilter(SharedTable):
+    MAGIC = b"BLOOM001"
+
+    def __init__(self, path: str, bits: int):
+        if bits % 8:
+            raise ValueError(f"The number of bits must be a multiple of eight, got {bits}")
+        self.bits = bits
+        super().__init__(path, bits, bits // 8)
+
+    def positions(self, key: str) -> list[int]:
+        # Double hashing, the k positions are derived from the two halves of one digest
+        digest = fingerprint(key)
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.bits for i in range(BLOOM_HASHES)]
+
+    def might_contain(self, key: str) -> bool:
+        return all(self.map[HEADER.size + (position >> 3)] & (1 << (position & 7)) for position in self.positions(key))
+
+    def write(self, entries: list[str], used: int) -> int:
+        for key in entries:
+            for position in self.positions(key):
+                self.map[HEADER.size + (position >> 3)] |= 1 << (position & 7)
+        return used + len(entries)
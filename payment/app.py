@@ -1,32 +1,98 @@
 import logging
 import os
+import hashlib
 import atexit
+import socket
+import threading
 import uuid
 import requests
 from enum import Enum
 import redis
-from copy import deepcopy
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from ast import literal_eval
 
-from msgspec import msgpack, Struct
-from flask import Flask, jsonify, abort, Response, request
+from msgspec import msgpack, json, Struct, Raw, MsgspecError
+from flask import Flask, jsonify, abort, Response, request, stream_with_context
 from datetime import datetime, timedelta
 
+from sharding import ShardedRedis, parse_nodes, redis_client, node_clients, client_for
+from time import perf_counter, time
+from werkzeug.exceptions import HTTPException
+
+from saga import SagaBus, bus_client, CHECKOUT_STREAM
+
 
 DB_ERROR_STR = "DB error"
 REQ_ERROR_STR = "Requests error"
+LOG_PAGE_SIZE = 500
+LOG_PAGE_MAX = 10000
+RECOVERY_INTERVAL = int(os.environ.get("RECOVERY_INTERVAL", 300))   # Seconds between two background recovery runs
+RECOVERY_GRACE = int(os.environ.get("RECOVERY_GRACE", 60))          # Seconds before an unfinished transaction counts as abandoned
+RECOVERY_CHECKPOINT_KEY = "{recovery}:checkpoint"
+RECOVERY_OPEN_KEY = "{recovery}:open"
+RECOVERY_STATS_KEY = "{recovery}:stats"
+RECOVERY_LEADER_KEY = "recovery:leader"
+RECOVERY_LEASE = int(os.environ.get("RECOVERY_LEASE", 15))          # Seconds the recovery leader holds its lease without renewing it
+RECOVERY_CLAIM_TTL = 600                                            # Seconds a recovered transaction stays claimed
+RECOVERY_READY_LAG = int(os.environ.get("RECOVERY_READY_LAG", RECOVERY_INTERVAL + RECOVERY_GRACE + 2 * RECOVERY_LEASE))
+RECOVERY_WORKERS = int(os.environ.get("RECOVERY_WORKERS", 8))       # Threads that recover partitions of the backlog in parallel
+RECOVERY_BATCH_SIZE = 1000                                          # Redis commands sent per pipeline round trip
+FIND_MANY_MAX = 100000                                              # Ids accepted by one find_many request
+FIND_MANY_CHUNK = 500                                               # Ids read with one MGET
+PAY_MANY_MAX = 10000                                                # Payments accepted by one pay_many request
+STREAM_MIMETYPES = {"ndjson": "application/x-ndjson", "msgpack": "application/x-msgpack"}
 GATEWAY_URL = os.environ['GATEWAY_URL']
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 64))     # Per worker, covers its request threads and background threads
+REDIS_POOL_TIMEOUT = int(os.environ.get("REDIS_POOL_TIMEOUT", 10))           # Seconds a request waits for a free connection
+# "host:port,host:port" spreads the keys over several Redis nodes, defaults to the single REDIS_HOST
+REDIS_NODES = parse_nodes(os.environ.get("REDIS_NODES") or f"{os.environ['REDIS_HOST']}:{os.environ['REDIS_PORT']}")
+REDIS_REPLICA_NODES = parse_nodes(os.environ.get("REDIS_REPLICA_NODES", ""))   # One replica per node of REDIS_NODES, in the same order
+REDIS_READ_POLICY = os.environ.get("REDIS_READ_POLICY", "master")              # master, replica, or bounded: replica while it lags at most REDIS_MAX_STALENESS
+REDIS_MAX_STALENESS = float(os.environ.get("REDIS_MAX_STALENESS", 1))          # Seconds
+REPLICA_CHECK_INTERVAL = 0.5                                                   # Seconds between two heartbeats
+REPLICA_HEARTBEAT_KEY = "reads:heartbeat"
+READ_STATS_KEY = "reads:stats"
+ENTITY_CACHE_BYTES = int(os.environ.get("ENTITY_CACHE_BYTES", 0))   # Per worker memory for decoded entities, 0 disables the cache
+CACHE_ENTRY_OVERHEAD = 200                                         # Rough bytes of a cached entry besides its encoded value
+CACHE_HISTORY = 10000                                              # Recent invalidations remembered to reject racing fills
+CACHE_CHANNEL = "cache:invalidate"
+CATALOG_STREAM_KEY = "{catalog}:users"                                  # Feed of created users for the user filter of the order service
+CATALOG_STREAM_LENGTH = int(os.environ.get("CATALOG_STREAM_LENGTH", 1000000))   # Approximate entries kept, readers behind the trimmed part start over
+CATALOG_PAGE_MAX = 10000
+HOLD_TTL = float(os.environ.get("HOLD_TTL", 30))                                # Seconds an authorization holds its credit unless it is captured
+HOLD_SWEEP_INTERVAL = float(os.environ.get("HOLD_SWEEP_INTERVAL", 1))
+HOLD_SWEEP_BATCH = 100
+HOLD_CLAIM_TIMEOUT = 30                                             # Seconds a claimed release is hidden from the other sweepers
+HOLD_TOMBSTONE_TTL = 3600                                           # Seconds a release of a hold whose credit was not taken yet is remembered
+HOLD_CAPTURED_TTL = 3600                                            # Seconds a captured hold answers a repeated capture
+HOLD_EXPIRY_KEY = "{holds}:expiry"                                 # Sorted set of hold ids scored by their deadline
+HOLD_RELEASING_KEY = "{holds}:releasing"                           # Sorted set of claimed releases scored by the end of their claim
+HOLD_USERS_KEY = "{holds}:users"                                   # Hash of hold id to its Hold
+HOLD_STATS_KEY = "{holds}:stats"
+SAGA_BUS = os.environ.get("SAGA_BUS", "")                           # host:port of the Redis node with the checkout streams, empty serves no saga events
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+PROCESS_STARTED = datetime.now()
 
 app = Flask("payment-service")
 
-db: redis.Redis = redis.Redis(
-    host=os.environ['REDIS_HOST'],
-    port=int(os.environ['REDIS_PORT']),
+db: redis.Redis | ShardedRedis = redis_client(
+    REDIS_NODES,
     password=os.environ['REDIS_PASSWORD'],
-    db=int(os.environ['REDIS_DB'])
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
 )
-pipeline_db = db.pipeline()
+# Reads that tolerate staleness can go to the replicas, see reader()
+replica_db: redis.Redis | ShardedRedis | None = redis_client(
+    REDIS_REPLICA_NODES,
+    password=os.environ['REDIS_PASSWORD'],
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
+) if REDIS_REPLICA_NODES else None
+# With SAGA_BUS the credit of the checkouts is held and settled on the events of the order service, see saga.py
+saga_bus: SagaBus | None = SagaBus(bus_client(SAGA_BUS, os.environ['REDIS_PASSWORD']), "payment", WORKER_ID, app.logger) if SAGA_BUS else None
 
 
 def close_db_connection():
@@ -60,29 +126,307 @@ class LogUserValue(Struct):
     type: LogType | None = None
     status: LogStatus | None = None
     user_id: str | None = None
-    old_uservalue: UserValue | None = None
+    old_uservalue: UserValue | Raw | None = None   # Written as the raw bytes read from Redis, always read back as a UserValue
+
 
+def get_user_from_db(user_id: str, log_id: str | None = None, stale_ok: bool = False) -> UserValue | None:
+    return get_tagged_user(user_id, log_id, stale_ok)[0]
 
-def get_user_from_db(user_id: str, log_id: str | None = None) -> UserValue | None:
+
+def get_tagged_user(user_id: str, log_id: str | None = None, stale_ok: bool = False) -> tuple[UserValue, str]:
+    # Only reads that tolerate staleness are served from the cache
+    use_cache = stale_ok and entity_cache is not None
+    if use_cache:
+        cached: tuple[UserValue, str] | None = entity_cache.get_tagged(user_id)
+        if cached is not None:
+            return cached
+        generation = entity_cache.generation
+    
     try:
-        entry: bytes = db.get(user_id)
+        # Cache misses read the master, a lagging replica could refill the cache with a value that was just invalidated
+        raw_entry: bytes = reader(stale_ok and not use_cache).get(user_id)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
+    
+    if not raw_entry:
+        abort_user_not_found(user_id, log_id)
+    entry: UserValue = msgpack.decode(raw_entry, type=UserValue)
+    etag = entity_etag(raw_entry)
+    if use_cache:
+        entity_cache.put(user_id, entry, len(raw_entry), generation, etag)
+    return entry, etag
 
-    entry: UserValue | None = msgpack.decode(entry, type=UserValue) if entry else None
 
-    if entry is None:
-        log_key = get_key()
-        error_payload = LogUserValue(
-            id=log_id if log_id else str(uuid.uuid4()),
-            type=LogType.SENT,
-            user_id=user_id,
-            status=LogStatus.FAILURE,
-            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
-        )
-        db.set(log_key, msgpack.encode(error_payload))
-        abort(400, f"User: {user_id} not found! Log key: {log_key}")
-    return entry
+def get_user_for_update(user_id: str, log_id: str | None = None) -> tuple[UserValue, Raw]:
+    # The raw bytes read from the master are the before-image of the UPDATE log, no copy of the user is made or encoded
+    try:
+        raw_entry: bytes = reader().get(user_id)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    
+    if not raw_entry:
+        abort_user_not_found(user_id, log_id)
+    return msgpack.decode(raw_entry, type=UserValue), Raw(raw_entry)
+
+
+def abort_user_not_found(user_id: str, log_id: str | None = None):
+    log_key = get_key(user_id)
+    error_payload = LogUserValue(
+        id=log_id if log_id else str(uuid.uuid4()),
+        type=LogType.SENT,
+        user_id=user_id,
+        status=LogStatus.FAILURE,
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+    )
+    db.set(log_key, msgpack.encode(error_payload))
+    abort(400, f"User: {user_id} not found! Log key: {log_key}")
+
+########################################################################################################################
+#   START OF READ ROUTING FUNCTIONS
+########################################################################################################################
+read_counts: Counter = Counter()
+read_counts_lock = threading.Lock()
+replica_staleness: float | None = None
+
+
+def use_replica(stale_ok: bool) -> bool:
+    # Reads that need read-your-writes always go to the master
+    replica = stale_ok and bool(REDIS_REPLICA_NODES) and (
+        REDIS_READ_POLICY == "replica"
+        or (REDIS_READ_POLICY == "bounded" and replica_staleness is not None and replica_staleness <= REDIS_MAX_STALENESS)
+    )
+    with read_counts_lock:
+        read_counts["replica" if replica else "master"] += 1
+    return replica
+
+
+def reader(stale_ok: bool = False) -> redis.Redis | ShardedRedis:
+    return replica_db if use_replica(stale_ok) else db
+
+
+def measure_replica_staleness() -> float | None:
+    # Every master gets a heartbeat with the current time, its replica is as stale as the heartbeat it has seen
+    now = datetime.now().timestamp()
+    for node in node_clients(db):
+        node.set(REPLICA_HEARTBEAT_KEY, now)
+    
+    staleness = 0.0
+    for node in node_clients(replica_db):
+        heartbeat = node.get(REPLICA_HEARTBEAT_KEY)
+        if heartbeat is None:
+            return None
+        staleness = max(staleness, datetime.now().timestamp() - float(heartbeat))
+    return staleness
+
+
+def replica_monitor_loop():
+    global replica_staleness
+    while not recovery_stop.wait(REPLICA_CHECK_INTERVAL):
+        try:
+            if replica_db is not None:
+                replica_staleness = measure_replica_staleness()
+            
+            # Share the read counts of this worker with the other workers
+            with read_counts_lock:
+                counts = dict(read_counts)
+                read_counts.clear()
+            if counts:
+                pipeline_db = db.pipeline(transaction=False)
+                for target, count in counts.items():
+                    pipeline_db.hincrby(READ_STATS_KEY, target, count)
+                pipeline_db.execute()
+        except redis.exceptions.RedisError as exc:
+            replica_staleness = None
+            app.logger.error(f"Checking the replicas failed: {exc}")
+
+
+@app.get('/reads/status')
+def reads_status():
+    stats = {key.decode('utf-8'): int(value) for key, value in db.hgetall(READ_STATS_KEY).items()}
+    total = sum(stats.values())
+    return jsonify({
+        "policy": REDIS_READ_POLICY,
+        "replicas": len(REDIS_REPLICA_NODES),
+        "max_staleness_seconds": REDIS_MAX_STALENESS,
+        "replica_staleness_seconds": replica_staleness,
+        "reads_master": stats.get("master", 0),
+        "reads_replica": stats.get("replica", 0),
+        "replica_share": stats.get("replica", 0) / total if total else 0.0,
+    }), 200
+
+########################################################################################################################
+#   START OF CACHE FUNCTIONS
+########################################################################################################################
+class EntityCache:
+    """LRU cache of decoded entities, bounded by the size of their encoded values."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, tuple[Struct, int, str]] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # Every invalidation bumps the generation, a fill that started before an invalidation of its key is dropped
+        self.generation = 0
+        self.invalidated: OrderedDict[str, int] = OrderedDict()
+        self.invalidated_floor = 0
+        self.stats: Counter = Counter()
+        self.staleness_total = 0.0
+        self.staleness_max = 0.0
+
+    def get(self, key: str) -> Struct | None:
+        tagged = self.get_tagged(key)
+        return tagged[0] if tagged is not None else None
+
+    def get_tagged(self, key: str) -> tuple[Struct, str] | None:
+        # The entity with the ETag it was stored with
+        with self.lock:
+            entry = self.entries.get(key)
+            self.stats["hits" if entry is not None else "misses"] += 1
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0], entry[2]
+
+    def put(self, key: str, value: Struct, encoded_size: int, generation: int, etag: str):
+        size = encoded_size + CACHE_ENTRY_OVERHEAD
+        with self.lock:
+            if self.invalidated.get(key, self.invalidated_floor) > generation or size > self.max_bytes:
+                return
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size, etag)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.stats["evictions"] += 1
+
+    def invalidate(self, keys: list[str], published_at: float):
+        with self.lock:
+            self.generation += 1
+            if not keys:
+                self.entries.clear()
+                self.size = 0
+                self.invalidated.clear()
+                self.invalidated_floor = self.generation
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.size -= entry[1]
+                self.invalidated[key] = self.generation
+                self.invalidated.move_to_end(key)
+            while len(self.invalidated) > CACHE_HISTORY:
+                self.invalidated_floor = self.invalidated.popitem(last=False)[1]
+            
+            # The staleness is how long a cached copy could outlive the write that replaced it
+            staleness = max(datetime.now().timestamp() - published_at, 0.0)
+            self.stats["invalidations"] += 1
+            self.staleness_total += staleness
+            self.staleness_max = max(self.staleness_max, staleness)
+
+    def clear(self):
+        self.invalidate([], datetime.now().timestamp())
+
+
+entity_cache: EntityCache | None = EntityCache(ENTITY_CACHE_BYTES) if ENTITY_CACHE_BYTES else None
+
+
+def publish_invalidation(*keys: str):
+    # Without keys every cached entity is dropped
+    if entity_cache is not None:
+        db.publish(CACHE_CHANNEL, msgpack.encode((datetime.now().timestamp(), list(keys))))
+
+
+def cache_invalidation_loop():
+    while not recovery_stop.is_set():
+        pubsub = client_for(db, CACHE_CHANNEL).pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(CACHE_CHANNEL)
+            # Invalidations published while not subscribed are lost, so start over from an empty cache
+            entity_cache.clear()
+            while not recovery_stop.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    published_at, keys = msgpack.decode(message["data"])
+                    entity_cache.invalidate(keys, published_at)
+        except redis.exceptions.RedisError as exc:
+            app.logger.error(f"Cache invalidation subscription failed: {exc}")
+            entity_cache.clear()
+            recovery_stop.wait(1)
+        finally:
+            pubsub.close()
+
+
+@app.get('/cache/status')
+def cache_status():
+    if entity_cache is None:
+        return jsonify({"enabled": False}), 200
+    
+    with entity_cache.lock:
+        stats = dict(entity_cache.stats)
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        invalidations = stats.get("invalidations", 0)
+        return jsonify({
+            "enabled": True,
+            "worker": WORKER_ID,
+            "entries": len(entity_cache.entries),
+            "bytes": entity_cache.size,
+            "max_bytes": entity_cache.max_bytes,
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),
+            "hit_ratio": stats.get("hits", 0) / lookups if lookups else 0.0,
+            "evictions": stats.get("evictions", 0),
+            "invalidations": invalidations,
+            "staleness_avg_seconds": entity_cache.staleness_total / invalidations if invalidations else 0.0,
+            "staleness_max_seconds": entity_cache.staleness_max,
+        }), 200
+
+def entity_etag(raw_entry: bytes) -> str:
+    # Every write that changes the entity changes its stored bytes, the digest is taken once per read from Redis and kept
+    # with the cached entity
+    return hashlib.blake2b(raw_entry, digest_size=8).hexdigest()
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # If-None-Match compares weakly, W/"x" matches "x"
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/").strip('"') for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def validator_headers(etag: str, max_age: int = 0) -> dict[str, str]:
+    # Clients and the gateway revalidate with If-None-Match, only immutable entities may be reused without asking
+    return {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={max_age}, immutable" if max_age else "no-cache",
+    }
+
+########################################################################################################################
+#   START OF CATALOG FUNCTIONS
+########################################################################################################################
+def add_catalog_entry(client: redis.Redis | redis.client.Pipeline, user_id: str):
+    # Every created user is appended to the user feed
+    client.xadd(CATALOG_STREAM_KEY, {"user": user_id}, maxlen=CATALOG_STREAM_LENGTH, approximate=True)
+
+
+@app.get('/catalog')
+def user_catalog_feed():
+    since = request.args.get("since", "0")
+    count = min(int(request.args.get("count", CATALOG_PAGE_MAX)), CATALOG_PAGE_MAX)
+    try:
+        # A position that is no longer in the feed was trimmed or flushed, so the reader has to start over
+        reset = since != "0" and not db.xrange(CATALOG_STREAM_KEY, since, since)
+        entries = db.xrange(CATALOG_STREAM_KEY, "-" if reset else f"({since}", count=count)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    
+    last_id = entries[-1][0].decode('utf-8') if entries else ("0" if reset else since)
+    return jsonify({
+        "reset": reset,
+        "last_id": last_id,
+        "users": [fields[b"user"].decode('utf-8') for _, fields in entries],
+    }), 200
 
 ########################################################################################################################
 #   START OF LOG FUNCTIONS
@@ -109,9 +453,88 @@ def sort_logs(logs: list[dict]):
     return log_dict
 
 
+class LogFilters(Struct):
+    type: str | None = None
+    status: str | None = None
+    user_id: str | None = None
+    since: str | None = None
+    until: str | None = None
+
+
+def log_key_timestamp(log_key: str) -> str:
+    # Log keys look like "log:<YYYYmmddHHMMSSffffff><counter>"
+    return log_key.split(":")[-1][:20]
+
+
+def parse_log_filters() -> LogFilters:
+    since = request.args.get("since")
+    until = request.args.get("until")
+    return LogFilters(
+        type=request.args.get("type"),
+        status=request.args.get("status"),
+        user_id=request.args.get("user_id"),
+        # Allow prefixes such as "20240601" or "2024060112" for the time range
+        since=since.ljust(20, "0") if since else None,
+        until=until.ljust(20, "9") if until else None,
+    )
+
+
+def log_matches_filters(log: dict, filters: LogFilters) -> bool:
+    if filters.type is not None and log["type"] != filters.type:
+        return False
+    if filters.status is not None and log["status"] != filters.status:
+        return False
+    if filters.user_id is not None and log["user_id"] != filters.user_id:
+        return False
+    return True
+
+
+def log_key_in_range(log_key: str, filters: LogFilters) -> bool:
+    timestamp_str = log_key_timestamp(log_key)
+    if filters.since is not None and timestamp_str < filters.since:
+        return False
+    if filters.until is not None and timestamp_str > filters.until:
+        return False
+    return True
+
+
+def scan_log_keys(batch_size: int = LOG_PAGE_SIZE, read_db: redis.Redis | ShardedRedis | None = None):
+    # Walk the log keys with SCAN so the whole keyspace is never loaded at once
+    batch: list[str] = []
+    for key in (read_db or db).scan_iter(match="log:*", count=batch_size):
+        batch.append(key.decode('utf-8'))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def fetch_logs(log_keys: list[str], filters: LogFilters, read_db: redis.Redis | ShardedRedis | None = None) -> list[dict]:
+    # Filter on the timestamp embedded in the key before fetching anything
+    log_keys = [key for key in log_keys if log_key_in_range(key, filters)]
+    if not log_keys:
+        return []
+
+    logs = []
+    for key, raw_data in zip(log_keys, (read_db or db).mget(log_keys)):
+        if not raw_data:
+            continue
+        log = format_log_entry(msgpack.decode(raw_data, type=LogUserValue))
+        if log_matches_filters(log, filters):
+            logs.append({"id": key, "log": log})
+    return logs
+
+
+def encode_stream_chunk(records: list, stream_format: str) -> bytes:
+    if stream_format == "msgpack":
+        return b"".join(msgpack.encode(record) for record in records)
+    return b"".join(json.encode(record) + b"\n" for record in records)
+
+
 def get_log_from_db(log_key: str) -> LogUserValue | None:
     try:
-        entry: bytes = db.get(log_key)
+        entry: bytes = reader(stale_ok=True).get(log_key)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
 
@@ -124,7 +547,7 @@ def get_log_from_db(log_key: str) -> LogUserValue | None:
 
 @app.get('/log_count')
 def get_log_count():
-    return Response(str(len(db.keys("log:*"))), status=200)
+    return Response(str(len(reader(stale_ok=True).keys("log:*"))), status=200)
 
 
 @app.get('/log/<log_key>')
@@ -138,11 +561,12 @@ def find_log(log_key: str):
 def find_all_logs():
     try:
         # Retrieve all keys starting with "log:" from Redis
-        log_keys = [key.decode('utf-8') for key in db.keys("log:*")]
+        read_db = reader(stale_ok=True)
+        log_keys = [key.decode('utf-8') for key in read_db.keys("log:*")]
 
         # Retrieve values corresponding to the keys
         logs = [{"key": key, "log": format_log_entry(msgpack.decode(
-            db.get(key), type=LogUserValue))} for key in log_keys]
+            read_db.get(key), type=LogUserValue))} for key in log_keys]
 
         return jsonify({'logs': logs}), 200
     except redis.exceptions.RedisError:
@@ -154,30 +578,15 @@ def find_all_logs_time(time: datetime, min_diff: int = 5):
         # Calculate the range
         lower_bound: datetime = time - timedelta(minutes=min_diff)
         upper_bound: datetime = time
+        filters = LogFilters(
+            since=lower_bound.strftime("%Y%m%d%H%M%S%f"),
+            until=upper_bound.strftime("%Y%m%d%H%M%S%f"),
+        )
 
-        # Create a broad pattern to fetch all potential keys
-        broad_pattern = "log:*"
-
-        # Retrieve all keys matching the broad pattern
-        potential_keys = [key.decode('utf-8') for key in db.keys(broad_pattern)]
-
-        # Filter keys based on the timestamp
+        # Fetch the logs within the range batch by batch
         logs = []
-        for key in potential_keys:
-            timestamp_str = key.split(":")[-1][:20]
-            key_timestamp: datetime = datetime.strptime(timestamp_str, "%Y%m%d%H%M%S%f")
-
-            if lower_bound > key_timestamp or upper_bound < key_timestamp:
-                continue
-
-            raw_data = db.get(key)
-
-            if not raw_data:
-                continue
-            
-            # Decode the raw data into a LogUserValue object
-            log_entry = msgpack.decode(raw_data, type=LogUserValue)
-            logs.append({"id": key, "log": format_log_entry(log_entry)})
+        for log_keys in scan_log_keys():
+            logs.extend(fetch_logs(log_keys, filters))
 
         return logs
     except redis.exceptions.RedisError:
@@ -192,6 +601,40 @@ def find_sorted_logs(min_diff: int):
 
     return jsonify(sorted_logs), 200
 
+@app.get('/logs/page')
+def find_logs_page():
+    cursor = int(request.args.get("cursor", 0))
+    count = min(int(request.args.get("count", LOG_PAGE_SIZE)), LOG_PAGE_MAX)
+    filters = parse_log_filters()
+
+    try:
+        read_db = reader(stale_ok=True)
+        next_cursor, log_keys = read_db.scan(cursor=cursor, match="log:*", count=count)
+        logs = fetch_logs([key.decode('utf-8') for key in log_keys], filters, read_db)
+    except redis.exceptions.RedisError:
+        return abort(500, 'Failed to retrieve logs from the database')
+
+    # A returned cursor of 0 means that the whole log has been walked
+    return jsonify({"logs": logs, "cursor": next_cursor}), 200
+
+
+@app.get('/logs/stream')
+def stream_logs():
+    stream_format = request.args.get("format", "ndjson")
+    if stream_format not in STREAM_MIMETYPES:
+        return abort(400, f"Unknown stream format: {stream_format}")
+    filters = parse_log_filters()
+
+    read_db = reader(stale_ok=True)
+    
+    def generate():
+        for log_keys in scan_log_keys(read_db=read_db):
+            chunk = encode_stream_chunk(fetch_logs(log_keys, filters, read_db), stream_format)
+            if chunk:
+                yield chunk
+
+    return Response(stream_with_context(generate()), mimetype=STREAM_MIMETYPES[stream_format])
+
 
 # For testing purposes only
 @app.post('/log/create')
@@ -213,8 +656,11 @@ def create_user_benchmark():
     user_id = str(uuid.uuid4())
     user_value = UserValue(credit=0)
 
+    pipeline_db = db.pipeline()
+    pipeline_db.set(user_id, msgpack.encode(user_value))
+    add_catalog_entry(pipeline_db, user_id)
     try:
-        db.set(user_id, msgpack.encode(user_value))
+        pipeline_db.execute()
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
 
@@ -223,7 +669,7 @@ def create_user_benchmark():
 
 @app.get('/find_user/<user_id>/benchmark')
 def find_user_benchmark(user_id: str):
-    entry: bytes = db.get(user_id)
+    entry: bytes = reader(stale_ok=True).get(user_id)
     user_entry: UserValue | None = msgpack.decode(entry, type=UserValue) if entry else None
 
     if user_entry is None:
@@ -240,9 +686,10 @@ def add_credit_benchmark(user_id: str, amount: int):
     try:
         db.set(user_id, msgpack.encode(user_entry))
     except redis.exceptions.RedisError:
-        pipeline_db.discard()
         return abort(400, DB_ERROR_STR)
 
+    publish_invalidation(user_id)
+
     return jsonify({"credit": user_entry.credit}), 200
 
 
@@ -257,9 +704,10 @@ def remove_credit_benchmark(user_id: str, amount: int):
     try:
         db.set(user_id, msgpack.encode(user_entry))
     except redis.exceptions.RedisError:
-        pipeline_db.discard()
         return abort(400, DB_ERROR_STR)
 
+    publish_invalidation(user_id)
+
     return jsonify({"credit": user_entry.credit}), 200
 
 ########################################################################################################################
@@ -282,9 +730,11 @@ def create_user():
     )
 
     # Set the log entry and the updated item in the pipeline
-    log_key = get_key()
+    log_key = get_key(user_id)
+    pipeline_db = db.pipeline()
     pipeline_db.set(log_key, msgpack.encode(create_payload))
     pipeline_db.set(user_id, msgpack.encode(user_value))
+    add_catalog_entry(pipeline_db, user_id)
     try:
         pipeline_db.execute()
     except redis.exceptions.RedisError:
@@ -295,7 +745,7 @@ def create_user():
             status=LogStatus.FAILURE,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
         )
-        db.set(get_key(), msgpack.encode(error_payload))
+        db.set(get_key(user_id), msgpack.encode(error_payload))
         
         pipeline_db.discard()
         
@@ -309,30 +759,72 @@ def create_user():
         status=LogStatus.SUCCESS,
         dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
     )
-    db.set(get_key(), msgpack.encode(sent_payload_to_user))
+    db.set(get_key(user_id), msgpack.encode(sent_payload_to_user))
 
     return jsonify({'user_id': user_id, 'log_id': log_id}), 200
 
 
 @app.get('/find_user/<user_id>')
 def find_user(user_id: str):
-    user_entry: UserValue = get_user_from_db(user_id)
+    user_entry, etag = get_tagged_user(user_id, stale_ok=True)
+
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status=304, headers=validator_headers(etag))
 
     return jsonify(
         {
             "user_id": user_id,
             "credit": user_entry.credit,
         }
-    ), 200
+    ), 200, validator_headers(etag)
+
+
+@app.post('/find_many')
+def find_many_users():
+    # The body is a JSON list of user ids, the entries are streamed in the order of the ids, one MGET per chunk
+    stream_format = request.args.get("format", "ndjson")
+    if stream_format not in STREAM_MIMETYPES:
+        return abort(400, f"Unknown stream format: {stream_format}")
+    try:
+        user_ids: list[str] = json.decode(request.get_data(), type=list[str])
+    except MsgspecError:
+        return abort(400, "Expected a JSON list of user ids")
+    if len(user_ids) > FIND_MANY_MAX:
+        return abort(400, f"At most {FIND_MANY_MAX} user ids per request")
+    
+    read_db = reader(stale_ok=True)
+    decoder = msgpack.Decoder(UserValue)
+    
+    def generate():
+        for start in range(0, len(user_ids), FIND_MANY_CHUNK):
+            chunk_ids = user_ids[start:start + FIND_MANY_CHUNK]
+            try:
+                entries: list[bytes | None] = read_db.mget(chunk_ids)
+            except redis.exceptions.RedisError:
+                # The status line is already sent, so the failure is reported per entry
+                yield encode_stream_chunk([{"user_id": user_id, "found": False, "error": DB_ERROR_STR} for user_id in chunk_ids], stream_format)
+                continue
+            # Missing ids are only reported, unlike a single find they do not write a failure log
+            yield encode_stream_chunk(
+                [user_record(user_id, decoder.decode(entry) if entry else None) for user_id, entry in zip(chunk_ids, entries)],
+                stream_format
+            )
+    
+    return Response(stream_with_context(generate()), mimetype=STREAM_MIMETYPES[stream_format])
+
+
+def user_record(user_id: str, entry: UserValue | None) -> dict:
+    if entry is None:
+        return {"user_id": user_id, "found": False}
+    return {"user_id": user_id, "found": True, "credit": entry.credit}
 
 
 @app.post('/add_funds/<user_id>/<amount>')
 def add_credit(user_id: str, amount: int):
     log_id = str(uuid.uuid4())
 
-    # Get the user from the database and create a copy of it for rollback purposes
-    user_entry: UserValue = get_user_from_db(user_id)
-    old_user_entry: UserValue = deepcopy(user_entry)
+    # Get the user from the database, its stored bytes are kept for rollback purposes
+    user_entry, old_user_entry = get_user_for_update(user_id)
 
     # Update credit locally
     user_entry.credit += int(amount)
@@ -347,7 +839,8 @@ def add_credit(user_id: str, amount: int):
     )
 
     # Set the log entry and the updated item in the pipeline
-    log_key = get_key()
+    log_key = get_key(user_id)
+    pipeline_db = db.pipeline()
     pipeline_db.set(log_key, msgpack.encode(update_payload))
     pipeline_db.set(user_id, msgpack.encode(user_entry))
     try:
@@ -360,12 +853,14 @@ def add_credit(user_id: str, amount: int):
             status=LogStatus.FAILURE,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
         )
-        db.set(get_key(), msgpack.encode(error_payload))
+        db.set(get_key(user_id), msgpack.encode(error_payload))
         
         pipeline_db.discard()
         
         return abort(400, DB_ERROR_STR)
 
+    publish_invalidation(user_id)
+
     # create log entry for the sent response
     sent_payload_to_user = LogUserValue(
         id=log_id,
@@ -374,7 +869,7 @@ def add_credit(user_id: str, amount: int):
         status=LogStatus.SUCCESS,
         dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
     )
-    db.set(get_key(), msgpack.encode(sent_payload_to_user))
+    db.set(get_key(user_id), msgpack.encode(sent_payload_to_user))
 
     return Response(f"User: {user_id} credit updated to: {user_entry.credit}, log_key: {log_key}", status=200)
 
@@ -385,9 +880,8 @@ def remove_credit(user_id: str, amount: int):
     
     log_id = str(uuid.uuid4())
 
-    # Get the user from the database and create a copy of it for rollback purposes
-    user_entry: UserValue = get_user_from_db(user_id)
-    old_user_entry: UserValue = deepcopy(user_entry)
+    # Get the user from the database, its stored bytes are kept for rollback purposes
+    user_entry, old_user_entry = get_user_for_update(user_id)
 
     # Update credit locally
     user_entry.credit -= int(amount)
@@ -403,7 +897,7 @@ def remove_credit(user_id: str, amount: int):
             user_id=user_id,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
         )
-        log_key = get_key()
+        log_key = get_key(user_id)
         db.set(log_key, msgpack.encode(sent_log))
         
         return abort(400, f"User: {user_id} credit cannot get reduced below zero! Log key: {log_key}")
@@ -418,7 +912,8 @@ def remove_credit(user_id: str, amount: int):
     )
 
     # Set the log entry and the updated item in the pipeline
-    log_key = get_key()
+    log_key = get_key(user_id)
+    pipeline_db = db.pipeline()
     pipeline_db.set(log_key, msgpack.encode(update_payload))
     pipeline_db.set(user_id, msgpack.encode(user_entry))
     try:
@@ -433,12 +928,14 @@ def remove_credit(user_id: str, amount: int):
             status=LogStatus.FAILURE,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
         )
-        db.set(get_key(), msgpack.encode(error_payload))
+        db.set(get_key(user_id), msgpack.encode(error_payload))
         
         pipeline_db.discard()
         
         return abort(400, DB_ERROR_STR)
 
+    publish_invalidation(user_id)
+
     # Create log entry for the sent response
     sent_payload_to_user = LogUserValue(
         id=log_id,
@@ -447,18 +944,393 @@ def remove_credit(user_id: str, amount: int):
         status=LogStatus.SUCCESS,
         dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
     )
-    db.set(get_key(), msgpack.encode(sent_payload_to_user))
+    db.set(get_key(user_id), msgpack.encode(sent_payload_to_user))
 
     return Response(f"User: {user_id} credit updated to: {user_entry.credit}, log_key: {log_key}", status=200)
 
-# Function to geet an idempotent key from the ID service
-def get_key():
+@app.post('/pay_many')
+def remove_credit_many():
+    # The body is a JSON list of [key, user_id, amount] payments, the payments of a user are applied in order and written once
+    try:
+        payments: list[tuple[str, str, int]] = json.decode(request.get_data(), type=list[tuple[str, str, int]])
+    except MsgspecError:
+        return abort(400, "Expected a JSON list of [key, user_id, amount] payments")
+    if len(payments) > PAY_MANY_MAX:
+        return abort(400, f"At most {PAY_MANY_MAX} payments per request")
+    
+    user_ids = list(dict.fromkeys(user_id for _, user_id, _ in payments))
+    try:
+        raw_entries: list[bytes | None] = db.mget(user_ids) if user_ids else []
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    old_entries: dict[str, UserValue | None] = {
+        user_id: msgpack.decode(raw_entry, type=UserValue) if raw_entry else None
+        for user_id, raw_entry in zip(user_ids, raw_entries)
+    }
+    old_images: dict[str, Raw | None] = {user_id: Raw(raw_entry) if raw_entry else None for user_id, raw_entry in zip(user_ids, raw_entries)}
+    credit: dict[str, int] = {user_id: entry.credit for user_id, entry in old_entries.items() if entry is not None}
+    
+    results: list[dict] = []
+    failure_logs: list[LogUserValue] = []
+    for key, user_id, amount in payments:
+        if user_id not in credit:
+            error = f"User: {user_id} not found!"
+        elif credit[user_id] - int(amount) < 0:
+            error = f"User: {user_id} credit cannot get reduced below zero!"
+        else:
+            credit[user_id] -= int(amount)
+            results.append({"key": key, "success": True})
+            continue
+        
+        failure_logs.append(LogUserValue(
+            id=str(uuid.uuid4()),
+            type=LogType.SENT,
+            status=LogStatus.FAILURE,
+            old_uservalue=old_images[user_id],
+            user_id=user_id,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+        ))
+        results.append({"key": key, "success": False, "error": error})
+    
+    pipeline_failures = db.pipeline(transaction=False)
+    for sent_log in failure_logs:
+        pipeline_failures.set(get_key(sent_log.user_id), msgpack.encode(sent_log))
+    
+    # Every charged user gets one UPDATE log with the value from before the batch, so recovery stays per user
+    changed = [user_id for user_id in user_ids if old_entries[user_id] is not None and credit[user_id] != old_entries[user_id].credit]
+    log_ids = {user_id: str(uuid.uuid4()) for user_id in changed}
+    pipeline_db = db.pipeline()
+    for user_id in changed:
+        update_payload = LogUserValue(
+            id=log_ids[user_id],
+            type=LogType.UPDATE,
+            user_id=user_id,
+            old_uservalue=old_images[user_id],
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+        )
+        pipeline_db.set(get_key(user_id), msgpack.encode(update_payload))
+        pipeline_db.set(user_id, msgpack.encode(UserValue(credit=credit[user_id])))
+    try:
+        pipeline_failures.execute()
+        pipeline_db.execute()
+    except redis.exceptions.RedisError:
+        # With sharding every node runs its own MULTI/EXEC, so some users may have been charged. Their UPDATE logs are
+        # left unfinished and the recovery restores them, the users of the other nodes got no log at all.
+        pipeline_db.discard()
+        
+        return abort(400, DB_ERROR_STR)
+    
+    if changed:
+        publish_invalidation(*changed)
+    
+    # Create a log entry per user for the sent response
+    pipeline_sent = db.pipeline(transaction=False)
+    for user_id in changed:
+        sent_payload_to_user = LogUserValue(
+            id=log_ids[user_id],
+            type=LogType.SENT,
+            user_id=user_id,
+            status=LogStatus.SUCCESS,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+        )
+        pipeline_sent.set(get_key(user_id), msgpack.encode(sent_payload_to_user))
+    pipeline_sent.execute()
+    
+    return jsonify(results), 200
+
+########################################################################################################################
+#   START OF HOLD FUNCTIONS
+########################################################################################################################
+class Hold(Struct):
+    user_id: str
+    amount: int
+    deadline: float
+
+
+def hold_key(hold_id: str, user_id: str) -> str:
+    # The hash tag keeps the hold on the node of its user, so the hold and the credit change are one MULTI/EXEC
+    return f"hold:{hold_id}{{{user_id}}}"
+
+
+def released_key(hold_id: str, user_id: str) -> str:
+    # Left by a release that found no credit to give back, so a debit of the hold that is still on its way is refused
+    return f"released:{hold_id}{{{user_id}}}"
+
+
+# Moves a hold from one sorted set to the releasing set when its score is at most the limit
+claim_release_script = db.register_script("""
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not score or (ARGV[2] ~= 'any' and tonumber(score) > tonumber(ARGV[2])) then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+return 1
+""")
+
+
+# Takes a hold out of the expiry set and remembers it as captured, 2 when it was captured before
+capture_hold_script = db.register_script("""
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    redis.call('SET', KEYS[2], 1, 'EX', ARGV[2])
+    return 1
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 2
+end
+return 0
+""")
+
+
+def captured_key(hold_id: str) -> str:
+    # Next to the expiry set, so the capture and its marker are one script
+    return f"{{holds}}:captured:{hold_id}"
+
+
+def claim_release(hold_id: str, source_key: str = HOLD_EXPIRY_KEY, limit: float | str = "any") -> bool:
+    return bool(claim_release_script(keys=[source_key, HOLD_RELEASING_KEY], args=[hold_id, limit, time() + HOLD_CLAIM_TIMEOUT]))
+
+
+def hold_log_payloads(user_id: str, raw_entry: bytes) -> tuple[bytes, bytes]:
+    # A finished transaction of its own, the UPDATE and SENT logs are written together with the credit change
+    log_id = str(uuid.uuid4())
+    update_payload = LogUserValue(
+        id=log_id,
+        type=LogType.UPDATE,
+        user_id=user_id,
+        old_uservalue=Raw(raw_entry),
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+    )
+    sent_payload = LogUserValue(
+        id=log_id,
+        type=LogType.SENT,
+        user_id=user_id,
+        status=LogStatus.SUCCESS,
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+    )
+    return msgpack.encode(update_payload), msgpack.encode(sent_payload)
+
+
+def release_hold(hold_id: str):
+    # Gives the held credit back, the hold is deleted in the transaction that returns the credit, so a release that is
+    # retried after a crash never returns the credit twice
+    raw_hold: bytes | None = db.hget(HOLD_USERS_KEY, hold_id)
+    if raw_hold:
+        hold: Hold = msgpack.decode(raw_hold, type=Hold)
+        key = hold_key(hold_id, hold.user_id)
+        update_key, sent_key = get_key(hold.user_id), get_key(hold.user_id)
+        with client_for(db, hold.user_id).pipeline() as pipeline_db:
+            while True:
+                try:
+                    pipeline_db.watch(hold.user_id, key)
+                    raw_entry: bytes | None = pipeline_db.get(hold.user_id)
+                    if not raw_entry:
+                        break
+                    if not pipeline_db.exists(key):
+                        # The credit was not taken yet, the debit that is still on its way sees this and gives up
+                        pipeline_db.multi()
+                        pipeline_db.set(released_key(hold_id, hold.user_id), 1, ex=HOLD_TOMBSTONE_TTL)
+                        pipeline_db.execute()
+                        break
+                    
+                    user_entry: UserValue = msgpack.decode(raw_entry, type=UserValue)
+                    user_entry.credit += hold.amount
+                    update_log, sent_log = hold_log_payloads(hold.user_id, raw_entry)
+                    
+                    pipeline_db.multi()
+                    pipeline_db.set(update_key, update_log)
+                    pipeline_db.set(hold.user_id, msgpack.encode(user_entry))
+                    pipeline_db.delete(key)
+                    pipeline_db.set(sent_key, sent_log)
+                    pipeline_db.execute()
+                    publish_invalidation(hold.user_id)
+                    break
+                except redis.exceptions.WatchError:
+                    continue
+    
+    pipeline_done = db.pipeline()
+    pipeline_done.hdel(HOLD_USERS_KEY, hold_id)
+    pipeline_done.zrem(HOLD_RELEASING_KEY, hold_id)
+    pipeline_done.execute()
+
+
+def sweep_holds() -> int:
+    # Releases the expired holds and the releases whose worker died, every worker sweeps, the claim picks one
+    released = 0
+    for source_key in (HOLD_EXPIRY_KEY, HOLD_RELEASING_KEY):
+        now = time()
+        for hold_id in db.zrangebyscore(source_key, "-inf", now, start=0, num=HOLD_SWEEP_BATCH):
+            hold_id = hold_id.decode('utf-8')
+            if claim_release(hold_id, source_key, now):
+                release_hold(hold_id)
+                released += 1
+    if released:
+        db.hincrby(HOLD_STATS_KEY, "expired", released)
+    return released
+
+
+def hold_sweep_loop():
+    while not recovery_stop.wait(HOLD_SWEEP_INTERVAL):
+        try:
+            sweep_holds()
+        except (redis.exceptions.RedisError, HTTPException) as exc:
+            app.logger.error(f"Sweeping the holds failed: {exc}")
+
+
+@app.post('/authorize/<hold_id>/<user_id>/<amount>')
+def authorize_payment(hold_id: str, user_id: str, amount: int):
+    # Takes the amount from the credit and keeps it on hold until it is captured, voided or expires after ttl seconds
+    return hold_credit(hold_id, user_id, int(amount), float(request.args.get("ttl", HOLD_TTL)))
+
+
+def hold_credit(hold_id: str, user_id: str, amount: int, ttl: float):
+    # A retried authorization is not held twice
+    hold = Hold(user_id=user_id, amount=amount, deadline=time() + ttl)
+    if not db.hsetnx(HOLD_USERS_KEY, hold_id, msgpack.encode(hold)):
+        return jsonify({"hold_id": hold_id, "deadline": msgpack.decode(db.hget(HOLD_USERS_KEY, hold_id), type=Hold).deadline}), 200
+    
+    # The hold is indexed before the credit is taken, so the sweeper finds it even when this worker dies
+    db.zadd(HOLD_EXPIRY_KEY, {hold_id: hold.deadline})
+    
+    def cancel_hold():
+        pipeline_cancel = db.pipeline()
+        pipeline_cancel.hdel(HOLD_USERS_KEY, hold_id)
+        pipeline_cancel.zrem(HOLD_EXPIRY_KEY, hold_id)
+        pipeline_cancel.execute()
+    
+    update_key, sent_key = get_key(user_id), get_key(user_id)
+    with client_for(db, user_id).pipeline() as pipeline_db:
+        while True:
+            try:
+                # The credit change and the hold are written only when the credit did not change and the hold was not
+                # released since they were read
+                pipeline_db.watch(user_id, released_key(hold_id, user_id))
+                raw_entry: bytes | None = pipeline_db.get(user_id)
+                if not raw_entry:
+                    pipeline_db.reset()
+                    cancel_hold()
+                    abort_user_not_found(user_id)
+                if pipeline_db.exists(released_key(hold_id, user_id)):
+                    # The sweeper or a void claimed the hold before its credit was taken
+                    pipeline_db.reset()
+                    return abort(400, f"Hold: {hold_id} expired or was voided before the credit was taken")
+                
+                user_entry: UserValue = msgpack.decode(raw_entry, type=UserValue)
+                user_entry.credit -= amount
+                if user_entry.credit < 0:
+                    pipeline_db.reset()
+                    cancel_hold()
+                    sent_log = LogUserValue(
+                        id=str(uuid.uuid4()),
+                        type=LogType.SENT,
+                        status=LogStatus.FAILURE,
+                        old_uservalue=Raw(raw_entry),
+                        user_id=user_id,
+                        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+                    )
+                    log_key = get_key(user_id)
+                    db.set(log_key, msgpack.encode(sent_log))
+                    return abort(400, f"User: {user_id} credit cannot get reduced below zero! Log key: {log_key}")
+                
+                update_log, sent_log = hold_log_payloads(user_id, raw_entry)
+                pipeline_db.multi()
+                pipeline_db.set(update_key, update_log)
+                pipeline_db.set(user_id, msgpack.encode(user_entry))
+                pipeline_db.set(hold_key(hold_id, user_id), amount)
+                pipeline_db.set(sent_key, sent_log)
+                pipeline_db.execute()
+                break
+            except redis.exceptions.WatchError:
+                continue
+            except redis.exceptions.RedisError:
+                # A hold that was written is given back by the sweeper when it expires
+                return abort(400, DB_ERROR_STR)
+    
+    publish_invalidation(user_id)
+    
+    return jsonify({"hold_id": hold_id, "deadline": hold.deadline, "credit": user_entry.credit}), 200
+
+
+@app.post('/capture/<hold_id>')
+def capture_payment(hold_id: str):
+    # The held credit stays taken, fails when the hold already expired or is being released. A repeated capture, such as
+    # the retry of a lost answer, succeeds and finishes the cleanup of the first one
+    captured = capture_hold_script(keys=[HOLD_EXPIRY_KEY, captured_key(hold_id)], args=[hold_id, HOLD_CAPTURED_TTL])
+    if not captured:
+        return abort(400, f"Hold: {hold_id} expired or does not exist!")
+    
+    raw_hold: bytes | None = db.hget(HOLD_USERS_KEY, hold_id)
+    pipeline_db = db.pipeline()
+    if raw_hold:
+        pipeline_db.delete(hold_key(hold_id, msgpack.decode(raw_hold, type=Hold).user_id))
+    pipeline_db.hdel(HOLD_USERS_KEY, hold_id)
+    pipeline_db.execute()
+    
+    if captured == 1:
+        db.hincrby(HOLD_STATS_KEY, "captured", 1)
+    return Response(f"Hold: {hold_id} captured", status=200)
+
+
+@app.post('/void/<hold_id>')
+def void_payment(hold_id: str):
+    # Voiding twice, or after the sweeper took the hold, is not an error
+    if claim_release(hold_id):
+        release_hold(hold_id)
+        db.hincrby(HOLD_STATS_KEY, "voided", 1)
+    return Response(f"Hold: {hold_id} voided", status=200)
+
+
+def authorize_for_saga(event: dict) -> tuple[bool, str]:
+    try:
+        hold_credit(event["saga_id"], event["user_id"], event["total_cost"], event["ttl"])
+    except HTTPException as exc:
+        return False, f"User out of credit: {exc.description}"
+    return True, ""
+
+
+def handle_checkout_event(event: dict):
+    # The saga id is the hold id, so a redelivered event authorizes, captures or voids the credit only once
+    saga_id = event["saga_id"]
+    with app.app_context():
+        if event["type"] == "requested":
+            saga_bus.answer(event, "payment", lambda: authorize_for_saga(event))
+        elif event["type"] == "completed":
+            try:
+                capture_payment(saga_id)
+            except HTTPException as exc:
+                # A repeated announcement is captured again without error, this is a paid order whose credit was given
+                # back, an operator has to charge it
+                db.hincrby(HOLD_STATS_KEY, "expired_captures", 1)
+                app.logger.error(f"Capturing the credit of saga {saga_id} failed: {exc.description}")
+        elif event["type"] == "cancelled":
+            void_payment(saga_id)
+
+
+@app.get('/saga/status')
+def saga_status():
+    if saga_bus is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **saga_bus.status(CHECKOUT_STREAM)}), 200
+
+
+@app.get('/holds/status')
+def holds_status():
+    stats = {key.decode('utf-8'): int(value) for key, value in db.hgetall(HOLD_STATS_KEY).items()}
+    return jsonify({
+        "active": db.zcard(HOLD_EXPIRY_KEY),
+        "releasing": db.zcard(HOLD_RELEASING_KEY),
+        "ttl": HOLD_TTL,
+        **stats,
+    }), 200
+
+# Function to get an idempotent key from the ID service, the hash tag keeps the log on the shard of its entity
+def get_key(hash_tag: str | None = None):
     try:
         response = requests.get(f"{GATEWAY_URL}/ids/create")
     except requests.exceptions.RequestException:
         abort(400, REQ_ERROR_STR)
     else:
-        return response.text
+        return f"{response.text}{{{hash_tag}}}" if hash_tag else response.text
 
 # Can ignore
 @app.post('/batch_init/<n>/<starting_money>')
@@ -468,12 +1340,44 @@ def batch_init_users(n: int, starting_money: int):
     starting_money = int(starting_money)
     kv_pairs: dict[str, bytes] = {f"{i}": msgpack.encode(UserValue(credit=starting_money))
                                   for i in range(n)}
+    pipeline_catalog = db.pipeline(transaction=False)
+    for user_id in kv_pairs:
+        add_catalog_entry(pipeline_catalog, user_id)
     try:
         db.mset(kv_pairs)
+        pipeline_catalog.execute()
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
+    publish_invalidation()
     return jsonify({"msg": "Batch init for users successful"})
 
+# Can ignore, seeds a backlog of unfinished transactions for the recovery benchmark
+@app.post('/recovery/seed/<n>')
+def seed_recovery_backlog(n: int):
+    n = int(n)
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    
+    pipeline_seed = db.pipeline(transaction=False)
+    for i in range(n):
+        user_id = f"recovery-seed-{i}"
+        update_payload = LogUserValue(
+            id=str(uuid.uuid4()),
+            type=LogType.UPDATE,
+            user_id=user_id,
+            old_uservalue=UserValue(credit=1),
+            dateTime=timestamp
+        )
+        pipeline_seed.set(user_id, msgpack.encode(UserValue(credit=0)))
+        pipeline_seed.set(f"log:{timestamp}seed{i}{{recovery-seed-{i}}}", msgpack.encode(update_payload))
+        if len(pipeline_seed) >= RECOVERY_BATCH_SIZE:
+            pipeline_seed.execute()
+    try:
+        pipeline_seed.execute()
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    publish_invalidation()
+    return jsonify({"msg": f"Seeded {n} unfinished transactions"})
+
 # Function to call the fault tolerance function for testing purposes
 @app.get('/fault_tolerance/<min_diff>')
 def test_fault_tolerance(min_diff: int):
@@ -486,25 +1390,238 @@ def fix_fault_tolerance(min_diff: int = 5):
     logs = find_all_logs_time(time, int(min_diff))
     sorted_logs = sort_logs(logs)
 
+    unfinished: list[list[dict]] = []
     for _, log_list in sorted_logs.items():
-        last_log = log_list[-1]["log"]
-        if last_log["status"] in [LogStatus.SUCCESS, LogStatus.FAILURE] and last_log["type"] == LogType.SENT:
+        if is_transaction_finished(log_list):
             # If log was finished properly
             continue
 
-        for log_entry in reversed(log_list):
-            log = log_entry["log"]
+        unfinished.append(log_list)
+
+    recover_transactions(unfinished)
+
+
+# Rollback the changes of an unfinished transaction and delete its logs
+def recover_transaction(log_list: list[dict], pipeline_recovery: redis.client.Pipeline):
+    for log_entry in reversed(log_list):
+        log = log_entry["log"]
+
+        log_type = log["type"]
+        log_user_id = log["user_id"]
+        if log_type == LogType.CREATE:
+            pipeline_recovery.delete(log_user_id)
+        elif log_type == LogType.UPDATE:
+            log_user_old = log["old_user_value"]
+            pipeline_recovery.set(log_user_id, msgpack.encode(UserValue(credit=log_user_old["credit"])))
+
+        pipeline_recovery.delete(log_entry["id"])
+
+
+def transaction_entity(log_list: list[dict]) -> str:
+    for log_entry in log_list:
+        if log_entry["log"]["user_id"] is not None:
+            return log_entry["log"]["user_id"]
+    return log_list[0]["log"]["id"]
+
+
+def recover_partition(partition: list[list[dict]]):
+    # Newest transactions first, so the oldest before-image of an entity is restored last
+    partition.sort(key=lambda log_list: log_list[0]["log"]["date_time"], reverse=True)
+    
+    pipeline_recovery = db.pipeline(transaction=False)
+    for log_list in partition:
+        recover_transaction(log_list, pipeline_recovery)
+        if len(pipeline_recovery) >= RECOVERY_BATCH_SIZE:
+            pipeline_recovery.execute()
+    pipeline_recovery.execute()
+    
+    publish_invalidation(*{transaction_entity(log_list) for log_list in partition})
+
+
+def recover_transactions(transactions: list[list[dict]]):
+    transactions = claim_transactions(transactions)
+    
+    # Transactions on the same entity always end up in the same partition, so they are rolled back in order
+    partitions: list[list[list[dict]]] = [[] for _ in range(RECOVERY_WORKERS)]
+    for log_list in transactions:
+        partitions[hash(transaction_entity(log_list)) % RECOVERY_WORKERS].append(log_list)
+    
+    with ThreadPoolExecutor(max_workers=RECOVERY_WORKERS) as executor:
+        list(executor.map(recover_partition, [partition for partition in partitions if partition]))
+
+
+def claim_transactions(transactions: list[list[dict]]) -> list[list[dict]]:
+    # Claim every transaction before rolling it back, so two recoveries never roll back the same transaction twice
+    claims = []
+    for start in range(0, len(transactions), RECOVERY_BATCH_SIZE):
+        pipeline_claim = db.pipeline(transaction=False)
+        for log_list in transactions[start:start + RECOVERY_BATCH_SIZE]:
+            pipeline_claim.set(f"recovery:claim:{log_list[0]['log']['id']}", WORKER_ID, nx=True, ex=RECOVERY_CLAIM_TTL)
+        claims.extend(pipeline_claim.execute())
+    
+    claimed = [log_list for log_list, claim in zip(transactions, claims) if claim]
+    if len(claimed) < len(transactions):
+        db.hincrby(RECOVERY_STATS_KEY, "duplicate_recoveries", len(transactions) - len(claimed))
+    return claimed
+
+
+def is_transaction_finished(log_list: list[dict]) -> bool:
+    last_log = log_list[-1]["log"]
+    return last_log["status"] in [LogStatus.SUCCESS, LogStatus.FAILURE] and last_log["type"] == LogType.SENT
+
+
+def run_incremental_recovery() -> int:
+    started = perf_counter()
+    now = datetime.now()
+    
+    # Only look at logs written since the last checkpoint (or the default window on the first run)
+    checkpoint = db.get(RECOVERY_CHECKPOINT_KEY)
+    checkpoint = checkpoint.decode('utf-8') if checkpoint else (now - timedelta(minutes=5)).strftime("%Y%m%d%H%M%S%f")
+    horizon = (now - timedelta(seconds=RECOVERY_GRACE)).strftime("%Y%m%d%H%M%S%f")
+    
+    logs = []
+    read_db = reader(stale_ok=True)
+    for log_keys in scan_log_keys(read_db=read_db):
+        logs.extend(fetch_logs(log_keys, LogFilters(since=checkpoint), read_db))
+    
+    # Add the logs of the transactions that were still open during the previous run
+    seen_keys = {log["id"] for log in logs}
+    open_keys = []
+    for encoded_keys in db.hvals(RECOVERY_OPEN_KEY):
+        open_keys.extend(key for key in msgpack.decode(encoded_keys, type=list[str]) if key not in seen_keys)
+    logs.extend(fetch_logs(open_keys, LogFilters(), read_db))
+    
+    still_open: dict[str, bytes] = {}
+    abandoned: list[list[dict]] = []
+    for log_id, log_list in sort_logs(logs).items():
+        if is_transaction_finished(log_list):
+            continue
+        
+        # Transactions that logged within the grace period might still be in flight
+        if max(log_key_timestamp(log_entry["id"]) for log_entry in log_list) > horizon:
+            still_open[log_id] = msgpack.encode([log_entry["id"] for log_entry in log_list])
+            continue
+        
+        abandoned.append(log_list)
+    
+    recover_transactions(abandoned)
+    recovered = len(abandoned)
+    
+    duration = perf_counter() - started
+    
+    # The background thread uses its own pipeline so it never interleaves with a request
+    pipeline_db = db.pipeline()
+    pipeline_db.delete(RECOVERY_OPEN_KEY)
+    if still_open:
+        pipeline_db.hset(RECOVERY_OPEN_KEY, mapping=still_open)
+    pipeline_db.set(RECOVERY_CHECKPOINT_KEY, horizon)
+    pipeline_db.hset(RECOVERY_STATS_KEY, mapping={
+        "checkpoint": horizon,
+        "last_run": now.strftime("%Y%m%d%H%M%S%f"),
+        "last_run_seconds": duration,
+        "last_run_logs": len(logs),
+        "last_run_recovered": recovered,
+        "open_transactions": len(still_open),
+        "logs_per_second": len(logs) / duration if duration > 0 else 0,
+    })
+    pipeline_db.hincrby(RECOVERY_STATS_KEY, "runs", 1)
+    pipeline_db.hincrby(RECOVERY_STATS_KEY, "total_logs", len(logs))
+    pipeline_db.hincrby(RECOVERY_STATS_KEY, "total_recovered", recovered)
+    pipeline_db.execute()
+    
+    return len(still_open)
+
+
+# Extends the lease only while this worker still holds it
+renew_recovery_lease = db.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+# Gives up the lease only while this worker still holds it
+release_recovery_lease = db.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def leadership_loop():
+    while not recovery_stop.is_set():
+        try:
+            if recovery_leader.is_set():
+                is_leader = renew_recovery_lease(keys=[RECOVERY_LEADER_KEY], args=[WORKER_ID, RECOVERY_LEASE * 1000])
+            else:
+                is_leader = db.set(RECOVERY_LEADER_KEY, WORKER_ID, nx=True, px=RECOVERY_LEASE * 1000)
+        except redis.exceptions.RedisError as exc:
+            app.logger.error(f"Renewing the recovery lease failed: {exc}")
+            is_leader = False
+        
+        if is_leader:
+            recovery_leader.set()
+        else:
+            recovery_leader.clear()
+        recovery_stop.wait(RECOVERY_LEASE / 3)
+
+
+def recovery_loop():
+    first_run = True
+    while not recovery_stop.is_set():
+        # Only the worker that holds the lease recovers, all workers serve requests right away
+        if not recovery_leader.wait(timeout=1):
+            continue
+        
+        try:
+            open_transactions = run_incremental_recovery()
+        except Exception as exc:
+            app.logger.error(f"Background recovery failed: {exc}")
+            recovery_stop.wait(RECOVERY_LEASE)
+            continue
+        
+        if first_run:
+            db.hset(RECOVERY_STATS_KEY, "cold_start_seconds", (datetime.now() - PROCESS_STARTED).total_seconds())
+            first_run = False
+        
+        # Come back sooner when transactions were still in flight during this run
+        recovery_stop.wait(min(RECOVERY_INTERVAL, RECOVERY_GRACE) if open_transactions else RECOVERY_INTERVAL)
+
 
-            log_type = log["type"]
-            log_user_id = log["user_id"]
-            if log_type == LogType.CREATE:
-                db.delete(log_user_id)
-            elif log_type == LogType.UPDATE:
-                # raise ValueError(f"HERE {log.keys()}")
-                log_user_old = log["old_user_value"]
-                db.set(log_user_id, msgpack.encode(UserValue(credit=log_user_old["credit"])))
+def stop_recovery():
+    recovery_stop.set()
+    if recovery_leader.is_set():
+        release_recovery_lease(keys=[RECOVERY_LEADER_KEY], args=[WORKER_ID])
 
-            db.delete(log_entry["id"])
+
+@app.get('/recovery/status')
+def recovery_status():
+    stats = {key.decode('utf-8'): value.decode('utf-8') for key, value in db.hgetall(RECOVERY_STATS_KEY).items()}
+    leader = db.get(RECOVERY_LEADER_KEY)
+    
+    # The lag is how far the checkpoint is behind the current time
+    checkpoint = stats.pop("checkpoint", None)
+    lag = (datetime.now() - datetime.strptime(checkpoint, "%Y%m%d%H%M%S%f")).total_seconds() if checkpoint else None
+    
+    return jsonify({
+        "checkpoint": checkpoint,
+        "lag_seconds": lag,
+        "interval_seconds": RECOVERY_INTERVAL,
+        "leader": leader.decode('utf-8') if leader else None,
+        "last_run": stats.pop("last_run", None),
+        **{key: float(value) for key, value in stats.items()},
+    }), 200
+
+
+@app.get('/ready')
+def readiness():
+    checkpoint = db.get(RECOVERY_CHECKPOINT_KEY)
+    lag = (datetime.now() - datetime.strptime(checkpoint.decode('utf-8'), "%Y%m%d%H%M%S%f")).total_seconds() if checkpoint else None
+    
+    # Ready once the recovery leader has caught up with the log
+    ready = lag is not None and lag <= RECOVERY_READY_LAG
+    return jsonify({"ready": ready, "lag_seconds": lag}), 200 if ready else 503
 
 
 if __name__ == '__main__':
@@ -515,4 +1632,16 @@ else:
     app.logger.setLevel(gunicorn_logger.level)
     
     # app.logger.setLevel(logging.DEBUG)
-    fix_fault_tolerance()
+    
+    # Recover in the background every RECOVERY_INTERVAL seconds, only in the worker that holds the recovery lease
+    recovery_stop = threading.Event()
+    recovery_leader = threading.Event()
+    atexit.register(stop_recovery)
+    threading.Thread(target=leadership_loop, name="recovery-leadership", daemon=True).start()
+    threading.Thread(target=recovery_loop, name="recovery", daemon=True).start()
+    threading.Thread(target=replica_monitor_loop, name="replica-monitor", daemon=True).start()
+    threading.Thread(target=hold_sweep_loop, name="hold-sweeper", daemon=True).start()
+    if saga_bus is not None:
+        threading.Thread(target=saga_bus.consume, args=(CHECKOUT_STREAM, handle_checkout_event, recovery_stop), name="saga-consumer", daemon=True).start()
+    if entity_cache is not None:
+        threading.Thread(target=cache_invalidation_loop, name="cache-invalidation", daemon=True).start()
@@ -0,0 +1,275 @@
+import os
+import uuid
+import httpx
+import redis
+import redis.asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from msgspec import msgpack, Raw
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Mount, Route
+
+# The Flask app still serves the log, recovery and benchmark endpoints and runs the background recovery
+from app import (
+    app as flask_app, UserValue, LogUserValue, LogType, LogStatus,
+    DB_ERROR_STR, REQ_ERROR_STR, GATEWAY_URL, REDIS_NODES, REDIS_REPLICA_NODES, REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT,
+    CACHE_CHANNEL, CATALOG_STREAM_KEY, CATALOG_STREAM_LENGTH, use_replica, entity_cache,
+    entity_etag, etag_matches, validator_headers,
+)
+from sharding import AsyncShardedRedis, async_redis_client
+
+
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 512))     # Per worker, shared by all in-flight requests
+
+db: redis.asyncio.Redis | AsyncShardedRedis = async_redis_client(
+    REDIS_NODES,
+    password=os.environ['REDIS_PASSWORD'],
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
+)
+replica_db: redis.asyncio.Redis | AsyncShardedRedis | None = async_redis_client(
+    REDIS_REPLICA_NODES,
+    password=os.environ['REDIS_PASSWORD'],
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
+) if REDIS_REPLICA_NODES else None
+
+
+def abort(status_code: int, detail: str):
+    raise HTTPException(status_code=status_code, detail=str(detail))
+
+
+def now() -> str:
+    return datetime.now().strftime("%Y%m%d%H%M%S%f")
+
+
+def reader(stale_ok: bool = False) -> redis.asyncio.Redis | AsyncShardedRedis:
+    # Same routing and read counts as the Flask app
+    return replica_db if use_replica(stale_ok) else db
+
+
+async def publish_invalidation(*keys: str):
+    # Same message as the Flask app, every worker drops its cached copy of the entity
+    if entity_cache is not None:
+        await db.publish(CACHE_CHANNEL, msgpack.encode((datetime.now().timestamp(), list(keys))))
+
+
+@asynccontextmanager
+async def lifespan(_app: Starlette):
+    global http_client
+    http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS))
+    yield
+    await http_client.aclose()
+    await db.aclose()
+    if replica_db is not None:
+        await replica_db.aclose()
+
+
+# Function to get an idempotent key from the ID service, the hash tag keeps the log on the shard of its entity
+async def get_key(hash_tag: str | None = None) -> str:
+    try:
+        response = await http_client.get(f"{GATEWAY_URL}/ids/create")
+    except httpx.HTTPError:
+        abort(400, REQ_ERROR_STR)
+    else:
+        return f"{response.text}{{{hash_tag}}}" if hash_tag else response.text
+
+
+async def get_user_from_db(user_id: str, log_id: str | None = None, stale_ok: bool = False) -> UserValue:
+    return (await get_tagged_user(user_id, log_id, stale_ok))[0]
+
+
+async def get_tagged_user(user_id: str, log_id: str | None = None, stale_ok: bool = False) -> tuple[UserValue, str]:
+    # Only reads that tolerate staleness are served from the cache of the Flask app in this worker
+    use_cache = stale_ok and entity_cache is not None
+    if use_cache:
+        cached: tuple[UserValue, str] | None = entity_cache.get_tagged(user_id)
+        if cached is not None:
+            return cached
+        generation = entity_cache.generation
+
+    try:
+        raw_entry: bytes = await reader(stale_ok and not use_cache).get(user_id)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+
+    if not raw_entry:
+        await abort_user_not_found(user_id, log_id)
+    entry: UserValue = msgpack.decode(raw_entry, type=UserValue)
+    etag = entity_etag(raw_entry)
+    if use_cache:
+        entity_cache.put(user_id, entry, len(raw_entry), generation, etag)
+    return entry, etag
+
+
+async def get_user_for_update(user_id: str, log_id: str | None = None) -> tuple[UserValue, Raw]:
+    # Same as the Flask app, the raw bytes read from the master are the before-image of the UPDATE log
+    try:
+        raw_entry: bytes = await reader().get(user_id)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+
+    if not raw_entry:
+        await abort_user_not_found(user_id, log_id)
+    return msgpack.decode(raw_entry, type=UserValue), Raw(raw_entry)
+
+
+async def abort_user_not_found(user_id: str, log_id: str | None = None):
+    log_key = await get_key(user_id)
+    error_payload = LogUserValue(
+        id=log_id if log_id else str(uuid.uuid4()),
+        type=LogType.SENT,
+        user_id=user_id,
+        status=LogStatus.FAILURE,
+        dateTime=now()
+    )
+    await db.set(log_key, msgpack.encode(error_payload))
+    abort(400, f"User: {user_id} not found! Log key: {log_key}")
+
+
+async def write_update(log_id: str, user_id: str, update_payload: LogUserValue, user_entry: UserValue) -> str:
+    # Set the log entry and the updated user in one transaction
+    log_key = await get_key(user_id)
+    pipeline_db = db.pipeline()
+    pipeline_db.set(log_key, msgpack.encode(update_payload))
+    pipeline_db.set(user_id, msgpack.encode(user_entry))
+    try:
+        await pipeline_db.execute()
+    except redis.exceptions.RedisError:
+        error_payload = LogUserValue(
+            id=log_id,
+            type=LogType.SENT,
+            user_id=user_id,
+            status=LogStatus.FAILURE,
+            dateTime=now()
+        )
+        await db.set(await get_key(user_id), msgpack.encode(error_payload))
+        return abort(400, DB_ERROR_STR)
+
+    await publish_invalidation(user_id)
+
+    # Create log entry for the sent response
+    sent_payload_to_user = LogUserValue(
+        id=log_id,
+        type=LogType.SENT,
+        user_id=user_id,
+        status=LogStatus.SUCCESS,
+        dateTime=now()
+    )
+    await db.set(await get_key(user_id), msgpack.encode(sent_payload_to_user))
+    return log_key
+
+########################################################################################################################
+#   START OF MICROSERVICE FUNCTIONS
+########################################################################################################################
+async def create_user(request: Request):
+    log_id = str(uuid.uuid4())
+
+    user_id = str(uuid.uuid4())
+    user_value = UserValue(credit=0)
+
+    # Create a log entry for the create request
+    create_payload = LogUserValue(
+        id=log_id,
+        type=LogType.CREATE,
+        user_id=user_id,
+        dateTime=now()
+    )
+    await write_update(log_id, user_id, create_payload, user_value)
+
+    # Feed the user filter of the order service, same entry as add_catalog_entry of the Flask app
+    try:
+        await db.xadd(CATALOG_STREAM_KEY, {"user": user_id}, maxlen=CATALOG_STREAM_LENGTH, approximate=True)
+    except redis.exceptions.RedisError:
+        pass    # The user is created, without its entry the order service asks the payment service about it
+
+    return JSONResponse({'user_id': user_id, 'log_id': log_id})
+
+
+async def find_user(request: Request):
+    user_id = request.path_params["user_id"]
+    user_entry, etag = await get_tagged_user(user_id, stale_ok=True)
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=validator_headers(etag))
+
+    return JSONResponse({"user_id": user_id, "credit": user_entry.credit}, headers=validator_headers(etag))
+
+
+async def add_credit(request: Request):
+    user_id, amount = request.path_params["user_id"], request.path_params["amount"]
+    log_id = str(uuid.uuid4())
+
+    # Get the user from the database, its stored bytes are kept for rollback purposes
+    user_entry, old_user_entry = await get_user_for_update(user_id)
+
+    user_entry.credit += int(amount)
+
+    # Create a log entry for the updated user
+    update_payload = LogUserValue(
+        id=log_id,
+        type=LogType.UPDATE,
+        user_id=user_id,
+        old_uservalue=old_user_entry,
+        dateTime=now()
+    )
+    log_key = await write_update(log_id, user_id, update_payload, user_entry)
+
+    return PlainTextResponse(f"User: {user_id} credit updated to: {user_entry.credit}, log_key: {log_key}")
+
+
+async def remove_credit(request: Request):
+    user_id, amount = request.path_params["user_id"], request.path_params["amount"]
+    log_id = str(uuid.uuid4())
+
+    # Get the user from the database, its stored bytes are kept for rollback purposes
+    user_entry, old_user_entry = await get_user_for_update(user_id)
+
+    user_entry.credit -= int(amount)
+
+    # Check if the user has enough credit
+    if user_entry.credit < 0:
+        sent_log = LogUserValue(
+            id=log_id,
+            type=LogType.SENT,
+            status=LogStatus.FAILURE,
+            old_uservalue=old_user_entry,
+            user_id=user_id,
+            dateTime=now()
+        )
+        log_key = await get_key(user_id)
+        await db.set(log_key, msgpack.encode(sent_log))
+
+        return abort(400, f"User: {user_id} credit cannot get reduced below zero! Log key: {log_key}")
+
+    # Create log entry for the updated user
+    update_payload = LogUserValue(
+        id=log_id,
+        type=LogType.UPDATE,
+        user_id=user_id,
+        old_uservalue=old_user_entry,
+        dateTime=now()
+    )
+    log_key = await write_update(log_id, user_id, update_payload, user_entry)
+
+    return PlainTextResponse(f"User: {user_id} credit updated to: {user_entry.credit}, log_key: {log_key}")
+
+
+app = Starlette(
+    routes=[
+        Route('/create_user', create_user, methods=["POST"]),
+        Route('/find_user/{user_id}', find_user, methods=["GET"]),
+        Route('/add_funds/{user_id}/{amount}', add_credit, methods=["POST"]),
+        Route('/pay/{user_id}/{amount}', remove_credit, methods=["POST"]),
+        # Every other endpoint is served by the Flask app
+        Mount('/', WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,220 @@
+"""Client-side sharding of a service database over several Redis nodes.
+
+Keys are placed on a consistent hash ring. Like in Redis Cluster, only the part of a key between the first `{` and
+the following `}` is hashed when it is present, so `log:<timestamp>{<entity id>}` lands on the same node as
+`<entity id>` and a pipeline that writes an entity together with its log stays a single MULTI/EXEC on one node.
+A pipeline that spans several nodes runs as one MULTI/EXEC per node.
+
+This file is the same in the order, stock and payment services on purpose, like saga.py: every service is built from
+its own directory, so each image carries its own copy. A change to one copy is made to all three.
+"""
+import bisect
+import hashlib
+from itertools import chain
+
+import redis
+import redis.asyncio
+
+
+RING_REPLICAS = 160     # Virtual nodes per Redis node, evens out the share of keys each node gets
+
+
+def parse_nodes(nodes: str) -> list[tuple[str, int]]:
+    # "host:port,host:port"
+    return [(host, int(port)) for host, port in (node.strip().rsplit(":", 1) for node in nodes.split(",") if node.strip())]
+
+
+def hash_slot_key(key: str | bytes) -> bytes:
+    key = key.encode('utf-8') if isinstance(key, str) else key
+    start = key.find(b"{")
+    if start != -1:
+        end = key.find(b"}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def ring_hash(value: bytes) -> int:
+    return int.from_bytes(hashlib.md5(value).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes: int, replicas: int = RING_REPLICAS):
+        points = sorted((ring_hash(f"{node}:{replica}".encode('utf-8')), node) for node in range(nodes) for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node(self, key: str | bytes) -> int:
+        index = bisect.bisect(self.hashes, ring_hash(hash_slot_key(key))) % len(self.hashes)
+        return self.nodes[index]
+
+
+class ShardedPipeline:
+    def __init__(self, sharded: "ShardedRedis", transaction: bool = True):
+        self.sharded = sharded
+        self.transaction = transaction
+        self.pipelines = {}
+        self.command_shards: list[int] = []
+
+    def shard_pipeline(self, shard: int):
+        if shard not in self.pipelines:
+            self.pipelines[shard] = self.sharded.clients[shard].pipeline(transaction=self.transaction)
+        return self.pipelines[shard]
+
+    def __getattr__(self, name: str):
+        def command(key, *args, **kwargs):
+            shard = self.sharded.ring.node(key)
+            getattr(self.shard_pipeline(shard), name)(key, *args, **kwargs)
+            self.command_shards.append(shard)
+            return self
+        return command
+
+    def __len__(self) -> int:
+        return len(self.command_shards)
+
+    def collect(self, shard_results: dict[int, list]) -> list:
+        # Put the replies of the nodes back in the order the commands were queued
+        positions = {shard: iter(results) for shard, results in shard_results.items()}
+        return [next(positions[shard]) for shard in self.command_shards]
+
+    def execute(self) -> list:
+        try:
+            return self.collect({shard: pipeline.execute() for shard, pipeline in sorted(self.pipelines.items())})
+        finally:
+            self.reset()
+
+    def reset(self):
+        for pipeline in self.pipelines.values():
+            pipeline.reset()
+        self.pipelines = {}
+        self.command_shards = []
+
+    discard = reset
+
+
+class ShardedScript:
+    def __init__(self, sharded: "ShardedRedis", script: str):
+        self.sharded = sharded
+        self.scripts = [client.register_script(script) for client in sharded.clients]
+
+    def __call__(self, keys: list, args: list | None = None, client=None):
+        # The first key picks the node, a script only touches keys of that node
+        args = args or []
+        shard = self.sharded.ring.node(keys[0])
+        if isinstance(client, ShardedPipeline):
+            self.scripts[shard](keys=keys, args=args, client=client.shard_pipeline(shard))
+            client.command_shards.append(shard)
+            return client
+        return self.scripts[shard](keys=keys, args=args, client=client)
+
+
+class ShardedRedis:
+    """Routes every single key command to the node of its key and fans the multi key commands out over all nodes."""
+
+    def __init__(self, clients: list[redis.Redis]):
+        self.clients = clients
+        self.ring = HashRing(len(clients))
+
+    def client_for(self, key: str | bytes) -> redis.Redis:
+        return self.clients[self.ring.node(key)]
+
+    def __getattr__(self, name: str):
+        def command(key, *args, **kwargs):
+            return getattr(self.client_for(key), name)(key, *args, **kwargs)
+        return command
+
+    def group_by_shard(self, keys) -> dict[int, list]:
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.ring.node(key), []).append(key)
+        return groups
+
+    def mget(self, keys, *args) -> list:
+        keys = list(keys) + list(args)
+        values = {}
+        for shard, shard_keys in self.group_by_shard(keys).items():
+            values.update(zip(shard_keys, self.clients[shard].mget(shard_keys)))
+        return [values[key] for key in keys]
+
+    def mset(self, mapping: dict) -> bool:
+        for shard, shard_keys in self.group_by_shard(mapping).items():
+            self.clients[shard].mset({key: mapping[key] for key in shard_keys})
+        return True
+
+    def keys(self, pattern="*") -> list:
+        return list(chain.from_iterable(client.keys(pattern) for client in self.clients))
+
+    def scan_iter(self, match=None, count=None, **kwargs):
+        return chain.from_iterable(client.scan_iter(match=match, count=count, **kwargs) for client in self.clients)
+
+    def scan(self, cursor=0, match=None, count=None, **kwargs) -> tuple[int, list]:
+        # The cursor encodes the node and the cursor on that node, 0 starts at the first node and ends after the last
+        shard, shard_cursor = cursor % len(self.clients), cursor // len(self.clients)
+        shard_cursor, keys = self.clients[shard].scan(cursor=shard_cursor, match=match, count=count, **kwargs)
+        if shard_cursor == 0:
+            shard += 1
+            if shard == len(self.clients):
+                return 0, keys
+        return shard_cursor * len(self.clients) + shard, keys
+
+    def pipeline(self, transaction: bool = True) -> ShardedPipeline:
+        return ShardedPipeline(self, transaction)
+
+    def register_script(self, script: str) -> ShardedScript:
+        return ShardedScript(self, script)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+
+class AsyncShardedPipeline(ShardedPipeline):
+    async def execute(self) -> list:
+        try:
+            return self.collect({shard: await pipeline.execute() for shard, pipeline in sorted(self.pipelines.items())})
+        finally:
+            await self.reset()
+
+    async def reset(self):
+        for pipeline in self.pipelines.values():
+            await pipeline.reset()
+        self.pipelines = {}
+        self.command_shards = []
+
+    discard = reset
+
+
+class AsyncShardedRedis(ShardedRedis):
+    """ShardedRedis for redis.asyncio clients, only the single key commands, pipelines and scripts are routed."""
+
+    def pipeline(self, transaction: bool = True) -> AsyncShardedPipeline:
+        return AsyncShardedPipeline(self, transaction)
+
+    async def aclose(self):
+        for client in self.clients:
+            await client.aclose()
+
+
+def node_clients(db: redis.Redis | ShardedRedis) -> list[redis.Redis]:
+    return db.clients if isinstance(db, ShardedRedis) else [db]
+
+
+def client_for(db: redis.Redis | ShardedRedis, key: str | bytes) -> redis.Redis:
+    return db.client_for(key) if isinstance(db, ShardedRedis) else db
+
+
+def redis_client(nodes: list[tuple[str, int]], **pool_kwargs) -> redis.Redis | ShardedRedis:
+    # Connections are handed out per command or pipeline, so threads and greenlets never share one
+    clients = [
+        redis.Redis(connection_pool=redis.BlockingConnectionPool(host=host, port=port, **pool_kwargs))
+        for host, port in nodes
+    ]
+    return clients[0] if len(clients) == 1 else ShardedRedis(clients)
+
+
+def async_redis_client(nodes: list[tuple[str, int]], **pool_kwargs) -> redis.asyncio.Redis | AsyncShardedRedis:
+    clients = [
+        redis.asyncio.Redis(connection_pool=redis.asyncio.BlockingConnectionPool(host=host, port=port, **pool_kwargs))
+        for host, port in nodes
+    ]
+    return clients[0] if len(clients) == 1 else AsyncShardedRedis(clients)
@@ -1,34 +1,112 @@
 import os
+import hashlib
 import logging
 import atexit
+import socket
+import threading
 import uuid
+import random
+import sys
 import requests
 from enum import Enum
 import redis
-from copy import deepcopy
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from ast import literal_eval
 
-from msgspec import msgpack, Struct
-from flask import Flask, jsonify, abort, Response, request
+from msgspec import msgpack, json, Struct, Raw, MsgspecError
+from flask import Flask, jsonify, abort, Response, request, stream_with_context
 from datetime import datetime, timedelta
+from time import perf_counter, time
 
-from redlock import RedLock
+from redlock import RedLock, RedLockError
+from werkzeug.exceptions import HTTPException
+
+from sharding import ShardedRedis, parse_nodes, redis_client, node_clients, client_for
+from partitions import Partitions, PartitionTimeout
+from saga import SagaBus, bus_client, CHECKOUT_STREAM
 
 
 DB_ERROR_STR = "DB error"
 REQ_ERROR_STR = "Requests error"
+LOG_PAGE_SIZE = 500
+LOG_PAGE_MAX = 10000
+RECOVERY_INTERVAL = int(os.environ.get("RECOVERY_INTERVAL", 300))   # Seconds between two background recovery runs
+RECOVERY_GRACE = int(os.environ.get("RECOVERY_GRACE", 60))          # Seconds before an unfinished transaction counts as abandoned
+RECOVERY_CHECKPOINT_KEY = "{recovery}:checkpoint"
+RECOVERY_OPEN_KEY = "{recovery}:open"
+RECOVERY_STATS_KEY = "{recovery}:stats"
+RECOVERY_LEADER_KEY = "recovery:leader"
+RECOVERY_LEASE = int(os.environ.get("RECOVERY_LEASE", 15))          # Seconds the recovery leader holds its lease without renewing it
+RECOVERY_CLAIM_TTL = 600                                            # Seconds a recovered transaction stays claimed
+RECOVERY_READY_LAG = int(os.environ.get("RECOVERY_READY_LAG", RECOVERY_INTERVAL + RECOVERY_GRACE + 2 * RECOVERY_LEASE))
+RECOVERY_WORKERS = int(os.environ.get("RECOVERY_WORKERS", 8))       # Threads that recover partitions of the backlog in parallel
+RECOVERY_BATCH_SIZE = 1000                                          # Redis commands sent per pipeline round trip
+FIND_MANY_MAX = 100000                                              # Ids accepted by one find_many request
+FIND_MANY_CHUNK = 500                                               # Ids read with one MGET
+SUBTRACT_MANY_MAX = 10000                                           # Groups accepted by one subtract_many request
+GROUP_COMMIT_WINDOW = float(os.environ.get("GROUP_COMMIT_WINDOW", 0))   # Seconds the stock changes of an item wait for others, 0 commits every change on its own
+GROUP_COMMIT_MAX_BATCH = 256                                        # Stock changes committed together at most
+STREAM_MIMETYPES = {"ndjson": "application/x-ndjson", "msgpack": "application/x-msgpack"}
 GATEWAY_URL = os.environ['GATEWAY_URL']
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 64))     # Per worker, covers its request threads and background threads
+REDIS_POOL_TIMEOUT = int(os.environ.get("REDIS_POOL_TIMEOUT", 10))           # Seconds a request waits for a free connection
+# "host:port,host:port" spreads the keys over several Redis nodes, defaults to the single REDIS_HOST
+REDIS_NODES = parse_nodes(os.environ.get("REDIS_NODES") or f"{os.environ['REDIS_HOST']}:{os.environ['REDIS_PORT']}")
+REDIS_REPLICA_NODES = parse_nodes(os.environ.get("REDIS_REPLICA_NODES", ""))   # One replica per node of REDIS_NODES, in the same order
+REDIS_READ_POLICY = os.environ.get("REDIS_READ_POLICY", "master")              # master, replica, or bounded: replica while it lags at most REDIS_MAX_STALENESS
+REDIS_MAX_STALENESS = float(os.environ.get("REDIS_MAX_STALENESS", 1))          # Seconds
+REPLICA_CHECK_INTERVAL = 0.5                                                   # Seconds between two heartbeats
+REPLICA_HEARTBEAT_KEY = "reads:heartbeat"
+READ_STATS_KEY = "reads:stats"
+ENTITY_CACHE_BYTES = int(os.environ.get("ENTITY_CACHE_BYTES", 0))   # Per worker memory for decoded entities, 0 disables the cache
+CACHE_ENTRY_OVERHEAD = 200                                         # Rough bytes of a cached entry besides its encoded value
+CACHE_HISTORY = 10000                                              # Recent invalidations remembered to reject racing fills
+CACHE_CHANNEL = "cache:invalidate"
+CATALOG_STREAM_KEY = "{catalog}:prices"                                 # Feed of item prices for the price table of the order service
+CATALOG_STREAM_LENGTH = int(os.environ.get("CATALOG_STREAM_LENGTH", 1000000))   # Approximate entries kept, readers behind the trimmed part start over
+CATALOG_PAGE_MAX = 10000
+RESERVATION_TTL = float(os.environ.get("RESERVATION_TTL", 30))                  # Seconds a reservation holds its stock unless it is confirmed
+RESERVATION_SWEEP_INTERVAL = float(os.environ.get("RESERVATION_SWEEP_INTERVAL", 1))
+RESERVATION_SWEEP_BATCH = 100
+RESERVATION_CLAIM_TIMEOUT = 30                                      # Seconds a claimed release is hidden from the other sweepers
+RESERVATION_TOMBSTONE_TTL = 3600                                    # Seconds a release of a hold that was not written yet is remembered
+RESERVATION_CONFIRMED_TTL = 3600                                    # Seconds a confirmed reservation answers a repeated confirm
+RESERVATION_EXPIRY_KEY = "{reservations}:expiry"                   # Sorted set of reservation ids scored by their deadline
+RESERVATION_RELEASING_KEY = "{reservations}:releasing"             # Sorted set of claimed releases scored by the end of their claim
+RESERVATION_ITEMS_KEY = "{reservations}:items"                     # Hash of reservation id to its Reservation
+RESERVATION_STATS_KEY = "{reservations}:stats"
+ESCROW_MAX_COUNTERS = 64                                            # Sub-counters one hot item can be split over
+ESCROW_REBALANCE_INTERVAL = float(os.environ.get("ESCROW_REBALANCE_INTERVAL", 1))
+ESCROW_ITEMS_KEY = "{escrow}:items"                                # Hash of the split item ids to their number of sub-counters
+STOCK_PARTITIONS = int(os.environ.get("STOCK_PARTITIONS", 0))       # Items served from the memory of their partition owner, 0 keeps them under RedLock
+SAGA_BUS = os.environ.get("SAGA_BUS", "")                           # host:port of the Redis node with the checkout streams, empty serves no saga events
+DELETED_PRICE = -1
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+PROCESS_STARTED = datetime.now()
 
 app = Flask("stock-service")
 
-db: redis.Redis = redis.Redis(
-    host=os.environ['REDIS_HOST'],
-    port=int(os.environ['REDIS_PORT']),
+db: redis.Redis | ShardedRedis = redis_client(
+    REDIS_NODES,
     password=os.environ['REDIS_PASSWORD'],
-    db=int(os.environ['REDIS_DB'])
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
 )
-pipeline_db = db.pipeline()
+# Reads that tolerate staleness can go to the replicas, see reader()
+replica_db: redis.Redis | ShardedRedis | None = redis_client(
+    REDIS_REPLICA_NODES,
+    password=os.environ['REDIS_PASSWORD'],
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
+) if REDIS_REPLICA_NODES else None
+# In partitioned mode every item is changed by the one worker that owns its partition, see partitions.py
+partitions: Partitions | None = Partitions(db, STOCK_PARTITIONS, WORKER_ID, app.logger) if STOCK_PARTITIONS else None
+# With SAGA_BUS the stock of the checkouts is held and settled on the events of the order service, see saga.py
+saga_bus: SagaBus | None = SagaBus(bus_client(SAGA_BUS, os.environ['REDIS_PASSWORD']), "stock", WORKER_ID, app.logger) if SAGA_BUS else None
 
 def close_db_connection():
     db.close()
@@ -37,9 +115,10 @@ def close_db_connection():
 atexit.register(close_db_connection)
 # atexit.register(lambda: scheduler.shutdown())
 
-class StockValue(Struct):
+class StockValue(Struct, omit_defaults=True):
     stock: int
     price: int
+    escrow: int = 0         # Number of sub-counters the stock is split over, stock is then only the part on the item
 
 
 class LogType(str, Enum):
@@ -61,29 +140,472 @@ class LogStockValue(Struct):
     type: LogType | None = None
     status: LogStatus | None = None
     stock_id: str | None = None
-    old_stockvalue: StockValue | None = None  
+    old_stockvalue: StockValue | Raw | None = None     # Written as the raw bytes read from Redis, always read back as a StockValue
+
+
+def get_item_from_db(item_id: str, log_id: str | None = None, stale_ok: bool = False) -> StockValue | None:
+    return get_tagged_item(item_id, log_id, stale_ok)[0]
+
+
+def get_tagged_item(item_id: str, log_id: str | None = None, stale_ok: bool = False) -> tuple[StockValue, str]:
+    # Only reads that tolerate staleness are served from the cache
+    use_cache = stale_ok and entity_cache is not None
+    if use_cache:
+        cached: tuple[StockValue, str] | None = entity_cache.get_tagged(item_id)
+        if cached is not None:
+            return cached
+        generation = entity_cache.generation
+    
+    # Cache misses read the master, a lagging replica could refill the cache with a value that was just invalidated
+    read_db = reader(stale_ok and not use_cache)
+    fill_generation = generation if use_cache else None
+    if stale_ok:
+        # Concurrent reads of the same item share one fetch, reads for an update never join a fetch that started earlier
+        tagged: tuple[StockValue, str] | None = read_flight.do(item_id, lambda: read_item(item_id, read_db, fill_generation, stale_ok))
+    else:
+        tagged: tuple[StockValue, str] | None = read_item(item_id, read_db, fill_generation, stale_ok)
+
+    if tagged is None:
+        return abort_item_not_found(item_id, log_id)
+    return tagged
 
 
-def get_item_from_db(item_id: str, log_id: str | None = None) -> StockValue | None:
+def get_item_for_update(item_id: str, log_id: str | None = None) -> tuple[StockValue, Raw]:
+    # The raw bytes read from the master are the before-image of the UPDATE log, no copy of the item is made or encoded
     try:
-        entry: bytes = db.get(item_id)
+        raw_entry: bytes = reader().get(item_id)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
+    
+    if not raw_entry:
+        return abort_item_not_found(item_id, log_id)
+    return msgpack.decode(raw_entry, type=StockValue), Raw(raw_entry)
 
-    entry: StockValue | None = msgpack.decode(entry, type=StockValue) if entry else None
 
-    if entry is None:
-        log_key = get_key()
-        error_payload = LogStockValue(
-            id=log_id if log_id else str(uuid.uuid4()),
-            type=LogType.SENT,
-            stock_id=item_id,
-            status=LogStatus.FAILURE,
-            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
-        )
-        db.set(log_key, msgpack.encode(error_payload))
-        return abort(400, f"Item: {item_id} not found! Log key: {log_key}")
-    return entry
+def abort_item_not_found(item_id: str, log_id: str | None = None):
+    log_key = get_key(item_id)
+    error_payload = LogStockValue(
+        id=log_id if log_id else str(uuid.uuid4()),
+        type=LogType.SENT,
+        stock_id=item_id,
+        status=LogStatus.FAILURE,
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+    )
+    db.set(log_key, msgpack.encode(error_payload))
+    return abort(400, f"Item: {item_id} not found! Log key: {log_key}")
+
+
+def read_item(item_id: str, read_db: redis.Redis | ShardedRedis, generation: int | None = None, with_escrow: bool = False) -> tuple[StockValue, str] | None:
+    try:
+        raw_entry: bytes = read_db.get(item_id)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    
+    if not raw_entry:
+        return None
+    entry: StockValue = msgpack.decode(raw_entry, type=StockValue)
+    etag = entity_etag(raw_entry)
+    if with_escrow and entry.escrow:
+        # Reads that tolerate staleness see the stock of a split item as the sum of its counters, every counter change
+        # invalidates the cached sum. The counters are not in the stored bytes of the item, so the sum is hashed with them
+        entry.stock += escrow_stock(read_db, item_id, entry.escrow)
+        etag = entity_etag(raw_entry + msgpack.encode(entry.stock))
+    if generation is not None:
+        entity_cache.put(item_id, entry, len(raw_entry), generation, etag)
+    return entry, etag
+
+########################################################################################################################
+#   START OF READ ROUTING FUNCTIONS
+########################################################################################################################
+read_counts: Counter = Counter()
+read_counts_lock = threading.Lock()
+replica_staleness: float | None = None
+
+
+def use_replica(stale_ok: bool) -> bool:
+    # Reads that need read-your-writes always go to the master
+    replica = stale_ok and bool(REDIS_REPLICA_NODES) and (
+        REDIS_READ_POLICY == "replica"
+        or (REDIS_READ_POLICY == "bounded" and replica_staleness is not None and replica_staleness <= REDIS_MAX_STALENESS)
+    )
+    with read_counts_lock:
+        read_counts["replica" if replica else "master"] += 1
+    return replica
+
+
+def reader(stale_ok: bool = False) -> redis.Redis | ShardedRedis:
+    return replica_db if use_replica(stale_ok) else db
+
+
+def measure_replica_staleness() -> float | None:
+    # Every master gets a heartbeat with the current time, its replica is as stale as the heartbeat it has seen
+    now = datetime.now().timestamp()
+    for node in node_clients(db):
+        node.set(REPLICA_HEARTBEAT_KEY, now)
+    
+    staleness = 0.0
+    for node in node_clients(replica_db):
+        heartbeat = node.get(REPLICA_HEARTBEAT_KEY)
+        if heartbeat is None:
+            return None
+        staleness = max(staleness, datetime.now().timestamp() - float(heartbeat))
+    return staleness
+
+
+def replica_monitor_loop():
+    global replica_staleness
+    while not recovery_stop.wait(REPLICA_CHECK_INTERVAL):
+        try:
+            if replica_db is not None:
+                replica_staleness = measure_replica_staleness()
+            
+            # Share the read counts of this worker with the other workers
+            with read_counts_lock:
+                counts = dict(read_counts)
+                read_counts.clear()
+            if counts:
+                pipeline_db = db.pipeline(transaction=False)
+                for target, count in counts.items():
+                    pipeline_db.hincrby(READ_STATS_KEY, target, count)
+                pipeline_db.execute()
+        except redis.exceptions.RedisError as exc:
+            replica_staleness = None
+            app.logger.error(f"Checking the replicas failed: {exc}")
+
+
+@app.get('/reads/status')
+def reads_status():
+    stats = {key.decode('utf-8'): int(value) for key, value in db.hgetall(READ_STATS_KEY).items()}
+    total = sum(stats.values())
+    return jsonify({
+        "policy": REDIS_READ_POLICY,
+        "replicas": len(REDIS_REPLICA_NODES),
+        "max_staleness_seconds": REDIS_MAX_STALENESS,
+        "replica_staleness_seconds": replica_staleness,
+        "reads_master": stats.get("master", 0),
+        "reads_replica": stats.get("replica", 0),
+        "replica_share": stats.get("replica", 0) / total if total else 0.0,
+    }), 200
+
+########################################################################################################################
+#   START OF COALESCING FUNCTIONS
+########################################################################################################################
+class FlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    """Lets concurrent calls with the same key wait for the call that is already in flight and share its result."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: dict[str, FlightCall] = {}
+        self.stats: Counter = Counter()
+
+    def count(self, collapsed: bool):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["collapsed"] += collapsed
+
+    def do(self, key: str, fetch):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = FlightCall()
+            self.stats["requests"] += 1
+            self.stats["collapsed"] += not leader
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fetch()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+read_flight = SingleFlight()      # Concurrent reads of an item that tolerate staleness
+
+
+class StockChange:
+    def __init__(self, change: int):
+        self.change = change
+        self.done = threading.Event()
+        self.accepted = False
+        self.stock = 0
+        self.log_id = ""
+        self.log_key = ""
+        self.error: BaseException | None = None
+
+
+class CommitBatch:
+    def __init__(self):
+        self.changes: list[StockChange] = []
+        self.full = threading.Event()
+
+
+class GroupCommit:
+    """Collects the concurrent stock changes of an item for a short window and commits them with one update."""
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.batches: dict[str, CommitBatch] = {}
+        self.stats: Counter = Counter()
+
+    def count(self, size: int):
+        with self.lock:
+            self.stats["requests"] += size
+            self.stats["batches"] += 1
+            self.stats["largest"] = max(self.stats["largest"], size)
+
+    def submit(self, key: str, change: int, commit) -> StockChange:
+        entry = StockChange(change)
+        with self.lock:
+            batch = self.batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.batches[key] = CommitBatch()
+            batch.changes.append(entry)
+            if len(batch.changes) >= self.max_batch:
+                # Later changes start the next batch, which commits after this one under the lock of the item
+                del self.batches[key]
+                batch.full.set()
+        
+        if not leader:
+            entry.done.wait()
+        else:
+            batch.full.wait(self.window)
+            with self.lock:
+                if self.batches.get(key) is batch:
+                    del self.batches[key]
+            self.count(len(batch.changes))
+            try:
+                commit(key, batch.changes)
+            except BaseException as exc:
+                for batch_entry in batch.changes:
+                    batch_entry.error = exc
+            finally:
+                for batch_entry in batch.changes:
+                    batch_entry.done.set()
+        
+        if entry.error is not None:
+            raise entry.error
+        return entry
+
+
+# Concurrent adds and subtracts of an item, only with GROUP_COMMIT_WINDOW
+stock_commits: GroupCommit | None = GroupCommit(GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX_BATCH) if GROUP_COMMIT_WINDOW > 0 else None
+
+
+@app.get('/coalescing/status')
+def coalescing_status():
+    status = {"worker": WORKER_ID}
+    for name, flight in (("reads", read_flight),):
+        with flight.lock:
+            status[name] = {
+                "requests": flight.stats["requests"],
+                "collapsed": flight.stats["collapsed"],
+                "in_flight": len(flight.calls),
+            }
+    if stock_commits is not None:
+        with stock_commits.lock:
+            status["commits"] = {
+                "window_seconds": stock_commits.window,
+                "requests": stock_commits.stats["requests"],
+                "batches": stock_commits.stats["batches"],
+                "largest": stock_commits.stats["largest"],
+                "collecting": len(stock_commits.batches),
+            }
+    return jsonify(status), 200
+
+########################################################################################################################
+#   START OF CACHE FUNCTIONS
+########################################################################################################################
+class EntityCache:
+    """LRU cache of decoded entities, bounded by the size of their encoded values."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, tuple[Struct, int, str]] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # Every invalidation bumps the generation, a fill that started before an invalidation of its key is dropped
+        self.generation = 0
+        self.invalidated: OrderedDict[str, int] = OrderedDict()
+        self.invalidated_floor = 0
+        self.stats: Counter = Counter()
+        self.staleness_total = 0.0
+        self.staleness_max = 0.0
+
+    def get(self, key: str) -> Struct | None:
+        tagged = self.get_tagged(key)
+        return tagged[0] if tagged is not None else None
+
+    def get_tagged(self, key: str) -> tuple[Struct, str] | None:
+        # The entity with the ETag it was stored with
+        with self.lock:
+            entry = self.entries.get(key)
+            self.stats["hits" if entry is not None else "misses"] += 1
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0], entry[2]
+
+    def put(self, key: str, value: Struct, encoded_size: int, generation: int, etag: str):
+        size = encoded_size + CACHE_ENTRY_OVERHEAD
+        with self.lock:
+            if self.invalidated.get(key, self.invalidated_floor) > generation or size > self.max_bytes:
+                return
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size, etag)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.stats["evictions"] += 1
+
+    def invalidate(self, keys: list[str], published_at: float):
+        with self.lock:
+            self.generation += 1
+            if not keys:
+                self.entries.clear()
+                self.size = 0
+                self.invalidated.clear()
+                self.invalidated_floor = self.generation
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.size -= entry[1]
+                self.invalidated[key] = self.generation
+                self.invalidated.move_to_end(key)
+            while len(self.invalidated) > CACHE_HISTORY:
+                self.invalidated_floor = self.invalidated.popitem(last=False)[1]
+            
+            # The staleness is how long a cached copy could outlive the write that replaced it
+            staleness = max(datetime.now().timestamp() - published_at, 0.0)
+            self.stats["invalidations"] += 1
+            self.staleness_total += staleness
+            self.staleness_max = max(self.staleness_max, staleness)
+
+    def clear(self):
+        self.invalidate([], datetime.now().timestamp())
+
+
+entity_cache: EntityCache | None = EntityCache(ENTITY_CACHE_BYTES) if ENTITY_CACHE_BYTES else None
+
+
+def publish_invalidation(*keys: str):
+    # Without keys every cached entity is dropped
+    if entity_cache is not None:
+        db.publish(CACHE_CHANNEL, msgpack.encode((datetime.now().timestamp(), list(keys))))
+
+
+def cache_invalidation_loop():
+    while not recovery_stop.is_set():
+        pubsub = client_for(db, CACHE_CHANNEL).pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(CACHE_CHANNEL)
+            # Invalidations published while not subscribed are lost, so start over from an empty cache
+            entity_cache.clear()
+            while not recovery_stop.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    published_at, keys = msgpack.decode(message["data"])
+                    entity_cache.invalidate(keys, published_at)
+        except redis.exceptions.RedisError as exc:
+            app.logger.error(f"Cache invalidation subscription failed: {exc}")
+            entity_cache.clear()
+            recovery_stop.wait(1)
+        finally:
+            pubsub.close()
+
+
+@app.get('/cache/status')
+def cache_status():
+    if entity_cache is None:
+        return jsonify({"enabled": False}), 200
+    
+    with entity_cache.lock:
+        stats = dict(entity_cache.stats)
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        invalidations = stats.get("invalidations", 0)
+        return jsonify({
+            "enabled": True,
+            "worker": WORKER_ID,
+            "entries": len(entity_cache.entries),
+            "bytes": entity_cache.size,
+            "max_bytes": entity_cache.max_bytes,
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),
+            "hit_ratio": stats.get("hits", 0) / lookups if lookups else 0.0,
+            "evictions": stats.get("evictions", 0),
+            "invalidations": invalidations,
+            "staleness_avg_seconds": entity_cache.staleness_total / invalidations if invalidations else 0.0,
+            "staleness_max_seconds": entity_cache.staleness_max,
+        }), 200
+
+def entity_etag(raw_entry: bytes) -> str:
+    # Every write that changes the entity changes its stored bytes, the digest is taken once per read from Redis and kept
+    # with the cached entity
+    return hashlib.blake2b(raw_entry, digest_size=8).hexdigest()
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # If-None-Match compares weakly, W/"x" matches "x"
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/").strip('"') for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def validator_headers(etag: str, max_age: int = 0) -> dict[str, str]:
+    # Clients and the gateway revalidate with If-None-Match, only immutable entities may be reused without asking
+    return {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={max_age}, immutable" if max_age else "no-cache",
+    }
+
+########################################################################################################################
+#   START OF CATALOG FUNCTIONS
+########################################################################################################################
+def add_catalog_entry(client: redis.Redis | redis.client.Pipeline, item_id: str, price: int):
+    # Every created or deleted item is appended to the price feed, deleted items get a negative price
+    client.xadd(CATALOG_STREAM_KEY, {"item": item_id, "price": price}, maxlen=CATALOG_STREAM_LENGTH, approximate=True)
+
+
+@app.get('/catalog')
+def price_catalog_feed():
+    since = request.args.get("since", "0")
+    count = min(int(request.args.get("count", CATALOG_PAGE_MAX)), CATALOG_PAGE_MAX)
+    try:
+        # A position that is no longer in the feed was trimmed or flushed, so the reader has to start over
+        reset = since != "0" and not db.xrange(CATALOG_STREAM_KEY, since, since)
+        entries = db.xrange(CATALOG_STREAM_KEY, "-" if reset else f"({since}", count=count)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    
+    last_id = entries[-1][0].decode('utf-8') if entries else ("0" if reset else since)
+    return jsonify({
+        "reset": reset,
+        "last_id": last_id,
+        "prices": [[fields[b"item"].decode('utf-8'), int(fields[b"price"])] for _, fields in entries],
+    }), 200
 
 ########################################################################################################################
 #   START OF LOG FUNCTIONS
@@ -96,7 +618,8 @@ def format_log_entry(log_entry: LogStockValue) -> dict:
         "stock_id": log_entry.stock_id,
         "old_stock_value": {
             "stock": log_entry.old_stockvalue.stock if log_entry.old_stockvalue else None,
-            "price": log_entry.old_stockvalue.price if log_entry.old_stockvalue else None
+            "price": log_entry.old_stockvalue.price if log_entry.old_stockvalue else None,
+            "escrow": log_entry.old_stockvalue.escrow if log_entry.old_stockvalue else None
         },
         "date_time": log_entry.dateTime
     }
@@ -113,9 +636,88 @@ def sort_logs(logs: list[dict]):
     return log_dict
 
 
+class LogFilters(Struct):
+    type: str | None = None
+    status: str | None = None
+    stock_id: str | None = None
+    since: str | None = None
+    until: str | None = None
+
+
+def log_key_timestamp(log_key: str) -> str:
+    # Log keys look like "log:<YYYYmmddHHMMSSffffff><counter>", followed by a hash tag that can contain colons itself
+    return log_key[len("log:"):len("log:") + 20]
+
+
+def parse_log_filters() -> LogFilters:
+    since = request.args.get("since")
+    until = request.args.get("until")
+    return LogFilters(
+        type=request.args.get("type"),
+        status=request.args.get("status"),
+        stock_id=request.args.get("stock_id"),
+        # Allow prefixes such as "20240601" or "2024060112" for the time range
+        since=since.ljust(20, "0") if since else None,
+        until=until.ljust(20, "9") if until else None,
+    )
+
+
+def log_matches_filters(log: dict, filters: LogFilters) -> bool:
+    if filters.type is not None and log["type"] != filters.type:
+        return False
+    if filters.status is not None and log["status"] != filters.status:
+        return False
+    if filters.stock_id is not None and log["stock_id"] != filters.stock_id:
+        return False
+    return True
+
+
+def log_key_in_range(log_key: str, filters: LogFilters) -> bool:
+    timestamp_str = log_key_timestamp(log_key)
+    if filters.since is not None and timestamp_str < filters.since:
+        return False
+    if filters.until is not None and timestamp_str > filters.until:
+        return False
+    return True
+
+
+def scan_log_keys(batch_size: int = LOG_PAGE_SIZE, read_db: redis.Redis | ShardedRedis | None = None):
+    # Walk the log keys with SCAN so the whole keyspace is never loaded at once
+    batch: list[str] = []
+    for key in (read_db or db).scan_iter(match="log:*", count=batch_size):
+        batch.append(key.decode('utf-8'))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def fetch_logs(log_keys: list[str], filters: LogFilters, read_db: redis.Redis | ShardedRedis | None = None) -> list[dict]:
+    # Filter on the timestamp embedded in the key before fetching anything
+    log_keys = [key for key in log_keys if log_key_in_range(key, filters)]
+    if not log_keys:
+        return []
+
+    logs = []
+    for key, raw_data in zip(log_keys, (read_db or db).mget(log_keys)):
+        if not raw_data:
+            continue
+        log = format_log_entry(msgpack.decode(raw_data, type=LogStockValue))
+        if log_matches_filters(log, filters):
+            logs.append({"id": key, "log": log})
+    return logs
+
+
+def encode_stream_chunk(records: list, stream_format: str) -> bytes:
+    if stream_format == "msgpack":
+        return b"".join(msgpack.encode(record) for record in records)
+    return b"".join(json.encode(record) + b"\n" for record in records)
+
+
 def get_log_from_db(log_id: str) -> LogStockValue | None:
     try:
-        entry: bytes = db.get(log_id)
+        entry: bytes = reader(stale_ok=True).get(log_id)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
     
@@ -127,7 +729,7 @@ def get_log_from_db(log_id: str) -> LogStockValue | None:
 
 @app.get('/log_count')
 def get_log_count():
-    return Response(str(len(db.keys("log:*"))), status=200)
+    return Response(str(len(reader(stale_ok=True).keys("log:*"))), status=200)
 
 
 @app.get('/log/<log_id>')
@@ -141,10 +743,11 @@ def find_log(log_id: str):
 def find_all_logs():
     try:
         # Retrieve all keys starting with "log:" from Redis
-        log_keys = [key.decode('utf-8') for key in db.keys("log:*")]
+        read_db = reader(stale_ok=True)
+        log_keys = [key.decode('utf-8') for key in read_db.keys("log:*")]
 
         # Retrieve values corresponding to the keys
-        logs = [{"p_key": key, "log": format_log_entry(msgpack.decode(db.get(key), type=LogStockValue))} for key in log_keys]
+        logs = [{"p_key": key, "log": format_log_entry(msgpack.decode(read_db.get(key), type=LogStockValue))} for key in log_keys]
 
         return jsonify({'logs': logs}), 200
     except redis.exceptions.RedisError:
@@ -156,30 +759,15 @@ def find_all_logs_time(time: datetime, min_diff: int = 5):
         # Calculate the range
         lower_bound: datetime = time - timedelta(minutes=min_diff)
         upper_bound: datetime = time
+        filters = LogFilters(
+            since=lower_bound.strftime("%Y%m%d%H%M%S%f"),
+            until=upper_bound.strftime("%Y%m%d%H%M%S%f"),
+        )
 
-        # Create a broad pattern to fetch all potential keys
-        broad_pattern = "log:*"
-        
-        # Retrieve all keys matching the broad pattern
-        potential_keys = [key.decode('utf-8') for key in db.keys(broad_pattern)]
-
-        # Filter keys based on the timestamp
+        # Fetch the logs within the range batch by batch
         logs = []
-        for key in potential_keys:
-            timestamp_str = key.split(":")[-1][:20]
-            key_timestamp: datetime = datetime.strptime(timestamp_str, "%Y%m%d%H%M%S%f")
-            
-            if lower_bound > key_timestamp or upper_bound < key_timestamp:
-                continue
-            
-            raw_data = db.get(key)
-            
-            if not raw_data:
-                continue
-            
-            # Decode the raw data into a LogUserValue object
-            log_entry = msgpack.decode(raw_data, type=LogStockValue)
-            logs.append({"id": key, "log": format_log_entry(log_entry)})
+        for log_keys in scan_log_keys():
+            logs.extend(fetch_logs(log_keys, filters))
 
         return logs
     except redis.exceptions.RedisError:
@@ -194,6 +782,40 @@ def find_sorted_logs(min_diff: int):
     
     return jsonify(sorted_logs), 200
 
+@app.get('/logs/page')
+def find_logs_page():
+    cursor = int(request.args.get("cursor", 0))
+    count = min(int(request.args.get("count", LOG_PAGE_SIZE)), LOG_PAGE_MAX)
+    filters = parse_log_filters()
+
+    try:
+        read_db = reader(stale_ok=True)
+        next_cursor, log_keys = read_db.scan(cursor=cursor, match="log:*", count=count)
+        logs = fetch_logs([key.decode('utf-8') for key in log_keys], filters, read_db)
+    except redis.exceptions.RedisError:
+        return abort(500, 'Failed to retrieve logs from the database')
+
+    # A returned cursor of 0 means that the whole log has been walked
+    return jsonify({"logs": logs, "cursor": next_cursor}), 200
+
+
+@app.get('/logs/stream')
+def stream_logs():
+    stream_format = request.args.get("format", "ndjson")
+    if stream_format not in STREAM_MIMETYPES:
+        return abort(400, f"Unknown stream format: {stream_format}")
+    filters = parse_log_filters()
+
+    read_db = reader(stale_ok=True)
+    
+    def generate():
+        for log_keys in scan_log_keys(read_db=read_db):
+            chunk = encode_stream_chunk(fetch_logs(log_keys, filters, read_db), stream_format)
+            if chunk:
+                yield chunk
+
+    return Response(stream_with_context(generate()), mimetype=STREAM_MIMETYPES[stream_format])
+
 
 @app.post('/log/create')
 def create_log():
@@ -201,7 +823,8 @@ def create_log():
     dict_log_entry = literal_eval(str_dict_log_entry)
     log_entry = LogStockValue(**dict_log_entry)
     
-    log_key = get_key()
+    # Keyed like the logs of the service itself, on the node of its entity
+    log_key = get_key(log_entry.stock_id)
     db.set(log_key, msgpack.encode(log_entry))
     
     return jsonify({"msg": "Log entry created", "log_key": log_key}), 200
@@ -214,8 +837,11 @@ def create_item_benchmark(price: int):
     item_id = str(uuid.uuid4())
     stock_value = StockValue(stock=0, price=int(price))
     
+    pipeline_db = db.pipeline()
+    pipeline_db.set(item_id, msgpack.encode(stock_value))
+    add_catalog_entry(pipeline_db, item_id, stock_value.price)
     try:
-        db.set(item_id, msgpack.encode(stock_value))
+        pipeline_db.execute()
     except redis.exceptions.RedisError:        
         return abort(400, DB_ERROR_STR)
 
@@ -224,7 +850,7 @@ def create_item_benchmark(price: int):
 
 @app.get('/find/<item_id>/benchmark')
 def find_item_benchmark(item_id: str):
-    entry: bytes = db.get(item_id)
+    entry: bytes = reader(stale_ok=True).get(item_id)
     item_entry: StockValue | None = msgpack.decode(entry, type=StockValue) if entry else None
 
     if item_entry is None:
@@ -242,6 +868,8 @@ def add_stock_benchmark(item_id: str, amount: int):
     except redis.exceptions.RedisError:        
         return abort(400, DB_ERROR_STR)
 
+    publish_invalidation(item_id)
+
     return jsonify({"stock": item_entry.stock}), 200
 
 @app.post('/subtract/<item_id>/<amount>/benchmark')
@@ -257,6 +885,8 @@ def remove_stock_benchmark(item_id: str, amount: int):
     except redis.exceptions.RedisError:        
         return abort(400, DB_ERROR_STR)
 
+    publish_invalidation(item_id)
+
     return jsonify({"stock": item_entry.stock}), 200
 
 ########################################################################################################################
@@ -281,9 +911,11 @@ def create_item(price: int):
     )
 
     # Set the log entry and the updated item in the pipeline
-    log_key = get_key()
+    log_key = get_key(item_id)
+    pipeline_db = db.pipeline()
     pipeline_db.set(log_key, msgpack.encode(create_payload))
     pipeline_db.set(item_id, msgpack.encode(stock_value))
+    add_catalog_entry(pipeline_db, item_id, stock_value.price)
     try:
         pipeline_db.execute()
     except redis.exceptions.RedisError:
@@ -294,7 +926,7 @@ def create_item(price: int):
             status=LogStatus.FAILURE,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
         )
-        db.set(get_key(), msgpack.encode(error_payload))
+        db.set(get_key(item_id), msgpack.encode(error_payload))
         
         pipeline_db.discard()
         
@@ -308,7 +940,7 @@ def create_item(price: int):
         status=LogStatus.SUCCESS,
         dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
     )
-    db.set(get_key(), msgpack.encode(sent_payload_to_user))
+    db.set(get_key(item_id), msgpack.encode(sent_payload_to_user))
 
     return jsonify({'item_id': item_id, 'log_id': log_id}), 200
 
@@ -317,21 +949,94 @@ def create_item(price: int):
 def find_item(item_id: str):
     log_id = str(uuid.uuid4())
 
-    item_entry: StockValue = get_item_from_db(item_id, log_id)
+    if partitions is not None:
+        found, *reply = call_partition(item_id, "find")
+        if not found:
+            return abort(400, reply[0])
+        item_entry = StockValue(stock=reply[0], price=reply[1])
+        etag = entity_etag(msgpack.encode(reply))
+    else:
+        # The log id is only logged for items that are not found
+        item_entry, etag = get_tagged_item(item_id, log_id, stale_ok=True)
+
+    headers = validator_headers(etag)
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status=304, headers=headers)
+
+    return jsonify({"stock": item_entry.stock, "price": item_entry.price}), 200, headers
+
+
+@app.post('/find_many')
+def find_many_items():
+    # The body is a JSON list of item ids, the entries are streamed in the order of the ids, one MGET per chunk
+    stream_format = request.args.get("format", "ndjson")
+    if stream_format not in STREAM_MIMETYPES:
+        return abort(400, f"Unknown stream format: {stream_format}")
+    try:
+        item_ids: list[str] = json.decode(request.get_data(), type=list[str])
+    except MsgspecError:
+        return abort(400, "Expected a JSON list of item ids")
+    if len(item_ids) > FIND_MANY_MAX:
+        return abort(400, f"At most {FIND_MANY_MAX} item ids per request")
+    
+    read_db = reader(stale_ok=True)
+    decoder = msgpack.Decoder(StockValue)
+    
+    def generate():
+        for start in range(0, len(item_ids), FIND_MANY_CHUNK):
+            chunk_ids = item_ids[start:start + FIND_MANY_CHUNK]
+            try:
+                entries: list[bytes | None] = read_db.mget(chunk_ids)
+            except redis.exceptions.RedisError:
+                # The status line is already sent, so the failure is reported per entry
+                yield encode_stream_chunk([{"item_id": item_id, "found": False, "error": DB_ERROR_STR} for item_id in chunk_ids], stream_format)
+                continue
+            # Missing ids are only reported, unlike a single find they do not write a failure log
+            records = []
+            for item_id, entry in zip(chunk_ids, entries):
+                item_entry: StockValue | None = decoder.decode(entry) if entry else None
+                if item_entry is not None and item_entry.escrow:
+                    item_entry.stock += escrow_stock(read_db, item_id, item_entry.escrow)
+                records.append(item_record(item_id, item_entry))
+            yield encode_stream_chunk(records, stream_format)
+    
+    return Response(stream_with_context(generate()), mimetype=STREAM_MIMETYPES[stream_format])
 
-    return jsonify({"stock": item_entry.stock, "price": item_entry.price, "log_id": log_id}), 200
+
+def call_partition(item_id: str, op: str, *args) -> list:
+    try:
+        return partitions.call(item_id, op, *args)
+    except (PartitionTimeout, redis.exceptions.RedisError) as exc:
+        return abort(400, str(exc))
+
+
+def partition_update(item_id: str, op: str, amount: int):
+    success, reply = call_partition(item_id, op, int(amount))
+    if not success:
+        return abort(400, reply)
+    return Response(f"Item: {item_id} stock updated to: {reply}", status=200)
+
+
+def item_record(item_id: str, entry: StockValue | None) -> dict:
+    if entry is None:
+        return {"item_id": item_id, "found": False}
+    return {"item_id": item_id, "found": True, "stock": entry.stock, "price": entry.price}
 
 
 @app.post('/add/<item_id>/<amount>')
 def add_stock(item_id: str, amount: int):
     log_id = str(uuid.uuid4())
+    
+    if partitions is not None:
+        return partition_update(item_id, "add", amount)
+    if stock_commits is not None:
+        return committed_change(item_id, stock_commits.submit(item_id, int(amount), commit_stock_changes))
 
     # Use RedLock to prevent dirty reads
-    with RedLock(f"{item_id}-lock", connection_details=[db.connection_pool.connection_kwargs], retry_times=20, retry_delay=100):
+    with RedLock(f"{item_id}-lock", connection_details=[client_for(db, item_id).connection_pool.connection_kwargs], retry_times=20, retry_delay=100):
         
-        # Get the item from the database and create a copy of it for the rollback purposes
-        item_entry: StockValue = get_item_from_db(item_id)
-        old_item_entry: StockValue = deepcopy(item_entry)
+        # Get the item from the database, its stored bytes are kept for the rollback purposes
+        item_entry, old_item_entry = get_item_for_update(item_id)
         
         # Update the stock locally
         item_entry.stock += int(amount)
@@ -346,7 +1051,8 @@ def add_stock(item_id: str, amount: int):
         )
 
         # Set the log entry and the updated item in the pipeline
-        log_key = get_key()
+        log_key = get_key(item_id)
+        pipeline_db = db.pipeline()
         pipeline_db.set(log_key, msgpack.encode(update_payload))
         pipeline_db.set(item_id, msgpack.encode(item_entry))
         try:
@@ -359,12 +1065,14 @@ def add_stock(item_id: str, amount: int):
                 status=LogStatus.FAILURE,
                 dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
             )
-            db.set(get_key(), msgpack.encode(error_payload))
+            db.set(get_key(item_id), msgpack.encode(error_payload))
             
             pipeline_db.discard()
             
             return abort(400, DB_ERROR_STR)
 
+        publish_invalidation(item_id)
+
         # Create a log entry for the sent response back to the user
         sent_payload_to_user = LogStockValue(
             id=log_id,
@@ -373,7 +1081,7 @@ def add_stock(item_id: str, amount: int):
             status=LogStatus.SUCCESS,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
         )
-        db.set(get_key(), msgpack.encode(sent_payload_to_user))
+        db.set(get_key(item_id), msgpack.encode(sent_payload_to_user))
 
         return Response(f"Item: {item_id} stock updated to: {item_entry.stock}, log_id: {log_id}", status=200)
 
@@ -382,12 +1090,26 @@ def add_stock(item_id: str, amount: int):
 def remove_stock(item_id: str, amount: int):
     log_id = str(uuid.uuid4())
     
+    # In partitioned mode the owner of the partition changes the item in memory, its write-ahead log replaces the logs
+    if partitions is not None:
+        return partition_update(item_id, "subtract", amount)
+    
+    # A split item is subtracted from one of its sub-counters without its lock, when none of them has enough the
+    # subtract takes the lock and the stock is collected on the item
+    if item_id in escrow_items and subtract_from_escrow(item_id, escrow_items[item_id], int(amount), log_id):
+        return Response(f"Item: {item_id} stock updated, log_id: {log_id}", status=200)
+    
+    if stock_commits is not None:
+        return committed_change(item_id, stock_commits.submit(item_id, -int(amount), commit_stock_changes))
+    
     # Use RedLock to prevent dirty reads
-    with RedLock(f"{item_id}-lock", connection_details=[db.connection_pool.connection_kwargs], retry_times=20, retry_delay=100):
+    with RedLock(f"{item_id}-lock", connection_details=[client_for(db, item_id).connection_pool.connection_kwargs], retry_times=20, retry_delay=100):
         
-        # Get the item from the database and create a copy of it for the rollback purposes
-        item_entry: StockValue = get_item_from_db(item_id)
-        old_item_entry: StockValue = deepcopy(item_entry)
+        # Get the item from the database, its stored bytes are kept for the rollback purposes
+        item_entry, old_item_entry = get_item_for_update(item_id)
+        if item_entry.escrow and item_entry.stock < int(amount):
+            collect_escrow(item_id, int(amount))
+            item_entry, old_item_entry = get_item_for_update(item_id)
         
         # Update stock locally
         item_entry.stock -= int(amount)
@@ -404,7 +1126,7 @@ def remove_stock(item_id: str, amount: int):
                 status=LogStatus.FAILURE,
                 dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
             )
-            log_key = get_key()
+            log_key = get_key(item_id)
             db.set(log_key, msgpack.encode(error_payload))
             
             return abort(400, f"Item: {item_id} stock cannot get reduced below zero! Log key: {log_key}")
@@ -419,7 +1141,8 @@ def remove_stock(item_id: str, amount: int):
         )
         
         # Set the log entry and the updated item in the pipeline
-        log_key = get_key()
+        log_key = get_key(item_id)
+        pipeline_db = db.pipeline()
         pipeline_db.set(log_key, msgpack.encode(update_payload))
         pipeline_db.set(item_id, msgpack.encode(item_entry))
         try:
@@ -432,12 +1155,14 @@ def remove_stock(item_id: str, amount: int):
                 status=LogStatus.FAILURE,
                 dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
             )
-            db.set(get_key(), msgpack.encode(error_payload))
+            db.set(get_key(item_id), msgpack.encode(error_payload))
             
             pipeline_db.discard()
             
             return abort(400, DB_ERROR_STR)
         
+        publish_invalidation(item_id)
+
         # Create a log entry for the sent response back to the user
         sent_payload_to_user = LogStockValue(
             id=log_id,
@@ -446,23 +1171,959 @@ def remove_stock(item_id: str, amount: int):
             status=LogStatus.SUCCESS,
             dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
         )
-        db.set(get_key(), msgpack.encode(sent_payload_to_user))
+        db.set(get_key(item_id), msgpack.encode(sent_payload_to_user))
         
         return Response(f"Item: {item_id} stock updated to: {item_entry.stock}, log_id: {log_id}", status=200)
 
-# Function to get an idempotent key from the ID service
-def get_key():
+def commit_stock_changes(item_id: str, changes: list[StockChange]):
+    # One read, one UPDATE log and one write of the item for the whole batch. The changes are applied in the order they
+    # arrived, a change that would take the stock below zero is rejected and the others still go through
+    log_id = str(uuid.uuid4())
+    with RedLock(f"{item_id}-lock", connection_details=[client_for(db, item_id).connection_pool.connection_kwargs], retry_times=20, retry_delay=100):
+        
+        item_entry, old_item_entry = get_item_for_update(item_id, log_id)
+        needed = -sum(change.change for change in changes if change.change < 0)
+        if item_entry.escrow and item_entry.stock < needed:
+            collect_escrow(item_id, needed)
+            item_entry, old_item_entry = get_item_for_update(item_id, log_id)
+        
+        for change in changes:
+            change.accepted = item_entry.stock + change.change >= 0
+            if change.accepted:
+                item_entry.stock += change.change
+            change.stock = item_entry.stock
+        
+        if any(change.accepted for change in changes):
+            write_accepted_changes(item_id, changes, log_id, item_entry, old_item_entry)
+    
+    # The rejected changes share one failure log of their own, which is written after the lock is released
+    rejected = [change for change in changes if not change.accepted]
+    if rejected:
+        failure_id, failure_key = str(uuid.uuid4()), get_key(item_id)
+        error_payload = LogStockValue(
+            id=failure_id,
+            type=LogType.SENT,
+            stock_id=item_id,
+            old_stockvalue=old_item_entry,
+            status=LogStatus.FAILURE,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+        )
+        db.set(failure_key, msgpack.encode(error_payload))
+        for change in rejected:
+            change.log_id, change.log_key = failure_id, failure_key
+
+
+def write_accepted_changes(item_id: str, changes: list[StockChange], log_id: str, item_entry: StockValue, old_item_entry: Raw):
+    # The caller holds the lock of the item
+    log_key = get_key(item_id)
+    for change in changes:
+        if change.accepted:
+            change.log_id, change.log_key = log_id, log_key
+    update_payload = LogStockValue(
+        id=log_id,
+        type=LogType.UPDATE,
+        stock_id=item_id,
+        old_stockvalue=old_item_entry,
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+    )
+    pipeline_db = db.pipeline()
+    pipeline_db.set(log_key, msgpack.encode(update_payload))
+    pipeline_db.set(item_id, msgpack.encode(item_entry))
+    try:
+        pipeline_db.execute()
+    except redis.exceptions.RedisError:
+        error_payload = LogStockValue(
+            id=log_id,
+            type=LogType.SENT,
+            stock_id=item_id,
+            status=LogStatus.FAILURE,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+        )
+        db.set(get_key(item_id), msgpack.encode(error_payload))
+        return abort(400, DB_ERROR_STR)
+    
+    publish_invalidation(item_id)
+    
+    sent_payload_to_user = LogStockValue(
+        id=log_id,
+        type=LogType.SENT,
+        stock_id=item_id,
+        status=LogStatus.SUCCESS,
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+    )
+    db.set(get_key(item_id), msgpack.encode(sent_payload_to_user))
+
+
+def committed_change(item_id: str, change: StockChange):
+    if not change.accepted:
+        return abort(400, f"Item: {item_id} stock cannot get reduced below zero! Log key: {change.log_key}")
+    return Response(f"Item: {item_id} stock updated to: {change.stock}, log_id: {change.log_id}", status=200)
+
+
+@app.post('/subtract_many')
+def remove_stock_many():
+    # The body is a JSON list of [key, [[item_id, amount], ...]] groups, every group is subtracted completely or not at all
+    try:
+        groups: list[tuple[str, list[tuple[str, int]]]] = json.decode(request.get_data(), type=list[tuple[str, list[tuple[str, int]]]])
+    except MsgspecError:
+        return abort(400, "Expected a JSON list of [key, [[item_id, amount], ...]] groups")
+    if len(groups) > SUBTRACT_MANY_MAX:
+        return abort(400, f"At most {SUBTRACT_MANY_MAX} groups per request")
+    if partitions is not None:
+        return abort(400, "Not available with STOCK_PARTITIONS, the items are changed by their partition owners")
+    
+    item_ids = sorted({item_id for _, lines in groups for item_id, _ in lines})
+    
+    # The log keys come from the id service, they are fetched before the locks so the locks are only held for Redis.
+    # A group logs at most one failure, its key gets the hash tag of the item that failed.
+    failure_ids = [get_key() for _ in groups]
+    update_keys = {item_id: get_key(item_id) for item_id in item_ids}
+    sent_keys = {item_id: get_key(item_id) for item_id in item_ids}
+    
+    # Lock the items in sorted order, so two batches that share items never deadlock
+    with ExitStack() as locks:
+        for item_id in item_ids:
+            locks.enter_context(RedLock(f"{item_id}-lock", connection_details=[client_for(db, item_id).connection_pool.connection_kwargs], retry_times=20, retry_delay=100))
+        
+        # The batch runs against the stock on the items, split items get all of theirs back for it
+        for item_id in item_ids:
+            if item_id in escrow_items:
+                collect_escrow(item_id)
+        
+        try:
+            raw_entries: list[bytes | None] = db.mget(item_ids) if item_ids else []
+        except redis.exceptions.RedisError:
+            return abort(400, DB_ERROR_STR)
+        old_entries: dict[str, StockValue | None] = {
+            item_id: msgpack.decode(raw_entry, type=StockValue) if raw_entry else None
+            for item_id, raw_entry in zip(item_ids, raw_entries)
+        }
+        old_images: dict[str, Raw | None] = {item_id: Raw(raw_entry) if raw_entry else None for item_id, raw_entry in zip(item_ids, raw_entries)}
+        stock: dict[str, int] = {item_id: entry.stock for item_id, entry in old_entries.items() if entry is not None}
+        
+        # Apply the groups in order against the running stock of every item
+        results: list[dict] = []
+        failure_logs: list[tuple[str, LogStockValue]] = []
+        for failure_id, (key, lines) in zip(failure_ids, groups):
+            amounts: dict[str, int] = defaultdict(int)
+            for item_id, amount in lines:
+                amounts[item_id] += int(amount)
+            
+            error = None
+            for item_id, amount in amounts.items():
+                if item_id not in stock:
+                    error = f"Item: {item_id} not found!"
+                elif stock[item_id] - amount < 0:
+                    error = f"Item: {item_id} stock cannot get reduced below zero!"
+                if error is not None:
+                    failure_logs.append((tagged_key(failure_id, item_id), LogStockValue(
+                        id=str(uuid.uuid4()),
+                        type=LogType.SENT,
+                        stock_id=item_id,
+                        old_stockvalue=old_images[item_id],
+                        status=LogStatus.FAILURE,
+                        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+                    )))
+                    break
+            
+            if error is None:
+                for item_id, amount in amounts.items():
+                    stock[item_id] -= amount
+                results.append({"key": key, "success": True})
+            else:
+                results.append({"key": key, "success": False, "error": error})
+        
+        pipeline_failures = db.pipeline(transaction=False)
+        for failure_key, error_payload in failure_logs:
+            pipeline_failures.set(failure_key, msgpack.encode(error_payload))
+        
+        # Every changed item gets its own UPDATE log with the value from before the batch, so recovery stays per item
+        changed = [item_id for item_id in item_ids if old_entries[item_id] is not None and stock[item_id] != old_entries[item_id].stock]
+        log_ids = {item_id: str(uuid.uuid4()) for item_id in changed}
+        pipeline_db = db.pipeline()
+        for item_id in changed:
+            update_payload = LogStockValue(
+                id=log_ids[item_id],
+                type=LogType.UPDATE,
+                stock_id=item_id,
+                old_stockvalue=old_images[item_id],
+                dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+            )
+            pipeline_db.set(update_keys[item_id], msgpack.encode(update_payload))
+            pipeline_db.set(item_id, msgpack.encode(StockValue(stock=stock[item_id], price=old_entries[item_id].price, escrow=old_entries[item_id].escrow)))
+        try:
+            pipeline_failures.execute()
+            pipeline_db.execute()
+        except redis.exceptions.RedisError:
+            # With sharding every node runs its own MULTI/EXEC, so some items may have been changed. Their UPDATE logs
+            # are left unfinished and the recovery restores them, the items of the other nodes got no log at all.
+            pipeline_db.discard()
+            
+            return abort(400, DB_ERROR_STR)
+        
+        if changed:
+            publish_invalidation(*changed)
+        
+        # Create a log entry per item for the sent response back to the user
+        pipeline_sent = db.pipeline(transaction=False)
+        for item_id in changed:
+            sent_payload_to_user = LogStockValue(
+                id=log_ids[item_id],
+                type=LogType.SENT,
+                stock_id=item_id,
+                status=LogStatus.SUCCESS,
+                dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+            )
+            pipeline_sent.set(sent_keys[item_id], msgpack.encode(sent_payload_to_user))
+        pipeline_sent.execute()
+        
+        return jsonify(results), 200
+
+########################################################################################################################
+#   START OF ESCROW FUNCTIONS
+########################################################################################################################
+escrow_items: dict[str, int] = {}     # Split items of this worker, refreshed by the rebalancer, see remove_stock()
+
+
+def escrow_key(item_id: str, index: int) -> str:
+    # Without a hash tag, so the sub-counters of an item spread over the nodes, their logs follow them
+    return f"escrow:{index}:{item_id}"
+
+
+def is_escrow_key(key: str) -> bool:
+    return key.startswith("escrow:")
+
+
+def escrow_item(key: str) -> tuple[str, int]:
+    _, index, item_id = key.split(":", 2)
+    return item_id, int(index)
+
+
+def escrow_stock(read_db: redis.Redis | ShardedRedis, item_id: str, counters: int) -> int:
+    raw_counters: list[bytes | None] = read_db.mget([escrow_key(item_id, index) for index in range(counters)])
+    return sum(msgpack.decode(raw_counter, type=StockValue).stock for raw_counter in raw_counters if raw_counter)
+
+
+def escrow_candidates(item_id: str, counters: int, amount: int) -> list[str]:
+    # The counters that had enough stock when they were read, in random order so concurrent subtracts spread out
+    keys = [escrow_key(item_id, index) for index in range(counters)]
+    candidates = [key for key, raw_counter in zip(keys, db.mget(keys)) if raw_counter and msgpack.decode(raw_counter, type=StockValue).stock >= amount]
+    random.shuffle(candidates)
+    return candidates
+
+
+def adjust_counter(key: str, change: int, log_id: str, partial: bool = False, finish: bool = False, reservation_id: str | None = None) -> int:
+    # Changes a sub-counter by change, or by as much of a negative change as it has stock for when partial. Sub-counters
+    # are only written by these optimistic transactions, never under the lock of their item, so the subtracts of a hot
+    # item do not wait for each other. Returns the applied change, 0 when the counter has too little stock
+    update_key = get_key(key)
+    sent_key = get_key(key) if finish else None
+    with client_for(db, key).pipeline() as pipeline_db:
+        while True:
+            try:
+                # A hold is only written while its reservation was not released
+                pipeline_db.watch(key, *([released_key(reservation_id, key)] if reservation_id is not None else []))
+                if reservation_id is not None and pipeline_db.exists(released_key(reservation_id, key)):
+                    pipeline_db.reset()
+                    return 0
+                raw_counter: bytes | None = pipeline_db.get(key)
+                counter = msgpack.decode(raw_counter, type=StockValue) if raw_counter else StockValue(stock=0, price=0)
+                applied = max(change, -counter.stock) if partial else change
+                if applied == 0 or counter.stock + applied < 0:
+                    return 0
+                
+                counter.stock += applied
+                update_payload = LogStockValue(
+                    id=log_id,
+                    type=LogType.UPDATE,
+                    stock_id=key,
+                    old_stockvalue=Raw(raw_counter) if raw_counter else StockValue(stock=0, price=0),
+                    dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+                )
+                pipeline_db.multi()
+                pipeline_db.set(update_key, msgpack.encode(update_payload))
+                pipeline_db.set(key, msgpack.encode(counter))
+                if reservation_id is not None:
+                    pipeline_db.set(hold_key(reservation_id, key), -applied)
+                if finish:
+                    sent_payload = LogStockValue(
+                        id=log_id,
+                        type=LogType.SENT,
+                        stock_id=key,
+                        status=LogStatus.SUCCESS,
+                        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+                    )
+                    pipeline_db.set(sent_key, msgpack.encode(sent_payload))
+                pipeline_db.execute()
+                return applied
+            except redis.exceptions.WatchError:
+                continue
+
+
+def subtract_from_escrow(item_id: str, counters: int, amount: int, log_id: str) -> bool:
+    for key in escrow_candidates(item_id, counters, amount):
+        if adjust_counter(key, -amount, log_id, finish=True):
+            publish_invalidation(item_id)
+            return True
+    return False
+
+
+def write_counter_transfer(item_id: str, raw_entry: bytes, item_entry: StockValue, log_id: str, counter_keys: list[str]):
+    # The main counter is written after its sub-counters, a transfer that stops halfway has no SENT logs and is rolled
+    # back by the recovery
+    update_payload = LogStockValue(
+        id=log_id,
+        type=LogType.UPDATE,
+        stock_id=item_id,
+        old_stockvalue=Raw(raw_entry),
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+    )
+    pipeline_db = db.pipeline()
+    pipeline_db.set(get_key(item_id), msgpack.encode(update_payload))
+    pipeline_db.set(item_id, msgpack.encode(item_entry))
+    pipeline_db.execute()
+    
+    pipeline_sent = db.pipeline(transaction=False)
+    for key in [item_id, *counter_keys]:
+        sent_payload = LogStockValue(
+            id=log_id,
+            type=LogType.SENT,
+            stock_id=key,
+            status=LogStatus.SUCCESS,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+        )
+        pipeline_sent.set(get_key(key), msgpack.encode(sent_payload))
+    pipeline_sent.execute()
+    publish_invalidation(item_id)
+
+
+def collect_escrow(item_id: str, needed: int | None = None, indexes: range | None = None):
+    # Moves stock of the sub-counters into the main counter until it holds needed, or all of it, the caller holds the
+    # lock of the item
+    raw_entry: bytes | None = db.get(item_id)
+    if not raw_entry:
+        return
+    item_entry: StockValue = msgpack.decode(raw_entry, type=StockValue)
+    
+    log_id = str(uuid.uuid4())
+    collected_keys = []
+    for index in (indexes if indexes is not None else range(item_entry.escrow)):
+        if needed is not None and item_entry.stock >= needed:
+            break
+        key = escrow_key(item_id, index)
+        taken = -adjust_counter(key, -(needed - item_entry.stock) if needed is not None else -sys.maxsize, log_id, partial=True)
+        if taken:
+            item_entry.stock += taken
+            collected_keys.append(key)
+    
+    if collected_keys:
+        write_counter_transfer(item_id, raw_entry, item_entry, log_id, collected_keys)
+
+
+def rebalance_escrow(item_id: str):
+    # Evens out the sub-counters of an item through its main counter, so the subtracts keep finding a counter with
+    # enough stock. Skips the item when another worker holds its lock
+    with RedLock(f"{item_id}-lock", connection_details=[client_for(db, item_id).connection_pool.connection_kwargs], retry_times=1, retry_delay=100):
+        raw_entry: bytes | None = db.get(item_id)
+        item_entry: StockValue | None = msgpack.decode(raw_entry, type=StockValue) if raw_entry else None
+        if item_entry is None or not item_entry.escrow:
+            return
+        
+        keys = [escrow_key(item_id, index) for index in range(item_entry.escrow)]
+        counters = [msgpack.decode(raw_counter, type=StockValue).stock if raw_counter else 0 for raw_counter in db.mget(keys)]
+        share = (item_entry.stock + sum(counters)) // len(keys)
+        if item_entry.stock < len(keys) and min(counters) * 2 >= share:
+            return
+        
+        # The counters above their share give the surplus to the main counter first, the others are refilled from it
+        log_id = str(uuid.uuid4())
+        changed_keys = []
+        for key, stock in zip(keys, counters):
+            if stock > share:
+                taken = -adjust_counter(key, share - stock, log_id, partial=True)
+                if taken:
+                    item_entry.stock += taken
+                    changed_keys.append(key)
+        for key, stock in zip(keys, counters):
+            if stock < share and item_entry.stock > 0:
+                given = adjust_counter(key, min(share - stock, item_entry.stock), log_id)
+                if given:
+                    item_entry.stock -= given
+                    changed_keys.append(key)
+        
+        if changed_keys:
+            write_counter_transfer(item_id, raw_entry, item_entry, log_id, changed_keys)
+
+
+def refresh_escrow_items():
+    # The dict is updated in place, the async app reads the same object
+    current = {item_id.decode('utf-8'): int(counters) for item_id, counters in db.hgetall(ESCROW_ITEMS_KEY).items()}
+    for item_id in set(escrow_items) - set(current):
+        escrow_items.pop(item_id, None)
+    escrow_items.update(current)
+
+
+def escrow_rebalance_loop():
+    while not recovery_stop.wait(ESCROW_REBALANCE_INTERVAL):
+        try:
+            refresh_escrow_items()
+            for item_id in list(escrow_items):
+                try:
+                    rebalance_escrow(item_id)
+                except RedLockError:
+                    continue
+        except (redis.exceptions.RedisError, HTTPException) as exc:
+            app.logger.error(f"Rebalancing the escrow counters failed: {exc}")
+
+
+@app.post('/escrow/<item_id>/<counters>')
+def split_stock(item_id: str, counters: int):
+    # Spreads the stock of a hot item over sub-counters, 0 puts all of it back on the item
+    counters = int(counters)
+    if not 0 <= counters <= ESCROW_MAX_COUNTERS:
+        return abort(400, f"Between 0 and {ESCROW_MAX_COUNTERS} counters per item")
+    if partitions is not None:
+        return abort(400, "Not available with STOCK_PARTITIONS, the items are changed by their partition owners")
+    log_id = str(uuid.uuid4())
+    
+    with RedLock(f"{item_id}-lock", connection_details=[client_for(db, item_id).connection_pool.connection_kwargs], retry_times=20, retry_delay=100):
+        item_entry, old_item_entry = get_item_for_update(item_id)
+        
+        # The counters that are dropped give their stock to the main counter first
+        if counters < item_entry.escrow:
+            collect_escrow(item_id, indexes=range(counters, item_entry.escrow))
+            item_entry, old_item_entry = get_item_for_update(item_id)
+        item_entry.escrow = counters
+        
+        update_payload = LogStockValue(
+            id=log_id,
+            type=LogType.UPDATE,
+            stock_id=item_id,
+            old_stockvalue=old_item_entry,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+        )
+        pipeline_db = db.pipeline()
+        pipeline_db.set(get_key(item_id), msgpack.encode(update_payload))
+        pipeline_db.set(item_id, msgpack.encode(item_entry))
+        try:
+            pipeline_db.execute()
+            if counters:
+                db.hset(ESCROW_ITEMS_KEY, item_id, counters)
+            else:
+                db.hdel(ESCROW_ITEMS_KEY, item_id)
+        except redis.exceptions.RedisError:
+            return abort(400, DB_ERROR_STR)
+        
+        publish_invalidation(item_id)
+        sent_payload_to_user = LogStockValue(
+            id=log_id,
+            type=LogType.SENT,
+            stock_id=item_id,
+            status=LogStatus.SUCCESS,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+        )
+        db.set(get_key(item_id), msgpack.encode(sent_payload_to_user))
+    
+    if counters:
+        escrow_items[item_id] = counters
+        # Fill the counters now instead of on the next round of the rebalancer
+        try:
+            rebalance_escrow(item_id)
+        except RedLockError:
+            pass
+    else:
+        escrow_items.pop(item_id, None)
+    
+    return Response(f"Item: {item_id} stock split over {counters} counters, log_id: {log_id}", status=200)
+
+########################################################################################################################
+#   START OF RESERVATION FUNCTIONS
+########################################################################################################################
+class Reservation(Struct):
+    items: list[tuple[str, int]]
+    deadline: float
+
+
+def hold_key(reservation_id: str, item_id: str) -> str:
+    # The hash tag keeps the hold on the node of its item, so the hold and the stock change are one MULTI/EXEC
+    return f"hold:{reservation_id}{{{item_id}}}"
+
+
+def released_key(reservation_id: str, item_id: str) -> str:
+    # Left by a release that found no hold, so a hold of the reservation that is still on its way is refused
+    return f"released:{reservation_id}{{{item_id}}}"
+
+
+def mark_released(reservation_id: str, key: str) -> bool:
+    # Leaves the tombstone of a sub-counter when it holds nothing for the reservation, in a transaction that fails when
+    # the hold is written in the meantime. Returns whether the tombstone was left
+    hold = hold_key(reservation_id, key)
+    with client_for(db, key).pipeline() as pipeline_db:
+        while True:
+            try:
+                pipeline_db.watch(hold)
+                if pipeline_db.exists(hold):
+                    return False
+                pipeline_db.multi()
+                pipeline_db.set(released_key(reservation_id, key), 1, ex=RESERVATION_TOMBSTONE_TTL)
+                pipeline_db.execute()
+                return True
+            except redis.exceptions.WatchError:
+                continue
+
+
+# Adds a sub-counter to a stored reservation, only while the reservation is not claimed for its release
+add_reservation_line_script = db.register_script("""
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+return 1
+""")
+
+
+# Moves a reservation from one sorted set to the releasing set when its score is at most the limit
+claim_release_script = db.register_script("""
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not score or (ARGV[2] ~= 'any' and tonumber(score) > tonumber(ARGV[2])) then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+return 1
+""")
+
+
+# Takes a reservation out of the expiry set and remembers it as confirmed, 2 when it was confirmed before
+confirm_reservation_script = db.register_script("""
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    redis.call('SET', KEYS[2], 1, 'EX', ARGV[2])
+    return 1
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 2
+end
+return 0
+""")
+
+
+def confirmed_key(reservation_id: str) -> str:
+    # Next to the expiry set, so the confirm and its marker are one script
+    return f"{{reservations}}:confirmed:{reservation_id}"
+
+
+def claim_release(reservation_id: str, source_key: str = RESERVATION_EXPIRY_KEY, limit: float | str = "any") -> bool:
+    return bool(claim_release_script(keys=[source_key, RESERVATION_RELEASING_KEY], args=[reservation_id, limit, time() + RESERVATION_CLAIM_TIMEOUT]))
+
+
+def release_counter_hold(reservation_id: str, key: str) -> bool:
+    # Same as a release on the item, with an optimistic transaction like every other write of a sub-counter
+    hold = hold_key(reservation_id, key)
+    if mark_released(reservation_id, key):
+        return False
+    
+    log_id = str(uuid.uuid4())
+    update_key, sent_key = get_key(key), get_key(key)
+    with client_for(db, key).pipeline() as pipeline_db:
+        while True:
+            try:
+                pipeline_db.watch(key, hold)
+                amount: bytes | None = pipeline_db.get(hold)
+                if amount is None:
+                    return False
+                raw_counter: bytes | None = pipeline_db.get(key)
+                counter = msgpack.decode(raw_counter, type=StockValue) if raw_counter else StockValue(stock=0, price=0)
+                counter.stock += int(amount)
+                
+                update_payload = LogStockValue(
+                    id=log_id,
+                    type=LogType.UPDATE,
+                    stock_id=key,
+                    old_stockvalue=Raw(raw_counter) if raw_counter else StockValue(stock=0, price=0),
+                    dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+                )
+                sent_payload = LogStockValue(
+                    id=log_id,
+                    type=LogType.SENT,
+                    stock_id=key,
+                    status=LogStatus.SUCCESS,
+                    dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+                )
+                pipeline_db.multi()
+                pipeline_db.delete(hold)
+                pipeline_db.set(update_key, msgpack.encode(update_payload))
+                pipeline_db.set(key, msgpack.encode(counter))
+                pipeline_db.set(sent_key, msgpack.encode(sent_payload))
+                pipeline_db.execute()
+                break
+            except redis.exceptions.WatchError:
+                continue
+    
+    # A counter that was dropped while its stock was held gives the stock to the item
+    item_id, index = escrow_item(key)
+    if escrow_items.get(item_id, 0) <= index:
+        with RedLock(f"{item_id}-lock", connection_details=[client_for(db, item_id).connection_pool.connection_kwargs], retry_times=20, retry_delay=100):
+            collect_escrow(item_id, indexes=range(index, index + 1))
+    return True
+
+
+def release_reservation(reservation_id: str):
+    # Gives back the stock of every hold that still exists, a hold is deleted together with its stock change, so a
+    # release that is retried after a crash never gives back the same stock twice
+    raw_reservation: bytes | None = db.hget(RESERVATION_ITEMS_KEY, reservation_id)
+    reservation: Reservation | None = msgpack.decode(raw_reservation, type=Reservation) if raw_reservation else None
+    
+    # The partition owners keep the holds in memory, a release of a hold they no longer have changes nothing
+    if partitions is not None and reservation is not None:
+        item_partitions = {partitions.partition_of(item_id) for item_id, _ in reservation.items}
+        partitions.call_many([(partition, ["release", reservation_id]) for partition in item_partitions])
+        reservation = None
+    
+    released_items = []
+    for item_id, _ in (reservation.items if reservation else []):
+        if is_escrow_key(item_id):
+            if release_counter_hold(reservation_id, item_id):
+                released_items.append(escrow_item(item_id)[0])
+            continue
+        with RedLock(f"{item_id}-lock", connection_details=[client_for(db, item_id).connection_pool.connection_kwargs], retry_times=20, retry_delay=100):
+            amount: bytes | None = db.get(hold_key(reservation_id, item_id))
+            if amount is None:
+                # The reservation still has to take the stock of this item, it does so under the same lock and sees this
+                db.set(released_key(reservation_id, item_id), 1, ex=RESERVATION_TOMBSTONE_TTL)
+                continue
+            raw_entry: bytes | None = db.get(item_id)
+            if not raw_entry:
+                db.delete(hold_key(reservation_id, item_id))
+                continue
+            
+            item_entry: StockValue = msgpack.decode(raw_entry, type=StockValue)
+            item_entry.stock += int(amount)
+            log_id = str(uuid.uuid4())
+            update_payload = LogStockValue(
+                id=log_id,
+                type=LogType.UPDATE,
+                stock_id=item_id,
+                old_stockvalue=Raw(raw_entry),
+                dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+            )
+            sent_payload = LogStockValue(
+                id=log_id,
+                type=LogType.SENT,
+                stock_id=item_id,
+                status=LogStatus.SUCCESS,
+                dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+            )
+            pipeline_db = db.pipeline()
+            pipeline_db.delete(hold_key(reservation_id, item_id))
+            pipeline_db.set(get_key(item_id), msgpack.encode(update_payload))
+            pipeline_db.set(item_id, msgpack.encode(item_entry))
+            pipeline_db.set(get_key(item_id), msgpack.encode(sent_payload))
+            pipeline_db.execute()
+            released_items.append(item_id)
+    
+    if released_items:
+        publish_invalidation(*released_items)
+    
+    pipeline_done = db.pipeline()
+    pipeline_done.hdel(RESERVATION_ITEMS_KEY, reservation_id)
+    pipeline_done.zrem(RESERVATION_RELEASING_KEY, reservation_id)
+    pipeline_done.execute()
+
+
+def sweep_reservations() -> int:
+    # Releases the expired reservations and the releases whose worker died, every worker sweeps, the claim picks one
+    released = 0
+    for source_key in (RESERVATION_EXPIRY_KEY, RESERVATION_RELEASING_KEY):
+        now = time()
+        for reservation_id in db.zrangebyscore(source_key, "-inf", now, start=0, num=RESERVATION_SWEEP_BATCH):
+            reservation_id = reservation_id.decode('utf-8')
+            if claim_release(reservation_id, source_key, now):
+                release_reservation(reservation_id)
+                released += 1
+    if released:
+        db.hincrby(RESERVATION_STATS_KEY, "expired", released)
+    return released
+
+
+def reservation_sweep_loop():
+    while not recovery_stop.wait(RESERVATION_SWEEP_INTERVAL):
+        try:
+            sweep_reservations()
+        except (redis.exceptions.RedisError, RedLockError, HTTPException, PartitionTimeout) as exc:
+            app.logger.error(f"Sweeping the reservations failed: {exc}")
+
+
+def queue_item_hold(pipeline_db: redis.client.Pipeline, reservation_id: str, item_id: str, amount: int, raw_entry: bytes):
+    # The stock change, the hold and the logs of one item, the caller holds the lock of the item
+    item_entry: StockValue = msgpack.decode(raw_entry, type=StockValue)
+    item_entry.stock -= amount
+    log_id = str(uuid.uuid4())
+    update_payload = LogStockValue(
+        id=log_id,
+        type=LogType.UPDATE,
+        stock_id=item_id,
+        old_stockvalue=Raw(raw_entry),
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+    )
+    sent_payload_to_user = LogStockValue(
+        id=log_id,
+        type=LogType.SENT,
+        stock_id=item_id,
+        status=LogStatus.SUCCESS,
+        dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+    )
+    pipeline_db.set(get_key(item_id), msgpack.encode(update_payload))
+    pipeline_db.set(item_id, msgpack.encode(item_entry))
+    pipeline_db.set(hold_key(reservation_id, item_id), amount)
+    pipeline_db.set(get_key(item_id), msgpack.encode(sent_payload_to_user))
+
+
+def hold_escrow_stock(reservation: Reservation, reservation_id: str, item_id: str, amount: int) -> bool:
+    # Every counter is added to the stored reservation before its stock is taken, so the sweeper finds its hold. When
+    # no counter has enough, the stock is collected on the item, which is already part of the reservation
+    for key in escrow_candidates(item_id, escrow_items.get(item_id, 0), amount):
+        reservation.items.append((key, amount))
+        if not add_reservation_line_script(keys=[RESERVATION_EXPIRY_KEY, RESERVATION_ITEMS_KEY], args=[reservation_id, msgpack.encode(reservation)]):
+            return False
+        if adjust_counter(key, -amount, str(uuid.uuid4()), finish=True, reservation_id=reservation_id):
+            publish_invalidation(item_id)
+            return True
+    
+    with RedLock(f"{item_id}-lock", connection_details=[client_for(db, item_id).connection_pool.connection_kwargs], retry_times=20, retry_delay=100):
+        collect_escrow(item_id, amount)
+        raw_entry: bytes | None = db.get(item_id)
+        if not raw_entry or msgpack.decode(raw_entry, type=StockValue).stock < amount or db.exists(released_key(reservation_id, item_id)):
+            return False
+        pipeline_db = db.pipeline()
+        queue_item_hold(pipeline_db, reservation_id, item_id, amount, raw_entry)
+        pipeline_db.execute()
+    publish_invalidation(item_id)
+    return True
+
+
+def reserve_in_partitions(reservation_id: str, reservation: Reservation):
+    # Every partition holds the stock of its items, a reservation that one of them refuses is released in all of them
+    lines: dict[int, list[tuple[str, int]]] = defaultdict(list)
+    for item_id, amount in reservation.items:
+        lines[partitions.partition_of(item_id)].append((item_id, amount))
+    try:
+        replies = partitions.call_many([(partition, ["hold", reservation_id, partition_lines]) for partition, partition_lines in lines.items()])
+    except (PartitionTimeout, redis.exceptions.RedisError) as exc:
+        # The holds that were placed are given back by the sweeper when the reservation expires
+        return abort(400, str(exc))
+    
+    errors = [reply[1] for reply in replies if not reply[0]]
+    if errors:
+        if claim_release(reservation_id):
+            release_reservation(reservation_id)
+        return abort(400, errors[0])
+    
+    return jsonify({"reservation_id": reservation_id, "deadline": reservation.deadline}), 200
+
+
+@app.post('/reserve/<reservation_id>')
+def reserve_stock(reservation_id: str):
+    # The body is a JSON list of [item_id, amount] pairs, the stock of all items is held or none of it
+    try:
+        lines: list[tuple[str, int]] = json.decode(request.get_data(), type=list[tuple[str, int]])
+    except MsgspecError:
+        return abort(400, "Expected a JSON list of [item_id, amount] pairs")
+    return hold_stock(reservation_id, lines, float(request.args.get("ttl", RESERVATION_TTL)))
+
+
+def hold_stock(reservation_id: str, lines: list[tuple[str, int]], ttl: float):
+    amounts: dict[str, int] = defaultdict(int)
+    for item_id, amount in lines:
+        amounts[item_id] += int(amount)
+    
+    # A retried reservation is not held twice
+    reservation = Reservation(items=sorted(amounts.items()), deadline=time() + ttl)
+    if not db.hsetnx(RESERVATION_ITEMS_KEY, reservation_id, msgpack.encode(reservation)):
+        return jsonify({"reservation_id": reservation_id, "deadline": msgpack.decode(db.hget(RESERVATION_ITEMS_KEY, reservation_id), type=Reservation).deadline}), 200
+    
+    # The reservation is stored before any stock is held, so the sweeper finds every hold even when this worker dies
+    db.zadd(RESERVATION_EXPIRY_KEY, {reservation_id: reservation.deadline})
+    
+    if partitions is not None:
+        return reserve_in_partitions(reservation_id, reservation)
+    
+    # Split items are held on one of their sub-counters after the other items, without their lock
+    locked_items = [(item_id, amount) for item_id, amount in reservation.items if item_id not in escrow_items]
+    escrow_lines = [(item_id, amount) for item_id, amount in reservation.items if item_id in escrow_items]
+    item_ids = [item_id for item_id, _ in locked_items]
+    with ExitStack() as locks:
+        for item_id in item_ids:
+            locks.enter_context(RedLock(f"{item_id}-lock", connection_details=[client_for(db, item_id).connection_pool.connection_kwargs], retry_times=20, retry_delay=100))
+        
+        try:
+            raw_entries: list[bytes | None] = db.mget(item_ids) if item_ids else []
+            released: list[bytes | None] = db.mget([released_key(reservation_id, item_id) for item_id in item_ids]) if item_ids else []
+        except redis.exceptions.RedisError:
+            return abort(400, DB_ERROR_STR)
+        
+        # The release of a reservation that expired before its stock was taken leaves a tombstone under the same locks
+        if any(released):
+            return abort(400, f"Reservation: {reservation_id} expired or was released before its stock was held")
+        
+        error = None
+        for (item_id, amount), raw_entry in zip(locked_items, raw_entries):
+            if not raw_entry:
+                error = f"Item: {item_id} not found!"
+            elif msgpack.decode(raw_entry, type=StockValue).stock < amount:
+                error = f"Item: {item_id} stock cannot get reduced below zero!"
+            if error is not None:
+                error_payload = LogStockValue(
+                    id=str(uuid.uuid4()),
+                    type=LogType.SENT,
+                    stock_id=item_id,
+                    old_stockvalue=Raw(raw_entry) if raw_entry else None,
+                    status=LogStatus.FAILURE,
+                    dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+                )
+                log_key = get_key(item_id)
+                db.set(log_key, msgpack.encode(error_payload))
+                
+                pipeline_cancel = db.pipeline()
+                pipeline_cancel.hdel(RESERVATION_ITEMS_KEY, reservation_id)
+                pipeline_cancel.zrem(RESERVATION_EXPIRY_KEY, reservation_id)
+                pipeline_cancel.execute()
+                return abort(400, f"{error} Log key: {log_key}")
+        
+        # Every item gets its stock change, its hold and its logs in one transaction on its node
+        pipeline_db = db.pipeline()
+        for (item_id, amount), raw_entry in zip(locked_items, raw_entries):
+            queue_item_hold(pipeline_db, reservation_id, item_id, amount, raw_entry)
+        try:
+            pipeline_db.execute()
+        except redis.exceptions.RedisError:
+            # The holds that were written are given back by the sweeper when the reservation expires
+            return abort(400, DB_ERROR_STR)
+    
+    if item_ids:
+        publish_invalidation(*item_ids)
+    
+    for item_id, amount in escrow_lines:
+        if not hold_escrow_stock(reservation, reservation_id, item_id, amount):
+            # Gives back the holds this reservation already has
+            if claim_release(reservation_id):
+                release_reservation(reservation_id)
+            error_payload = LogStockValue(
+                id=str(uuid.uuid4()),
+                type=LogType.SENT,
+                stock_id=item_id,
+                status=LogStatus.FAILURE,
+                dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+            )
+            log_key = get_key(item_id)
+            db.set(log_key, msgpack.encode(error_payload))
+            return abort(400, f"Item: {item_id} stock cannot get reduced below zero! Log key: {log_key}")
+    
+    return jsonify({"reservation_id": reservation_id, "deadline": reservation.deadline}), 200
+
+
+@app.post('/confirm/<reservation_id>')
+def confirm_reservation(reservation_id: str):
+    # The held stock stays subtracted, fails when the reservation already expired or is being released. A repeated
+    # confirm, such as the retry of a lost answer, succeeds and finishes the cleanup of the first one
+    confirmed = confirm_reservation_script(keys=[RESERVATION_EXPIRY_KEY, confirmed_key(reservation_id)], args=[reservation_id, RESERVATION_CONFIRMED_TTL])
+    if not confirmed:
+        return abort(400, f"Reservation: {reservation_id} expired or does not exist!")
+    
+    raw_reservation: bytes | None = db.hget(RESERVATION_ITEMS_KEY, reservation_id)
+    reservation: Reservation | None = msgpack.decode(raw_reservation, type=Reservation) if raw_reservation else None
+    if partitions is not None and reservation is not None:
+        try:
+            partitions.call_many([(partition, ["confirm", reservation_id]) for partition in {partitions.partition_of(item_id) for item_id, _ in reservation.items}])
+        except (PartitionTimeout, redis.exceptions.RedisError):
+            pass    # The stock stays subtracted, the owner only keeps the hold in memory until its next restart
+    
+    pipeline_db = db.pipeline()
+    for item_id, _ in (reservation.items if reservation else []):
+        pipeline_db.delete(hold_key(reservation_id, item_id))
+    pipeline_db.hdel(RESERVATION_ITEMS_KEY, reservation_id)
+    pipeline_db.execute()
+    
+    if confirmed == 1:
+        db.hincrby(RESERVATION_STATS_KEY, "confirmed", 1)
+    return Response(f"Reservation: {reservation_id} confirmed", status=200)
+
+
+@app.post('/release/<reservation_id>')
+def release_reservation_now(reservation_id: str):
+    # Releasing twice, or after the sweeper took the reservation, is not an error
+    if claim_release(reservation_id):
+        release_reservation(reservation_id)
+        db.hincrby(RESERVATION_STATS_KEY, "released", 1)
+    return Response(f"Reservation: {reservation_id} released", status=200)
+
+
+@app.get('/reservations/status')
+def reservations_status():
+    stats = {key.decode('utf-8'): int(value) for key, value in db.hgetall(RESERVATION_STATS_KEY).items()}
+    return jsonify({
+        "active": db.zcard(RESERVATION_EXPIRY_KEY),
+        "releasing": db.zcard(RESERVATION_RELEASING_KEY),
+        "ttl": RESERVATION_TTL,
+        **stats,
+    }), 200
+
+def reserve_for_saga(event: dict) -> tuple[bool, str]:
+    try:
+        hold_stock(event["saga_id"], [(item_id, amount) for item_id, amount in event["items"]], event["ttl"])
+    except HTTPException as exc:
+        return False, f"Out of stock: {exc.description}"
+    return True, ""
+
+
+def handle_checkout_event(event: dict):
+    # The saga id is the reservation id, so a redelivered event holds, confirms or releases the stock only once
+    saga_id = event["saga_id"]
+    with app.app_context():
+        if event["type"] == "requested":
+            saga_bus.answer(event, "stock", lambda: reserve_for_saga(event))
+        elif event["type"] == "completed":
+            try:
+                confirm_reservation(saga_id)
+            except HTTPException as exc:
+                # A repeated announcement is confirmed again without error, this is a reservation that expired
+                app.logger.warning(f"Confirming the stock of saga {saga_id} failed: {exc.description}")
+        elif event["type"] == "cancelled":
+            release_reservation_now(saga_id)
+
+
+@app.get('/saga/status')
+def saga_status():
+    if saga_bus is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **saga_bus.status(CHECKOUT_STREAM)}), 200
+
+
+@app.get('/partitions/status')
+def partitions_status():
+    if partitions is None:
+        return jsonify({"partitions": []}), 200
+    return jsonify(partitions.status()), 200
+
+# Function to get an idempotent key from the ID service, the hash tag keeps the log on the shard of its entity
+def get_key(hash_tag: str | None = None):
     try:
         response = requests.get(f"{GATEWAY_URL}/ids/create")
     except requests.exceptions.RequestException:
         abort(400, REQ_ERROR_STR)
     else:
-        return response.text
+        return tagged_key(response.text, hash_tag) if hash_tag else response.text
+
+
+def tagged_key(key: str, hash_tag: str) -> str:
+    # Puts a key fetched without hash tag on the node of its entity
+    return f"{key}{{{hash_tag}}}"
 
 # Can ignore
 @app.post('/batch_init/<n>/<starting_stock>/<item_price>')
 def batch_init_users(n: int, starting_stock: int, item_price: int):
     """This function apparenlty boeit niet."""
+    if partitions is not None:
+        return abort(400, "Not available with STOCK_PARTITIONS, the owners would keep the items they already loaded")
     n = int(n)
     starting_stock = int(starting_stock)
     item_price = int(item_price)
@@ -470,13 +2131,44 @@ def batch_init_users(n: int, starting_stock: int, item_price: int):
         f"{i}": msgpack.encode(StockValue(stock=starting_stock, price=item_price))
         for i in range(n)
     }
+    pipeline_catalog = db.pipeline(transaction=False)
+    for item_id in kv_pairs:
+        add_catalog_entry(pipeline_catalog, item_id, item_price)
     try:
         db.mset(kv_pairs)
+        pipeline_catalog.execute()
     except redis.exceptions.RedisError:
-        pipeline_db.discard()
         return abort(400, DB_ERROR_STR)
+    publish_invalidation()
     return jsonify({"msg": "Batch init for stock successful"})
     
+# Can ignore, seeds a backlog of unfinished transactions for the recovery benchmark
+@app.post('/recovery/seed/<n>')
+def seed_recovery_backlog(n: int):
+    n = int(n)
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    
+    pipeline_seed = db.pipeline(transaction=False)
+    for i in range(n):
+        item_id = f"recovery-seed-{i}"
+        update_payload = LogStockValue(
+            id=str(uuid.uuid4()),
+            type=LogType.UPDATE,
+            stock_id=item_id,
+            old_stockvalue=StockValue(stock=1, price=1),
+            dateTime=timestamp
+        )
+        pipeline_seed.set(item_id, msgpack.encode(StockValue(stock=0, price=1)))
+        pipeline_seed.set(f"log:{timestamp}seed{i}{{recovery-seed-{i}}}", msgpack.encode(update_payload))
+        if len(pipeline_seed) >= RECOVERY_BATCH_SIZE:
+            pipeline_seed.execute()
+    try:
+        pipeline_seed.execute()
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    publish_invalidation()
+    return jsonify({"msg": f"Seeded {n} unfinished transactions"})
+
 # Function to call the fault tolerance function for testing purposes
 @app.get('/fault_tolerance/<min_diff>')
 def test_fault_tolerance(min_diff: int):
@@ -489,25 +2181,242 @@ def fix_fault_tolerance(min_diff: int = 5):
     logs = find_all_logs_time(time, int(min_diff))
     sorted_logs = sort_logs(logs)
     
+    unfinished: list[list[dict]] = []
     for _, log_list in sorted_logs.items():
-        last_log = log_list[-1]["log"]
-        if last_log["status"] in [LogStatus.SUCCESS, LogStatus.FAILURE] and last_log["type"] == LogType.SENT: # If log was finished properly
+        if is_transaction_finished(log_list): # If log was finished properly
             continue
         
-        for log_entry in reversed(log_list):
-            log = log_entry["log"]
-            
-            log_type = log["type"]
-            log_stock_id = log["stock_id"]
-            if log_type == LogType.CREATE:
-                db.delete(log_stock_id)
-            elif log_type == LogType.UPDATE:
-                log_stock_old = log["old_stock_value"]
-                db.set(log_stock_id, msgpack.encode(StockValue(stock=log_stock_old["stock"], price=log_stock_old["price"])))
-            
-            db.delete(log_entry["id"])
+        unfinished.append(log_list)
     
+    recover_transactions(unfinished)
+
+
+# Rollback the changes of an unfinished transaction and delete its logs
+def recover_transaction(log_list: list[dict], pipeline_recovery: redis.client.Pipeline):
+    for log_entry in reversed(log_list):
+        log = log_entry["log"]
+        
+        log_type = log["type"]
+        log_stock_id = log["stock_id"]
+        if log_type == LogType.CREATE:
+            pipeline_recovery.delete(log_stock_id)
+            add_catalog_entry(pipeline_recovery, log_stock_id, DELETED_PRICE)
+        elif log_type == LogType.UPDATE:
+            log_stock_old = log["old_stock_value"]
+            pipeline_recovery.set(log_stock_id, msgpack.encode(StockValue(stock=log_stock_old["stock"], price=log_stock_old["price"], escrow=log_stock_old.get("escrow") or 0)))
+        
+        pipeline_recovery.delete(log_entry["id"])
+
+
+def transaction_entity(log_list: list[dict]) -> str:
+    for log_entry in log_list:
+        if log_entry["log"]["stock_id"] is not None:
+            return log_entry["log"]["stock_id"]
+    return log_list[0]["log"]["id"]
+
+
+def recover_partition(partition: list[list[dict]]):
+    # Newest transactions first, so the oldest before-image of an entity is restored last
+    partition.sort(key=lambda log_list: log_list[0]["log"]["date_time"], reverse=True)
+    
+    pipeline_recovery = db.pipeline(transaction=False)
+    for log_list in partition:
+        recover_transaction(log_list, pipeline_recovery)
+        if len(pipeline_recovery) >= RECOVERY_BATCH_SIZE:
+            pipeline_recovery.execute()
+    pipeline_recovery.execute()
+    
+    # A sub-counter is cached as part of its item
+    entities = {transaction_entity(log_list) for log_list in partition}
+    publish_invalidation(*{escrow_item(entity)[0] if is_escrow_key(entity) else entity for entity in entities})
+
+
+def recover_transactions(transactions: list[list[dict]]):
+    transactions = claim_transactions(transactions)
+    
+    # Transactions on the same entity always end up in the same partition, so they are rolled back in order
+    partitions: list[list[list[dict]]] = [[] for _ in range(RECOVERY_WORKERS)]
+    for log_list in transactions:
+        partitions[hash(transaction_entity(log_list)) % RECOVERY_WORKERS].append(log_list)
+    
+    with ThreadPoolExecutor(max_workers=RECOVERY_WORKERS) as executor:
+        list(executor.map(recover_partition, [partition for partition in partitions if partition]))
+
+
+def claim_transactions(transactions: list[list[dict]]) -> list[list[dict]]:
+    # Claim every transaction before rolling it back, so two recoveries never roll back the same transaction twice
+    claims = []
+    for start in range(0, len(transactions), RECOVERY_BATCH_SIZE):
+        pipeline_claim = db.pipeline(transaction=False)
+        for log_list in transactions[start:start + RECOVERY_BATCH_SIZE]:
+            pipeline_claim.set(f"recovery:claim:{log_list[0]['log']['id']}", WORKER_ID, nx=True, ex=RECOVERY_CLAIM_TTL)
+        claims.extend(pipeline_claim.execute())
+    
+    claimed = [log_list for log_list, claim in zip(transactions, claims) if claim]
+    if len(claimed) < len(transactions):
+        db.hincrby(RECOVERY_STATS_KEY, "duplicate_recoveries", len(transactions) - len(claimed))
+    return claimed
+
+
+def is_transaction_finished(log_list: list[dict]) -> bool:
+    last_log = log_list[-1]["log"]
+    return last_log["status"] in [LogStatus.SUCCESS, LogStatus.FAILURE] and last_log["type"] == LogType.SENT
+
+
+def run_incremental_recovery() -> int:
+    started = perf_counter()
+    now = datetime.now()
+    
+    # Only look at logs written since the last checkpoint (or the default window on the first run)
+    checkpoint = db.get(RECOVERY_CHECKPOINT_KEY)
+    checkpoint = checkpoint.decode('utf-8') if checkpoint else (now - timedelta(minutes=5)).strftime("%Y%m%d%H%M%S%f")
+    horizon = (now - timedelta(seconds=RECOVERY_GRACE)).strftime("%Y%m%d%H%M%S%f")
+    
+    logs = []
+    read_db = reader(stale_ok=True)
+    for log_keys in scan_log_keys(read_db=read_db):
+        logs.extend(fetch_logs(log_keys, LogFilters(since=checkpoint), read_db))
+    
+    # Add the logs of the transactions that were still open during the previous run
+    seen_keys = {log["id"] for log in logs}
+    open_keys = []
+    for encoded_keys in db.hvals(RECOVERY_OPEN_KEY):
+        open_keys.extend(key for key in msgpack.decode(encoded_keys, type=list[str]) if key not in seen_keys)
+    logs.extend(fetch_logs(open_keys, LogFilters(), read_db))
+    
+    still_open: dict[str, bytes] = {}
+    abandoned: list[list[dict]] = []
+    for log_id, log_list in sort_logs(logs).items():
+        if is_transaction_finished(log_list):
+            continue
+        
+        # Transactions that logged within the grace period might still be in flight
+        if max(log_key_timestamp(log_entry["id"]) for log_entry in log_list) > horizon:
+            still_open[log_id] = msgpack.encode([log_entry["id"] for log_entry in log_list])
+            continue
+        
+        abandoned.append(log_list)
     
+    recover_transactions(abandoned)
+    recovered = len(abandoned)
+    
+    duration = perf_counter() - started
+    
+    # The background thread uses its own pipeline so it never interleaves with a request
+    pipeline_db = db.pipeline()
+    pipeline_db.delete(RECOVERY_OPEN_KEY)
+    if still_open:
+        pipeline_db.hset(RECOVERY_OPEN_KEY, mapping=still_open)
+    pipeline_db.set(RECOVERY_CHECKPOINT_KEY, horizon)
+    pipeline_db.hset(RECOVERY_STATS_KEY, mapping={
+        "checkpoint": horizon,
+        "last_run": now.strftime("%Y%m%d%H%M%S%f"),
+        "last_run_seconds": duration,
+        "last_run_logs": len(logs),
+        "last_run_recovered": recovered,
+        "open_transactions": len(still_open),
+        "logs_per_second": len(logs) / duration if duration > 0 else 0,
+    })
+    pipeline_db.hincrby(RECOVERY_STATS_KEY, "runs", 1)
+    pipeline_db.hincrby(RECOVERY_STATS_KEY, "total_logs", len(logs))
+    pipeline_db.hincrby(RECOVERY_STATS_KEY, "total_recovered", recovered)
+    pipeline_db.execute()
+    
+    return len(still_open)
+
+
+# Extends the lease only while this worker still holds it
+renew_recovery_lease = db.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+# Gives up the lease only while this worker still holds it
+release_recovery_lease = db.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def leadership_loop():
+    while not recovery_stop.is_set():
+        try:
+            if recovery_leader.is_set():
+                is_leader = renew_recovery_lease(keys=[RECOVERY_LEADER_KEY], args=[WORKER_ID, RECOVERY_LEASE * 1000])
+            else:
+                is_leader = db.set(RECOVERY_LEADER_KEY, WORKER_ID, nx=True, px=RECOVERY_LEASE * 1000)
+        except redis.exceptions.RedisError as exc:
+            app.logger.error(f"Renewing the recovery lease failed: {exc}")
+            is_leader = False
+        
+        if is_leader:
+            recovery_leader.set()
+        else:
+            recovery_leader.clear()
+        recovery_stop.wait(RECOVERY_LEASE / 3)
+
+
+def recovery_loop():
+    first_run = True
+    while not recovery_stop.is_set():
+        # Only the worker that holds the lease recovers, all workers serve requests right away
+        if not recovery_leader.wait(timeout=1):
+            continue
+        
+        try:
+            open_transactions = run_incremental_recovery()
+        except Exception as exc:
+            app.logger.error(f"Background recovery failed: {exc}")
+            recovery_stop.wait(RECOVERY_LEASE)
+            continue
+        
+        if first_run:
+            db.hset(RECOVERY_STATS_KEY, "cold_start_seconds", (datetime.now() - PROCESS_STARTED).total_seconds())
+            first_run = False
+        
+        # Come back sooner when transactions were still in flight during this run
+        recovery_stop.wait(min(RECOVERY_INTERVAL, RECOVERY_GRACE) if open_transactions else RECOVERY_INTERVAL)
+
+
+def stop_recovery():
+    recovery_stop.set()
+    if recovery_leader.is_set():
+        release_recovery_lease(keys=[RECOVERY_LEADER_KEY], args=[WORKER_ID])
+
+
+@app.get('/recovery/status')
+def recovery_status():
+    stats = {key.decode('utf-8'): value.decode('utf-8') for key, value in db.hgetall(RECOVERY_STATS_KEY).items()}
+    leader = db.get(RECOVERY_LEADER_KEY)
+    
+    # The lag is how far the checkpoint is behind the current time
+    checkpoint = stats.pop("checkpoint", None)
+    lag = (datetime.now() - datetime.strptime(checkpoint, "%Y%m%d%H%M%S%f")).total_seconds() if checkpoint else None
+    
+    return jsonify({
+        "checkpoint": checkpoint,
+        "lag_seconds": lag,
+        "interval_seconds": RECOVERY_INTERVAL,
+        "leader": leader.decode('utf-8') if leader else None,
+        "last_run": stats.pop("last_run", None),
+        **{key: float(value) for key, value in stats.items()},
+    }), 200
+
+
+@app.get('/ready')
+def readiness():
+    checkpoint = db.get(RECOVERY_CHECKPOINT_KEY)
+    lag = (datetime.now() - datetime.strptime(checkpoint.decode('utf-8'), "%Y%m%d%H%M%S%f")).total_seconds() if checkpoint else None
+    
+    # Ready once the recovery leader has caught up with the log
+    ready = lag is not None and lag <= RECOVERY_READY_LAG
+    return jsonify({"ready": ready, "lag_seconds": lag}), 200 if ready else 503
+
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=8000, debug=True)
 else:
@@ -516,5 +2425,20 @@ else:
     app.logger.setLevel(gunicorn_logger.level)
     
     # app.logger.setLevel(logging.DEBUG)
-    fix_fault_tolerance()
+    
+    # Recover in the background every RECOVERY_INTERVAL seconds, only in the worker that holds the recovery lease
+    recovery_stop = threading.Event()
+    recovery_leader = threading.Event()
+    atexit.register(stop_recovery)
+    threading.Thread(target=leadership_loop, name="recovery-leadership", daemon=True).start()
+    threading.Thread(target=recovery_loop, name="recovery", daemon=True).start()
+    threading.Thread(target=replica_monitor_loop, name="replica-monitor", daemon=True).start()
+    threading.Thread(target=reservation_sweep_loop, name="reservation-sweeper", daemon=True).start()
+    threading.Thread(target=escrow_rebalance_loop, name="escrow-rebalancer", daemon=True).start()
+    if saga_bus is not None:
+        threading.Thread(target=saga_bus.consume, args=(CHECKOUT_STREAM, handle_checkout_event, recovery_stop, (RedLockError, PartitionTimeout)), name="saga-consumer", daemon=True).start()
+    if partitions is not None:
+        threading.Thread(target=partitions.ownership_loop, args=(recovery_stop,), name="partition-owner", daemon=True).start()
+    if entity_cache is not None:
+        threading.Thread(target=cache_invalidation_loop, name="cache-invalidation", daemon=True).start()
     
\ No newline at end of file
@@ -0,0 +1,583 @@
+import os
+import uuid
+import random
+import asyncio
+import httpx
+import redis
+import redis.asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from msgspec import msgpack, Raw
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Mount, Route
+
+# The Flask app still serves the log, recovery and benchmark endpoints and runs the background recovery
+from app import (
+    app as flask_app, StockValue, LogStockValue, LogType, LogStatus,
+    DB_ERROR_STR, REQ_ERROR_STR, GATEWAY_URL, REDIS_NODES, REDIS_REPLICA_NODES, REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT,
+    CACHE_CHANNEL, CATALOG_STREAM_KEY, CATALOG_STREAM_LENGTH, use_replica, entity_cache,
+    SingleFlight, read_flight, escrow_items, escrow_key, STOCK_PARTITIONS,
+    GroupCommit, StockChange, stock_commits,
+    entity_etag, etag_matches, validator_headers,
+)
+from sharding import AsyncShardedRedis, async_redis_client, client_for
+
+
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 512))     # Per worker, shared by all in-flight requests
+LOCK_TTL = 100000                                                          # Milliseconds, same as the RedLock default of the Flask app
+LOCK_RETRY_TIMES = 20
+LOCK_RETRY_DELAY = 0.1
+
+db: redis.asyncio.Redis | AsyncShardedRedis = async_redis_client(
+    REDIS_NODES,
+    password=os.environ['REDIS_PASSWORD'],
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
+)
+replica_db: redis.asyncio.Redis | AsyncShardedRedis | None = async_redis_client(
+    REDIS_REPLICA_NODES,
+    password=os.environ['REDIS_PASSWORD'],
+    db=int(os.environ['REDIS_DB']),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT
+) if REDIS_REPLICA_NODES else None
+
+# Only deletes the lock while it still holds our token
+release_lock_script = db.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines, counted together with the SingleFlight of the Flask app."""
+
+    def __init__(self, counts: SingleFlight):
+        self.counts = counts
+        self.calls: dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fetch):
+        future = self.calls.get(key)
+        self.counts.count(future is not None)
+        if future is not None:
+            return await asyncio.shield(future)
+        
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fetch()
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()  # Marks the error as retrieved when no other call waited for it
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.calls[key]
+
+
+item_reads = AsyncSingleFlight(read_flight)
+
+
+class AsyncCommitBatch:
+    def __init__(self, done: asyncio.Future):
+        self.changes: list[StockChange] = []
+        self.done = done
+
+
+class AsyncGroupCommit:
+    """GroupCommit for coroutines, counted together with the GroupCommit of the Flask app."""
+
+    def __init__(self, counts: GroupCommit):
+        self.counts = counts
+        self.batches: dict[str, AsyncCommitBatch] = {}
+
+    async def submit(self, key: str, change: int, commit) -> StockChange:
+        entry = StockChange(change)
+        batch = self.batches.get(key)
+        if batch is not None:
+            batch.changes.append(entry)
+            if len(batch.changes) >= self.counts.max_batch:
+                del self.batches[key]
+            await asyncio.shield(batch.done)
+        else:
+            batch = self.batches[key] = AsyncCommitBatch(asyncio.get_running_loop().create_future())
+            batch.changes.append(entry)
+            try:
+                await asyncio.sleep(self.counts.window)
+                if self.batches.get(key) is batch:
+                    del self.batches[key]
+                self.counts.count(len(batch.changes))
+                await commit(key, batch.changes)
+            except BaseException as exc:
+                if self.batches.get(key) is batch:
+                    del self.batches[key]
+                for batch_entry in batch.changes:
+                    batch_entry.error = exc
+            finally:
+                batch.done.set_result(None)
+
+        if entry.error is not None:
+            raise entry.error
+        return entry
+
+
+item_commits = AsyncGroupCommit(stock_commits) if stock_commits is not None else None
+
+
+def abort(status_code: int, detail: str):
+    raise HTTPException(status_code=status_code, detail=str(detail))
+
+
+def now() -> str:
+    return datetime.now().strftime("%Y%m%d%H%M%S%f")
+
+
+def reader(stale_ok: bool = False) -> redis.asyncio.Redis | AsyncShardedRedis:
+    # Same routing and read counts as the Flask app
+    return replica_db if use_replica(stale_ok) else db
+
+
+async def publish_invalidation(*keys: str):
+    # Same message as the Flask app, every worker drops its cached copy of the entity
+    if entity_cache is not None:
+        await db.publish(CACHE_CHANNEL, msgpack.encode((datetime.now().timestamp(), list(keys))))
+
+
+@asynccontextmanager
+async def lifespan(_app: Starlette):
+    global http_client
+    http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS))
+    yield
+    await http_client.aclose()
+    await db.aclose()
+    if replica_db is not None:
+        await replica_db.aclose()
+
+
+@asynccontextmanager
+async def item_lock(item_id: str):
+    # Uses the same key and node as RedLock in the Flask app, so sync and async workers exclude each other
+    lock_key = f"{item_id}-lock"
+    lock_db = client_for(db, item_id)
+    token = str(uuid.uuid4())
+    for _ in range(LOCK_RETRY_TIMES):
+        if await lock_db.set(lock_key, token, nx=True, px=LOCK_TTL):
+            break
+        await asyncio.sleep(LOCK_RETRY_DELAY)
+    else:
+        abort(400, f"Item: {item_id} is locked")
+    try:
+        yield
+    finally:
+        await release_lock_script(keys=[lock_key], args=[token], client=lock_db)
+
+
+# Function to get an idempotent key from the ID service, the hash tag keeps the log on the shard of its entity
+async def get_key(hash_tag: str | None = None) -> str:
+    try:
+        response = await http_client.get(f"{GATEWAY_URL}/ids/create")
+    except httpx.HTTPError:
+        abort(400, REQ_ERROR_STR)
+    else:
+        return f"{response.text}{{{hash_tag}}}" if hash_tag else response.text
+
+
+async def get_item_from_db(item_id: str, log_id: str | None = None, stale_ok: bool = False) -> StockValue:
+    return (await get_tagged_item(item_id, log_id, stale_ok))[0]
+
+
+async def get_tagged_item(item_id: str, log_id: str | None = None, stale_ok: bool = False) -> tuple[StockValue, str]:
+    # Only reads that tolerate staleness are served from the cache of the Flask app in this worker
+    use_cache = stale_ok and entity_cache is not None
+    if use_cache:
+        cached: tuple[StockValue, str] | None = entity_cache.get_tagged(item_id)
+        if cached is not None:
+            return cached
+        generation = entity_cache.generation
+
+    read_db = reader(stale_ok and not use_cache)
+    fill_generation = generation if use_cache else None
+    if stale_ok:
+        # Concurrent reads of the same item share one fetch, reads for an update never join a fetch that started earlier
+        tagged: tuple[StockValue, str] | None = await item_reads.do(item_id, lambda: read_item(item_id, read_db, fill_generation, stale_ok))
+    else:
+        tagged: tuple[StockValue, str] | None = await read_item(item_id, read_db, fill_generation, stale_ok)
+
+    if tagged is None:
+        return await abort_item_not_found(item_id, log_id)
+    return tagged
+
+
+async def get_item_for_update(item_id: str, log_id: str | None = None) -> tuple[StockValue, Raw]:
+    # Same as the Flask app, the raw bytes read from the master are the before-image of the UPDATE log
+    try:
+        raw_entry: bytes = await reader().get(item_id)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+
+    if not raw_entry:
+        return await abort_item_not_found(item_id, log_id)
+    return msgpack.decode(raw_entry, type=StockValue), Raw(raw_entry)
+
+
+async def abort_item_not_found(item_id: str, log_id: str | None = None):
+    log_key = await get_key(item_id)
+    error_payload = LogStockValue(
+        id=log_id if log_id else str(uuid.uuid4()),
+        type=LogType.SENT,
+        stock_id=item_id,
+        status=LogStatus.FAILURE,
+        dateTime=now()
+    )
+    await db.set(log_key, msgpack.encode(error_payload))
+    return abort(400, f"Item: {item_id} not found! Log key: {log_key}")
+
+
+async def read_item(item_id: str, read_db: redis.asyncio.Redis | AsyncShardedRedis, generation: int | None = None, with_escrow: bool = False) -> tuple[StockValue, str] | None:
+    try:
+        raw_entry: bytes = await read_db.get(item_id)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+
+    if not raw_entry:
+        return None
+    entry: StockValue = msgpack.decode(raw_entry, type=StockValue)
+    etag = entity_etag(raw_entry)
+    if with_escrow and entry.escrow:
+        # Same as the Flask app, reads that tolerate staleness see the sum of the sub-counters of a split item
+        entry.stock += await escrow_stock(read_db, item_id, entry.escrow)
+        etag = entity_etag(raw_entry + msgpack.encode(entry.stock))
+    if generation is not None:
+        entity_cache.put(item_id, entry, len(raw_entry), generation, etag)
+    return entry, etag
+
+
+async def write_update(log_id: str, item_id: str, update_payload: LogStockValue, item_entry: StockValue) -> str:
+    # Set the log entry and the updated item in one transaction
+    log_key = await get_key(item_id)
+    pipeline_db = db.pipeline()
+    pipeline_db.set(log_key, msgpack.encode(update_payload))
+    pipeline_db.set(item_id, msgpack.encode(item_entry))
+    try:
+        await pipeline_db.execute()
+    except redis.exceptions.RedisError:
+        error_payload = LogStockValue(
+            id=log_id,
+            type=LogType.SENT,
+            stock_id=item_id,
+            status=LogStatus.FAILURE,
+            dateTime=now()
+        )
+        await db.set(await get_key(item_id), msgpack.encode(error_payload))
+        return abort(400, DB_ERROR_STR)
+
+    await publish_invalidation(item_id)
+
+    # Create a log entry for the sent response back to the user
+    sent_payload_to_user = LogStockValue(
+        id=log_id,
+        type=LogType.SENT,
+        stock_id=item_id,
+        status=LogStatus.SUCCESS,
+        dateTime=now()
+    )
+    await db.set(await get_key(item_id), msgpack.encode(sent_payload_to_user))
+    return log_key
+
+async def read_counters(read_db: redis.asyncio.Redis | AsyncShardedRedis, keys: list[str]) -> list[bytes | None]:
+    # The async sharded client routes no MGET, a pipeline reads the counters with one round trip per node
+    pipeline_db = read_db.pipeline(transaction=False)
+    for key in keys:
+        pipeline_db.get(key)
+    return await pipeline_db.execute()
+
+
+async def escrow_stock(read_db: redis.asyncio.Redis | AsyncShardedRedis, item_id: str, counters: int) -> int:
+    raw_counters: list[bytes | None] = await read_counters(read_db, [escrow_key(item_id, index) for index in range(counters)])
+    return sum(msgpack.decode(raw_counter, type=StockValue).stock for raw_counter in raw_counters if raw_counter)
+
+
+async def adjust_counter(key: str, change: int, log_id: str, partial: bool = False, finish: bool = False) -> int:
+    # Same as the Flask app, sub-counters are only written by optimistic transactions
+    update_key = await get_key(key)
+    sent_key = await get_key(key) if finish else None
+    async with client_for(db, key).pipeline() as pipeline_db:
+        while True:
+            try:
+                await pipeline_db.watch(key)
+                raw_counter: bytes | None = await pipeline_db.get(key)
+                counter = msgpack.decode(raw_counter, type=StockValue) if raw_counter else StockValue(stock=0, price=0)
+                applied = max(change, -counter.stock) if partial else change
+                if applied == 0 or counter.stock + applied < 0:
+                    return 0
+
+                counter.stock += applied
+                update_payload = LogStockValue(
+                    id=log_id,
+                    type=LogType.UPDATE,
+                    stock_id=key,
+                    old_stockvalue=Raw(raw_counter) if raw_counter else StockValue(stock=0, price=0),
+                    dateTime=now()
+                )
+                pipeline_db.multi()
+                pipeline_db.set(update_key, msgpack.encode(update_payload))
+                pipeline_db.set(key, msgpack.encode(counter))
+                if finish:
+                    sent_payload = LogStockValue(
+                        id=log_id,
+                        type=LogType.SENT,
+                        stock_id=key,
+                        status=LogStatus.SUCCESS,
+                        dateTime=now()
+                    )
+                    pipeline_db.set(sent_key, msgpack.encode(sent_payload))
+                await pipeline_db.execute()
+                return applied
+            except redis.exceptions.WatchError:
+                continue
+
+
+async def subtract_from_escrow(item_id: str, counters: int, amount: int, log_id: str) -> bool:
+    keys = [escrow_key(item_id, index) for index in range(counters)]
+    raw_counters: list[bytes | None] = await read_counters(db, keys)
+    candidates = [key for key, raw_counter in zip(keys, raw_counters) if raw_counter and msgpack.decode(raw_counter, type=StockValue).stock >= amount]
+    random.shuffle(candidates)
+    for key in candidates:
+        if await adjust_counter(key, -amount, log_id, finish=True):
+            await publish_invalidation(item_id)
+            return True
+    return False
+
+
+async def collect_escrow(item_id: str, needed: int):
+    # Same as the Flask app, the caller holds the lock of the item
+    raw_entry: bytes | None = await db.get(item_id)
+    if not raw_entry:
+        return
+    item_entry: StockValue = msgpack.decode(raw_entry, type=StockValue)
+
+    log_id = str(uuid.uuid4())
+    collected_keys = []
+    for index in range(item_entry.escrow):
+        if item_entry.stock >= needed:
+            break
+        key = escrow_key(item_id, index)
+        taken = -await adjust_counter(key, -(needed - item_entry.stock), log_id, partial=True)
+        if taken:
+            item_entry.stock += taken
+            collected_keys.append(key)
+    if not collected_keys:
+        return
+
+    update_payload = LogStockValue(
+        id=log_id,
+        type=LogType.UPDATE,
+        stock_id=item_id,
+        old_stockvalue=Raw(raw_entry),
+        dateTime=now()
+    )
+    pipeline_db = db.pipeline()
+    pipeline_db.set(await get_key(item_id), msgpack.encode(update_payload))
+    pipeline_db.set(item_id, msgpack.encode(item_entry))
+    await pipeline_db.execute()
+    for key in [item_id, *collected_keys]:
+        sent_payload = LogStockValue(
+            id=log_id,
+            type=LogType.SENT,
+            stock_id=key,
+            status=LogStatus.SUCCESS,
+            dateTime=now()
+        )
+        await db.set(await get_key(key), msgpack.encode(sent_payload))
+    await publish_invalidation(item_id)
+
+async def commit_stock_changes(item_id: str, changes: list[StockChange]):
+    # Same as the Flask app, one UPDATE log and one write of the item for the whole batch
+    log_id = str(uuid.uuid4())
+    async with item_lock(item_id):
+        item_entry, old_item_entry = await get_item_for_update(item_id, log_id)
+        needed = -sum(change.change for change in changes if change.change < 0)
+        if item_entry.escrow and item_entry.stock < needed:
+            await collect_escrow(item_id, needed)
+            item_entry, old_item_entry = await get_item_for_update(item_id, log_id)
+
+        for change in changes:
+            change.accepted = item_entry.stock + change.change >= 0
+            if change.accepted:
+                item_entry.stock += change.change
+            change.stock = item_entry.stock
+
+        if any(change.accepted for change in changes):
+            update_payload = LogStockValue(
+                id=log_id,
+                type=LogType.UPDATE,
+                stock_id=item_id,
+                old_stockvalue=old_item_entry,
+                dateTime=now()
+            )
+            log_key = await write_update(log_id, item_id, update_payload, item_entry)
+            for change in changes:
+                if change.accepted:
+                    change.log_id, change.log_key = log_id, log_key
+
+    # Same as the Flask app, the rejected changes share one failure log of their own
+    rejected = [change for change in changes if not change.accepted]
+    if rejected:
+        failure_id, failure_key = str(uuid.uuid4()), await get_key(item_id)
+        error_payload = LogStockValue(
+            id=failure_id,
+            type=LogType.SENT,
+            stock_id=item_id,
+            old_stockvalue=old_item_entry,
+            status=LogStatus.FAILURE,
+            dateTime=now()
+        )
+        await db.set(failure_key, msgpack.encode(error_payload))
+        for change in rejected:
+            change.log_id, change.log_key = failure_id, failure_key
+
+
+def committed_change(item_id: str, change: StockChange):
+    if not change.accepted:
+        return abort(400, f"Item: {item_id} stock cannot get reduced below zero! Log key: {change.log_key}")
+    return PlainTextResponse(f"Item: {item_id} stock updated to: {change.stock}, log_id: {change.log_id}")
+
+########################################################################################################################
+#   START OF MICROSERVICE FUNCTIONS
+########################################################################################################################
+async def create_item(request: Request):
+    price = request.path_params["price"]
+    log_id = str(uuid.uuid4())
+
+    item_id = str(uuid.uuid4())
+    stock_value = StockValue(stock=0, price=int(price))
+
+    # Create a log entry for the create request
+    create_payload = LogStockValue(
+        id=log_id,
+        type=LogType.CREATE,
+        stock_id=item_id,
+        dateTime=now()
+    )
+    await write_update(log_id, item_id, create_payload, stock_value)
+
+    # Feed the price table of the order service, same entry as add_catalog_entry of the Flask app
+    try:
+        await db.xadd(CATALOG_STREAM_KEY, {"item": item_id, "price": stock_value.price}, maxlen=CATALOG_STREAM_LENGTH, approximate=True)
+    except redis.exceptions.RedisError:
+        pass    # The item is created, without its entry the order service asks the stock service for its price
+
+    return JSONResponse({'item_id': item_id, 'log_id': log_id})
+
+
+async def find_item(request: Request):
+    item_id = request.path_params["item_id"]
+    log_id = str(uuid.uuid4())
+
+    # The log id is only logged for items that are not found
+    item_entry, etag = await get_tagged_item(item_id, log_id, stale_ok=True)
+
+    headers = validator_headers(etag)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse({"stock": item_entry.stock, "price": item_entry.price}, headers=headers)
+
+
+async def add_stock(request: Request):
+    item_id, amount = request.path_params["item_id"], request.path_params["amount"]
+    log_id = str(uuid.uuid4())
+
+    if item_commits is not None:
+        return committed_change(item_id, await item_commits.submit(item_id, int(amount), commit_stock_changes))
+
+    async with item_lock(item_id):
+        # Get the item from the database, its stored bytes are kept for the rollback purposes
+        item_entry, old_item_entry = await get_item_for_update(item_id)
+
+        item_entry.stock += int(amount)
+
+        # Create a log entry for the update request
+        update_payload = LogStockValue(
+            id=log_id,
+            type=LogType.UPDATE,
+            stock_id=item_id,
+            old_stockvalue=old_item_entry,
+            dateTime=now()
+        )
+        await write_update(log_id, item_id, update_payload, item_entry)
+
+    return PlainTextResponse(f"Item: {item_id} stock updated to: {item_entry.stock}, log_id: {log_id}")
+
+
+async def remove_stock(request: Request):
+    item_id, amount = request.path_params["item_id"], request.path_params["amount"]
+    log_id = str(uuid.uuid4())
+
+    # Same as the Flask app, a split item is subtracted from one of its sub-counters without its lock
+    if item_id in escrow_items and await subtract_from_escrow(item_id, escrow_items[item_id], int(amount), log_id):
+        return PlainTextResponse(f"Item: {item_id} stock updated, log_id: {log_id}")
+
+    if item_commits is not None:
+        return committed_change(item_id, await item_commits.submit(item_id, -int(amount), commit_stock_changes))
+
+    async with item_lock(item_id):
+        # Get the item from the database, its stored bytes are kept for the rollback purposes
+        item_entry, old_item_entry = await get_item_for_update(item_id)
+        if item_entry.escrow and item_entry.stock < int(amount):
+            await collect_escrow(item_id, int(amount))
+            item_entry, old_item_entry = await get_item_for_update(item_id)
+
+        item_entry.stock -= int(amount)
+
+        # Check if the stock is below zero
+        if item_entry.stock < 0:
+            error_payload = LogStockValue(
+                id=log_id,
+                type=LogType.SENT,
+                stock_id=item_id,
+                old_stockvalue=old_item_entry,
+                status=LogStatus.FAILURE,
+                dateTime=now()
+            )
+            log_key = await get_key(item_id)
+            await db.set(log_key, msgpack.encode(error_payload))
+
+            return abort(400, f"Item: {item_id} stock cannot get reduced below zero! Log key: {log_key}")
+
+        # Create a log entry for the update request
+        update_payload = LogStockValue(
+            id=log_id,
+            type=LogType.UPDATE,
+            stock_id=item_id,
+            old_stockvalue=old_item_entry,
+            dateTime=now()
+        )
+        await write_update(log_id, item_id, update_payload, item_entry)
+
+    return PlainTextResponse(f"Item: {item_id} stock updated to: {item_entry.stock}, log_id: {log_id}")
+
+
+app = Starlette(
+    routes=[
+        Route('/item/create/{price}', create_item, methods=["POST"]),
+        # With STOCK_PARTITIONS the items are changed by their partition owners, which the Flask app routes to
+        *([] if STOCK_PARTITIONS else [
+            Route('/find/{item_id}', find_item, methods=["GET"]),
+            Route('/add/{item_id}/{amount}', add_stock, methods=["POST"]),
+            Route('/subtract/{item_id}/{amount}', remove_stock, methods=["POST"]),
+        ]),
+        # Every other endpoint is served by the Flask app
+        Mount('/', WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan,
+)
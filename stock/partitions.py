@@ -0,0 +1,383 @@
+"""Single-writer partitions of the stock, kept in the memory of the worker that owns them.
+
+Items are hashed to a fixed number of partitions. Every partition is owned by one worker at a time through a lease in
+Redis, and only its owner changes its items: the owner pops the requests of the partition from a Redis list, applies
+them one after the other to a dict in memory and pushes every answer on the reply list of its request. No request waits
+for a lock, the queue of the partition puts its requests in order.
+
+The changes of a batch of requests are appended to the write-ahead log of the partition (a Redis stream) in the script
+that sends the replies, and that script first checks the lease, so a worker that lost its partition can no longer
+change it. The log holds the new values, not the operations, so replaying an entry twice does no harm. Every
+SNAPSHOT_INTERVAL seconds the owner stores a snapshot of the partition and trims the log up to it, a new owner loads the
+snapshot and replays the rest of the log. The snapshot also writes the stock of the changed items to their keys, so the
+readers of the rest of the service see it with the delay of one snapshot.
+
+All keys of a partition share the hash tag `{partition:<n>}`, so they live on one node and the script can touch them.
+"""
+import hashlib
+import math
+import random
+import threading
+import uuid
+from time import time
+
+import redis
+from msgspec import msgpack
+
+from sharding import ShardedRedis, client_for
+
+
+PARTITION_LEASE = 10                 # Seconds an owner keeps its partitions without renewing the leases
+REQUEST_TIMEOUT = 5                  # Seconds a request waits for its reply, older requests are skipped by the owner
+REPLY_GRACE = 2                      # Seconds a caller keeps waiting for a request the owner took just before its deadline
+REPLY_TTL = 30                       # Seconds a reply is kept, also after it was read
+BATCH_SIZE = 256                     # Requests applied and committed together
+SNAPSHOT_INTERVAL = 5                # Seconds between two snapshots of a partition with changes
+TOMBSTONE_TTL = 3600                 # Seconds a release of a reservation that holds nothing here yet is remembered
+WORKERS_KEY = "{partitions}:workers"
+
+# Appends the changes of a batch to the log and sends its replies, only while the caller still holds the lease. Every
+# reply is pushed on the list its caller waits on and stored under the id of its request, where the caller reads it
+# again when the wait timed out
+commit_script_source = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return false
+end
+local entry_id = ''
+if ARGV[2] ~= '' then
+    entry_id = redis.call('XADD', KEYS[2], '*', 'changes', ARGV[2])
+end
+local replies = (#KEYS - 2) / 2
+for i = 1, replies do
+    redis.call('RPUSH', KEYS[2 + i], ARGV[3 + i])
+    redis.call('EXPIRE', KEYS[2 + i], ARGV[3])
+    redis.call('SET', KEYS[2 + replies + i], ARGV[3 + i], 'EX', ARGV[3])
+end
+return entry_id
+"""
+
+# Stores a snapshot and trims the log up to it, only while the caller still holds the lease
+snapshot_script_source = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2])
+redis.call('XTRIM', KEYS[3], 'MINID', '~', ARGV[3])
+return 1
+"""
+
+renew_script_source = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+release_script_source = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class PartitionTimeout(Exception):
+    pass
+
+
+def partition_key(partition: int, name: str) -> str:
+    return f"{{partition:{partition}}}:{name}"
+
+
+def reply_keys(partition: int, request_id: str) -> tuple[str, str]:
+    # The list the caller waits on and the copy of the reply that stays readable for REPLY_TTL
+    return partition_key(partition, f"reply:{request_id}"), partition_key(partition, f"result:{request_id}")
+
+
+class PartitionState:
+    """The items and stock holds of one partition. apply() answers a request and returns the changes it made."""
+
+    def __init__(self, items: dict | None = None, holds: dict | None = None, released: dict | None = None):
+        self.items: dict[str, list[int]] = items or {}                 # Item id to [stock, price, escrow]
+        self.holds: dict[str, list[list]] = holds or {}                # Reservation id to its [item id, amount] lines
+        self.released: dict[str, float] = released or {}               # Reservation id to the time it was released
+
+    def apply(self, op: str, args: list) -> tuple[list, list]:
+        if op == "find":
+            item = self.items.get(args[0])
+            return ([True, item[0], item[1]] if item else [False, f"Item: {args[0]} not found!"]), []
+        if op in ("add", "subtract"):
+            item_id, amount = args[0], int(args[1])
+            item = self.items.get(item_id)
+            if item is None:
+                return [False, f"Item: {item_id} not found!"], []
+            stock = item[0] + amount if op == "add" else item[0] - amount
+            if stock < 0:
+                return [False, f"Item: {item_id} stock cannot get reduced below zero!"], []
+            item[0] = stock
+            return [True, stock], [["item", item_id, *item]]
+        if op == "hold":
+            reservation_id, lines = args[0], args[1]
+            if reservation_id in self.holds:
+                return [True, None], []
+            if reservation_id in self.released:
+                return [False, f"Reservation: {reservation_id} expired or was released before its stock was held"], []
+            for item_id, amount in lines:
+                item = self.items.get(item_id)
+                if item is None:
+                    return [False, f"Item: {item_id} not found!"], []
+                if item[0] < amount:
+                    return [False, f"Item: {item_id} stock cannot get reduced below zero!"], []
+            changes = []
+            for item_id, amount in lines:
+                item = self.items[item_id]
+                item[0] -= amount
+                changes.append(["item", item_id, *item])
+            self.holds[reservation_id] = lines
+            return [True, None], changes + [["hold", reservation_id, lines]]
+        if op == "confirm":
+            if self.holds.pop(args[0], None) is None:
+                return [False, f"Reservation: {args[0]} holds no stock here!"], []
+            return [True, None], [["drop", args[0]]]
+        if op == "release":
+            lines = self.holds.pop(args[0], None)
+            if lines is None:
+                # The hold may still be on its way in a later batch, it is refused when it arrives
+                self.released[args[0]] = time()
+                return [True, None], [["released", args[0], self.released[args[0]]]]
+            changes = []
+            for item_id, amount in lines:
+                item = self.items.get(item_id)
+                if item is not None:
+                    item[0] += amount
+                    changes.append(["item", item_id, *item])
+            return [True, None], changes + [["drop", args[0]]]
+        return [False, f"Unknown operation: {op}"], []
+
+    def replay(self, changes: list):
+        for change in changes:
+            if change[0] == "item":
+                self.items[change[1]] = list(change[2:])
+            elif change[0] == "hold":
+                self.holds[change[1]] = change[2]
+            elif change[0] == "drop":
+                self.holds.pop(change[1], None)
+            elif change[0] == "released":
+                self.released[change[1]] = change[2]
+
+    def forget_released(self, before: float):
+        self.released = {reservation_id: released for reservation_id, released in self.released.items() if released >= before}
+
+
+def request_items(op: str, args: list) -> list[str]:
+    if op in ("find", "add", "subtract"):
+        return [args[0]]
+    if op == "hold":
+        return [item_id for item_id, _ in args[1]]
+    return []
+
+
+class PartitionOwner:
+    """Serves one partition in a thread of the worker that holds its lease."""
+
+    def __init__(self, partitions: "Partitions", partition: int):
+        self.partitions = partitions
+        self.partition = partition
+        self.client: redis.Redis = client_for(partitions.db, partition_key(partition, "owner"))
+        self.stop = threading.Event()
+        self.stopped = threading.Event()
+        self.state = PartitionState()
+        self.last_id = "0-0"
+        self.dirty: set[str] = set()
+        self.applied = 0
+
+    def load(self):
+        raw_snapshot: bytes | None = self.client.get(partition_key(self.partition, "snapshot"))
+        if raw_snapshot:
+            # Snapshots of older versions have no released reservations
+            self.last_id, items, holds, *released = msgpack.decode(raw_snapshot)
+            self.state = PartitionState(items, holds, *released)
+        start = f"({self.last_id}" if self.last_id != "0-0" else "-"
+        for entry_id, fields in self.client.xrange(partition_key(self.partition, "wal"), min=start):
+            self.state.replay(msgpack.decode(fields[b"changes"]))
+            self.last_id = entry_id.decode('utf-8')
+            self.dirty.update(change[1] for change in msgpack.decode(fields[b"changes"]) if change[0] == "item")
+
+    def fetch_items(self, item_ids: set[str]):
+        # Items this partition has not seen yet are read from their keys, where the rest of the service created them
+        missing = [item_id for item_id in item_ids if item_id not in self.state.items]
+        if not missing:
+            return
+        for item_id, raw_entry in zip(missing, self.partitions.db.mget(missing)):
+            if raw_entry:
+                entry = msgpack.decode(raw_entry)
+                self.state.items[item_id] = [entry["stock"], entry["price"], entry.get("escrow", 0)]
+
+    def serve_batch(self, raw_requests: list[bytes]) -> bool:
+        requests = [msgpack.decode(raw_request) for raw_request in raw_requests]
+        now = time()
+        requests = [request for request in requests if request[1] >= now]
+        self.fetch_items({item_id for request in requests for item_id in request_items(request[2], request[3:])})
+
+        list_keys, result_keys, replies, changes = [], [], [], []
+        for request_id, _, op, *args in requests:
+            reply, request_changes = self.state.apply(op, args)
+            list_key, result_key = reply_keys(self.partition, request_id)
+            list_keys.append(list_key)
+            result_keys.append(result_key)
+            replies.append(msgpack.encode(reply))
+            changes.extend(request_changes)
+        if not list_keys:
+            return True
+
+        entry_id = self.partitions.commit_script(
+            keys=[partition_key(self.partition, "owner"), partition_key(self.partition, "wal"), *list_keys, *result_keys],
+            args=[self.partitions.worker_id, msgpack.encode(changes) if changes else "", REPLY_TTL, *replies],
+        )
+        if entry_id is None:
+            # The lease is gone, the changes in memory were never logged and are dropped with the state
+            return False
+        if entry_id:
+            self.last_id = entry_id.decode('utf-8') if isinstance(entry_id, bytes) else entry_id
+            self.dirty.update(change[1] for change in changes if change[0] == "item")
+        self.applied += len(list_keys)
+        return True
+
+    def snapshot(self) -> bool:
+        self.state.forget_released(time() - TOMBSTONE_TTL)
+        stored = self.partitions.snapshot_script(
+            keys=[partition_key(self.partition, "owner"), partition_key(self.partition, "snapshot"), partition_key(self.partition, "wal")],
+            args=[self.partitions.worker_id, msgpack.encode([self.last_id, self.state.items, self.state.holds, self.state.released]), self.last_id],
+        )
+        if not stored:
+            return False
+
+        if self.dirty:
+            # The escrow of an item that was split before the partitions were enabled is kept, entries of older versions
+            # have none
+            self.partitions.db.mset({
+                item_id: msgpack.encode(dict(zip(("stock", "price", "escrow"), self.state.items[item_id])))
+                for item_id in self.dirty if item_id in self.state.items
+            })
+            self.dirty = set()
+        return True
+
+    def run(self):
+        requests_key = partition_key(self.partition, "requests")
+        try:
+            self.load()
+            last_snapshot = time()
+            while not self.stop.is_set():
+                popped = self.client.blpop([requests_key], timeout=1)
+                if popped is not None:
+                    raw_requests = [popped[1], *(self.client.lpop(requests_key, BATCH_SIZE - 1) or [])]
+                    if not self.serve_batch(raw_requests):
+                        return
+                if self.dirty and time() - last_snapshot >= SNAPSHOT_INTERVAL:
+                    if not self.snapshot():
+                        return
+                    last_snapshot = time()
+            # A partition that is handed over leaves a fresh snapshot, so the next owner replays nothing
+            if self.snapshot():
+                self.partitions.release_script(keys=[partition_key(self.partition, "owner")], args=[self.partitions.worker_id])
+        except redis.exceptions.RedisError as exc:
+            self.partitions.logger.error(f"Partition {self.partition} stopped: {exc}")
+        finally:
+            self.stopped.set()
+
+
+class Partitions:
+    """Routes the requests of the items to the owners of their partitions and takes a fair share of the partitions."""
+
+    def __init__(self, db: redis.Redis | ShardedRedis, count: int, worker_id: str, logger):
+        self.db = db
+        self.count = count
+        self.worker_id = worker_id
+        self.logger = logger
+        self.owned: dict[int, PartitionOwner] = {}
+        self.commit_script = db.register_script(commit_script_source)
+        self.snapshot_script = db.register_script(snapshot_script_source)
+        self.renew_script = db.register_script(renew_script_source)
+        self.release_script = db.register_script(release_script_source)
+
+    def partition_of(self, item_id: str) -> int:
+        return int.from_bytes(hashlib.md5(item_id.encode('utf-8')).digest()[:8], "big") % self.count
+
+    def call_many(self, calls: list[tuple[int, list]]) -> list[list]:
+        # All requests are queued before the first reply is awaited, so the partitions work on them at the same time
+        deadline = time() + REQUEST_TIMEOUT
+        requests = []
+        for partition, command in calls:
+            request_id = str(uuid.uuid4())
+            self.db.rpush(partition_key(partition, "requests"), msgpack.encode([request_id, deadline, *command]))
+            requests.append((partition, request_id))
+
+        replies = []
+        for partition, request_id in requests:
+            list_key, result_key = reply_keys(partition, request_id)
+            popped = client_for(self.db, list_key).blpop([list_key], timeout=max(1, math.ceil(deadline + REPLY_GRACE - time())))
+            raw_reply: bytes | None = popped[1] if popped is not None else self.db.get(result_key)
+            if raw_reply is None:
+                # The owner skips requests past their deadline and commits the ones it took within REPLY_GRACE
+                raise PartitionTimeout(f"Partition {partition} did not answer request {request_id} in time")
+            replies.append(msgpack.decode(raw_reply))
+        return replies
+
+    def call(self, item_id: str, op: str, *args) -> list:
+        return self.call_many([(self.partition_of(item_id), [op, item_id, *args])])[0]
+
+    def live_workers(self) -> int:
+        now = time()
+        pipeline_workers = self.db.pipeline()
+        pipeline_workers.zadd(WORKERS_KEY, {self.worker_id: now})
+        pipeline_workers.zremrangebyscore(WORKERS_KEY, "-inf", now - PARTITION_LEASE)
+        pipeline_workers.zcard(WORKERS_KEY)
+        return max(1, pipeline_workers.execute()[2])
+
+    def balance(self):
+        # Renews the leases, drops the partitions whose thread stopped, then takes or hands over one partition at a time
+        for partition, owner in list(self.owned.items()):
+            if owner.stopped.is_set() or not self.renew_script(keys=[partition_key(partition, "owner")], args=[self.worker_id, PARTITION_LEASE * 1000]):
+                owner.stop.set()
+                del self.owned[partition]
+
+        share = math.ceil(self.count / self.live_workers())
+        if len(self.owned) > share:
+            partition, owner = next(iter(self.owned.items()))
+            owner.stop.set()
+            del self.owned[partition]
+            return
+
+        free = [partition for partition in range(self.count) if partition not in self.owned]
+        random.shuffle(free)
+        for partition in free:
+            if len(self.owned) >= share:
+                break
+            if self.db.set(partition_key(partition, "owner"), self.worker_id, nx=True, px=PARTITION_LEASE * 1000):
+                owner = PartitionOwner(self, partition)
+                self.owned[partition] = owner
+                threading.Thread(target=owner.run, name=f"partition-{partition}", daemon=True).start()
+
+    def ownership_loop(self, stop: threading.Event):
+        while not stop.wait(PARTITION_LEASE / 3):
+            try:
+                self.balance()
+            except redis.exceptions.RedisError as exc:
+                self.logger.error(f"Balancing the partitions failed: {exc}")
+        for owner in self.owned.values():
+            owner.stop.set()
+
+    def status(self) -> dict:
+        pipeline_status = self.db.pipeline(transaction=False)
+        for partition in range(self.count):
+            pipeline_status.get(partition_key(partition, "owner"))
+            pipeline_status.llen(partition_key(partition, "requests"))
+        results = pipeline_status.execute()
+        return {
+            "worker": self.worker_id,
+            "owned": {partition: owner.applied for partition, owner in self.owned.items()},
+            "partitions": [
+                {"partition": partition, "owner": owner.decode('utf-8') if owner else None, "queued": queued}
+                for partition, (owner, queued) in enumerate(zip(results[::2], results[1::2]))
+            ],
+        }
@@ -0,0 +1,113 @@
+"""Checkout saga events between the order, stock and payment services over Redis Streams.
+
+The order service appends a `requested` event for every checkout to CHECKOUT_STREAM. The stock and payment services
+read it in their own consumer group, hold the stock and the credit, and append their outcome to OUTCOME_STREAM, which
+the order service reads in its own consumer group. Once both outcomes are in, or one of them failed, the order service
+appends `completed` or `cancelled` to CHECKOUT_STREAM, on which stock and payment keep or give back their holds. No
+service waits for another one, every worker handles the events at the pace of its own database.
+
+An entry is acknowledged after it was handled, and the entries that a consumer left unacknowledged, because its worker
+died or restarted, are claimed by another consumer of the group after CLAIM_IDLE. Every event is therefore handled at
+least once, and the handlers are idempotent: the holds are keyed by the saga id, and the order service only records the
+first outcome of every service. Stock and payment keep the outcome of every hold, so a request that is delivered again
+after its saga was decided is answered with that outcome instead of being held a second time. A service that was down
+reads the entries it missed from the position of its group, and a saga that is still pending at its deadline, because
+an outcome was lost, is cancelled by a sweeper in the order service.
+
+This file is the same in the order, stock and payment services on purpose, see sharding.py.
+"""
+import threading
+
+import redis
+from msgspec import msgpack
+
+from sharding import parse_nodes
+
+
+CHECKOUT_STREAM = "saga:checkout"      # Order to stock and payment: requested, completed, cancelled
+OUTCOME_STREAM = "saga:outcomes"       # Stock and payment to order: the outcome of their hold
+STREAM_LENGTH = 1000000                # Approximate entries kept per stream
+READ_BATCH = 100                       # Entries read and handled together
+READ_BLOCK = 1000                      # Milliseconds a read waits for new entries
+CLAIM_IDLE = 30000                     # Milliseconds before an unacknowledged entry is handed to another consumer
+OUTCOME_TTL = 86400                    # Seconds the outcome of a hold is kept for redelivered requests
+
+
+def bus_client(address: str, password: str) -> redis.Redis:
+    # The streams live on one Redis node, the consumer group commands take no key as their first argument
+    (host, port), = parse_nodes(address)
+    return redis.Redis(host=host, port=port, password=password, db=0)
+
+
+class SagaBus:
+    """Appends events to the saga streams and feeds the entries of one stream to a handler, in a consumer group."""
+
+    def __init__(self, client: redis.Redis, group: str, consumer: str, logger):
+        self.client = client
+        self.group = group
+        self.consumer = consumer
+        self.logger = logger
+        self.handled = 0
+        self.claimed = 0
+
+    def publish(self, stream: str, event: dict) -> bytes:
+        return self.client.xadd(stream, {"event": msgpack.encode(event)}, maxlen=STREAM_LENGTH, approximate=True)
+
+    def answer(self, event: dict, service: str, hold):
+        # hold() places the hold of a requested event and returns (ok, detail), once per saga and service
+        outcome_key = f"saga:{event['saga_id']}:{service}"
+        raw_outcome: bytes | None = self.client.get(outcome_key)
+        if raw_outcome is None:
+            self.client.set(outcome_key, msgpack.encode(hold()), nx=True, ex=OUTCOME_TTL)
+            raw_outcome = self.client.get(outcome_key)
+        ok, detail = msgpack.decode(raw_outcome)
+        self.publish(OUTCOME_STREAM, {"saga_id": event["saga_id"], "order_id": event["order_id"], "service": service, "ok": ok, "detail": detail})
+
+    def create_group(self, stream: str):
+        # A new group starts at the beginning of the stream, so the events appended before the first start are handled
+        try:
+            self.client.xgroup_create(stream, self.group, id="0", mkstream=True)
+        except redis.exceptions.ResponseError as exc:
+            if "BUSYGROUP" not in str(exc):
+                raise
+
+    def read(self, stream: str) -> list[tuple[bytes, dict]]:
+        # Entries abandoned by other consumers first, then new ones
+        _, claimed, *_ = self.client.xautoclaim(stream, self.group, self.consumer, CLAIM_IDLE, "0-0", count=READ_BATCH)
+        claimed = [(entry_id, fields) for entry_id, fields in claimed if fields]
+        if claimed:
+            self.claimed += len(claimed)
+            return claimed
+        reply = self.client.xreadgroup(self.group, self.consumer, {stream: ">"}, count=READ_BATCH, block=READ_BLOCK)
+        return reply[0][1] if reply else []
+
+    def consume(self, stream: str, handle, stop: threading.Event, errors: tuple = ()):
+        # A handler that raises one of errors leaves its entry pending, like a failed Redis command
+        created = False
+        while not stop.is_set():
+            try:
+                if not created:
+                    self.create_group(stream)
+                    created = True
+                for entry_id, fields in self.read(stream):
+                    handle(msgpack.decode(fields[b"event"]))
+                    self.client.xack(stream, self.group, entry_id)
+                    self.handled += 1
+            except (redis.exceptions.RedisError, *errors) as exc:
+                # The entry stays pending and is read again once it was idle for CLAIM_IDLE
+                self.logger.error(f"Consuming {stream} failed: {exc}")
+                created = False
+                stop.wait(1)
+
+    def status(self, stream: str) -> dict:
+        groups = {group["name"].decode('utf-8'): group for group in self.client.xinfo_groups(stream)} if self.client.exists(stream) else {}
+        group = groups.get(self.group, {})
+        return {
+            "stream": stream,
+            "length": self.client.xlen(stream),
+            "group": self.group,
+            "pending": group.get("pending", 0),
+            "lag": group.get("lag"),
+            "handled": self.handled,
+            "claimed": self.claimed,
+        }
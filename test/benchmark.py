@@ -0,0 +1,383 @@
+"""Benchmarks for the services, run against a running deployment (e.g. `docker-compose up`).
+
+Usage:
+    python benchmark.py recovery --transactions 100000
+    python benchmark.py startup --transactions 10000
+    python benchmark.py workers --checkouts 2000 --clients 64
+    python benchmark.py asyncio --checkouts 5000 --clients 512
+    python benchmark.py additems --baskets 500 --lines 20 --clients 32
+    python benchmark.py rollbackimages --updates 20000 --sizes 1,10,100,1000
+    python benchmark.py logbytes --sizes 10,100,1000
+    python benchmark.py engine --subtracts 20000 --items 1,100 --clients 64
+"""
+import argparse
+import os
+import subprocess
+import uuid
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from datetime import datetime
+from msgspec import msgpack, Raw
+
+from time import perf_counter, process_time, sleep
+
+from class_utils import LogType, OrderValue, OrderDelta, LogOrderValue
+
+import utils as tu
+
+########################################################################################################################
+#   RECOVERY BENCHMARK
+########################################################################################################################
+
+def time_fault_tolerance(service_url: str) -> float:
+    start = perf_counter()
+    response = requests.get(f"{service_url}/fault_tolerance/5")
+    elapsed = perf_counter() - start
+    if not tu.status_code_is_success(response.status_code):
+        raise RuntimeError(f"Recovery failed: {response.text}")
+    return elapsed
+
+
+def seed_backlog(service_url: str, transactions: int, **params):
+    response = requests.post(f"{service_url}/recovery/seed/{transactions}", params=params)
+    if not tu.status_code_is_success(response.status_code):
+        raise RuntimeError(f"Seeding failed: {response.text}")
+
+
+def benchmark_recovery(transactions: int):
+    # An item that receives the stock compensations of the seeded checkouts
+    item_id = tu.create_item(1)['item_id']
+
+    scenarios = [
+        ("stock updates", f"{tu.STOCK_URL}/stock", {}),
+        ("payment updates", f"{tu.PAYMENT_URL}/payment", {}),
+        ("order updates", f"{tu.ORDER_URL}/orders", {}),
+        ("order checkout compensations", f"{tu.ORDER_URL}/orders", {"item_id": item_id}),
+    ]
+    for name, service_url, params in scenarios:
+        seed_backlog(service_url, transactions, **params)
+        elapsed = time_fault_tolerance(service_url)
+        print(f"{name:<30} {transactions} transactions recovered in {elapsed:.2f}s ({transactions / elapsed:.0f} tx/s)")
+
+    stock = tu.find_item(item_id)['stock']
+    print(f"Stock compensations applied: {stock}/{transactions}")
+
+
+########################################################################################################################
+#   STARTUP BENCHMARK
+########################################################################################################################
+
+def wait_for(url: str, timeout: float) -> float:
+    start = perf_counter()
+    while perf_counter() - start < timeout:
+        try:
+            if tu.status_code_is_success(requests.get(url).status_code):
+                return perf_counter() - start
+        except requests.exceptions.ConnectionError:
+            pass
+        sleep(0.1)
+    raise RuntimeError(f"{url} did not respond within {timeout}s")
+
+
+def benchmark_startup(transactions: int, timeout: float):
+    services = [
+        ("stock", "stock-service", tu.STOCK_URL + "/stock"),
+        ("payment", "payment-service", tu.PAYMENT_URL + "/payment"),
+        ("order", "order-service", tu.ORDER_URL + "/orders"),
+    ]
+    for _, _, service_url in services:
+        seed_backlog(service_url, transactions)
+
+    subprocess.run(["docker", "compose", "restart", *(container for _, container, _ in services)], check=True)
+
+    # Serving should start right away, readiness only once the recovery leader caught up
+    for name, _, service_url in services:
+        serving = wait_for(f"{service_url}/recovery/status", timeout)
+        ready = wait_for(f"{service_url}/ready", timeout)
+        status = requests.get(f"{service_url}/recovery/status").json()
+        print(f"{name:<10} serving after {serving:.2f}s, ready after {serving + ready:.2f}s, "
+              f"leader cold start {status.get('cold_start_seconds', 0):.2f}s, "
+              f"duplicate recoveries {status.get('duplicate_recoveries', 0):.0f}")
+
+
+########################################################################################################################
+#   WORKER CLASS BENCHMARK
+########################################################################################################################
+
+WORKER_CONFIGS = [
+    ("sync", {"WORKER_CLASS": "sync", "WORKER_THREADS": "1"}),
+    ("gthread", {"WORKER_CLASS": "gthread", "WORKER_THREADS": "16"}),
+    ("gevent", {"WORKER_CLASS": "gevent", "WORKER_CONNECTIONS": "1000"}),
+]
+
+
+def checkout_once(user_id: str, item_id: str) -> bool:
+    order_id = tu.create_order(user_id)['order_id']
+    tu.add_item_to_order(order_id, item_id, 1)
+    return tu.status_code_is_success(tu.checkout_order(order_id).status_code)
+
+
+def run_checkout_load(checkouts: int, clients: int) -> tuple[float, int]:
+    # Every client gets its own item and user, so the load measures the workers and not the stock locks
+    per_client = -(-checkouts // clients)
+    item_ids, user_ids = [], []
+    for _ in range(clients):
+        item_id = tu.create_item(1)['item_id']
+        tu.add_stock(item_id, per_client)
+        item_ids.append(item_id)
+        user_id = tu.create_user()['user_id']
+        tu.add_credit_to_user(user_id, per_client)
+        user_ids.append(user_id)
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(lambda i: checkout_once(user_ids[i % clients], item_ids[i % clients]), range(checkouts)))
+    return perf_counter() - start, sum(results)
+
+
+def benchmark_workers(checkouts: int, clients: int, timeout: float):
+    for name, config in WORKER_CONFIGS:
+        subprocess.run(["docker", "compose", "up", "-d", "--force-recreate"], env={**os.environ, **config}, check=True)
+        wait_for(f"{tu.ORDER_URL}/orders/recovery/status", timeout)
+
+        elapsed, succeeded = run_checkout_load(checkouts, clients)
+        print(f"{name:<10} {succeeded}/{checkouts} checkouts with {clients} clients in {elapsed:.2f}s "
+              f"({checkouts / elapsed:.0f} checkouts/s)")
+
+
+########################################################################################################################
+#   ASYNCIO BENCHMARK
+########################################################################################################################
+
+# Both setups run two worker processes per service, so they get the same CPU budget
+SERVING_MODES = [
+    ("gunicorn -w 2", ["-f", "../docker-compose.yml"]),
+    ("asyncio -w 2", ["-f", "../docker-compose.yml", "-f", "../docker-compose.async.yml"]),
+]
+
+
+def benchmark_asyncio(checkouts: int, clients: int, timeout: float):
+    for name, compose_files in SERVING_MODES:
+        subprocess.run(["docker", "compose", *compose_files, "up", "-d", "--force-recreate"], check=True)
+        wait_for(f"{tu.ORDER_URL}/orders/recovery/status", timeout)
+
+        elapsed, succeeded = run_checkout_load(checkouts, clients)
+        print(f"{name:<15} {succeeded}/{checkouts} checkouts with {clients} clients in {elapsed:.2f}s "
+              f"({checkouts / elapsed:.0f} checkouts/s)")
+
+
+########################################################################################################################
+#   BATCH ADD ITEMS BENCHMARK
+########################################################################################################################
+
+def fill_basket_per_item(order_id: str, basket: list[tuple[str, int]]) -> bool:
+    return all(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id, quantity)) for item_id, quantity in basket)
+
+
+def fill_basket_batch(order_id: str, basket: list[tuple[str, int]]) -> bool:
+    return tu.status_code_is_success(tu.add_items_to_order(order_id, basket))
+
+
+def benchmark_add_items(baskets: int, lines: int, clients: int):
+    user_id = tu.create_user()['user_id']
+    basket = [(tu.create_item(1)['item_id'], 1) for _ in range(lines)]
+
+    for name, fill_basket in (("per item", fill_basket_per_item), ("addItems", fill_basket_batch)):
+        order_ids = [tu.create_order(user_id)['order_id'] for _ in range(baskets)]
+
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            results = list(executor.map(lambda order_id: fill_basket(order_id, basket), order_ids))
+        elapsed = perf_counter() - start
+        print(f"{name:<10} {sum(results)}/{baskets} baskets of {lines} lines with {clients} clients in {elapsed:.2f}s "
+              f"({baskets * lines / elapsed:.0f} lines/s)")
+
+
+########################################################################################################################
+#   ROLLBACK IMAGES BENCHMARK
+########################################################################################################################
+
+def update_with_copy(raw_entry: bytes) -> tuple[bytes, bytes]:
+    # The previous update path: decode, deepcopy the old value and encode the copy again into the UPDATE log
+    order_entry = msgpack.decode(raw_entry, type=OrderValue)
+    old_order_entry = deepcopy(order_entry)
+    order_entry.paid = True
+    update_payload = LogOrderValue(id="log", type=LogType.UPDATE, order_id="order", old_ordervalue=old_order_entry,
+                                   dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"))
+    return msgpack.encode(update_payload), msgpack.encode(order_entry)
+
+
+def update_with_raw(raw_entry: bytes) -> tuple[bytes, bytes]:
+    # The current update path: the bytes read from Redis are embedded as the old value
+    order_entry = msgpack.decode(raw_entry, type=OrderValue)
+    order_entry.paid = True
+    update_payload = LogOrderValue(id="log", type=LogType.UPDATE, order_id="order", old_ordervalue=Raw(raw_entry),
+                                   dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f"))
+    return msgpack.encode(update_payload), msgpack.encode(order_entry)
+
+
+def benchmark_rollback_images(updates: int, sizes: list[int]):
+    # Runs in this process without a deployment, it times the CPU a service spends on the values of one update
+    for size in sizes:
+        order_entry = OrderValue(paid=False, items=[(f"item-{i:06}", 1) for i in range(size)], user_id="user", total_cost=size)
+        raw_entry = msgpack.encode(order_entry)
+        # Both paths must log the same before-image
+        assert all(msgpack.decode(update(raw_entry)[0], type=LogOrderValue).old_ordervalue == order_entry for update in (update_with_copy, update_with_raw))
+
+        timings = {}
+        for name, update in (("deepcopy", update_with_copy), ("raw", update_with_raw)):
+            start = process_time()
+            for _ in range(updates):
+                update(raw_entry)
+            timings[name] = (process_time() - start) / updates * 1e6
+        print(f"{size:>5} items: deepcopy {timings['deepcopy']:8.1f}us  raw {timings['raw']:8.1f}us  "
+              f"({timings['deepcopy'] / timings['raw']:.1f}x)")
+
+
+########################################################################################################################
+#   LOG BYTES BENCHMARK
+########################################################################################################################
+
+def basket_update_logs(lines: int, with_delta: bool) -> list[bytes]:
+    # The UPDATE logs of filling a basket with one addItem per line and checking it out
+    order_entry = OrderValue(paid=False, items=[], user_id=str(uuid.uuid4()), total_cost=0)
+    logs = []
+    for _ in range(lines + 1):
+        old_order_entry = msgpack.decode(msgpack.encode(order_entry), type=OrderValue)
+        if len(order_entry.items) < lines:
+            line = (str(uuid.uuid4()), 1)
+            order_entry.items.append(line)
+            order_entry.total_cost += 10
+            delta = OrderDelta(items=[line], cost=10)
+        else:
+            delta = OrderDelta(old_paid=order_entry.paid)
+            order_entry.paid = True
+        logs.append(msgpack.encode(LogOrderValue(
+            id=str(uuid.uuid4()), type=LogType.UPDATE, order_id=str(uuid.uuid4()),
+            old_ordervalue=None if with_delta else old_order_entry, delta=delta if with_delta else None,
+            dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
+        )))
+    return logs
+
+
+def benchmark_log_bytes(sizes: list[int]):
+    # Runs in this process without a deployment, the logs are encoded like the order service writes them
+    for size in sizes:
+        image_logs, delta_logs = basket_update_logs(size, False), basket_update_logs(size, True)
+        image_bytes, delta_bytes = sum(map(len, image_logs)), sum(map(len, delta_logs))
+
+        decode_times = []
+        for logs in (image_logs, delta_logs):
+            start = process_time()
+            for log in logs:
+                msgpack.decode(log, type=LogOrderValue)
+            decode_times.append((process_time() - start) * 1000)
+        print(f"{size:>5} lines: before-images {image_bytes / 1024:10.1f} KiB decoded in {decode_times[0]:6.1f}ms, "
+              f"deltas {delta_bytes / 1024:8.1f} KiB decoded in {decode_times[1]:6.1f}ms ({image_bytes / delta_bytes:.1f}x), "
+              f"checkout log {len(image_logs[-1])} vs {len(delta_logs[-1])} bytes")
+
+
+########################################################################################################################
+#   PARTITIONED ENGINE BENCHMARK
+########################################################################################################################
+
+# Both setups serve the stock with gthread workers, so the engine is compared with the locks and not with sync workers
+STOCK_ENGINES = [
+    ("redlock", ["-f", "../docker-compose.yml"], {"WORKER_CLASS": "gthread", "WORKER_THREADS": "16"}),
+    ("partitioned", ["-f", "../docker-compose.yml", "-f", "../docker-compose.engine.yml"], {}),
+]
+
+
+def wait_for_partitions(timeout: float):
+    # The workers take their partitions within a few lease renewals after the start
+    start = perf_counter()
+    while perf_counter() - start < timeout:
+        partitions = tu.get_stock_partitions_status().get("partitions", [])
+        if all(partition["owner"] for partition in partitions):
+            return
+        sleep(0.5)
+    raise RuntimeError(f"The stock partitions were not all owned within {timeout}s")
+
+
+def benchmark_engine(subtracts: int, items: list[int], clients: int, timeout: float):
+    for name, compose_files, config in STOCK_ENGINES:
+        subprocess.run(["docker", "compose", *compose_files, "up", "-d", "--force-recreate"], env={**os.environ, **config}, check=True)
+        wait_for(f"{tu.STOCK_URL}/stock/partitions/status", timeout)
+        wait_for_partitions(timeout)
+
+        for item_count in items:
+            # One item puts all clients on the same lock or partition, many items spread them
+            item_ids = [tu.create_item(1)['item_id'] for _ in range(item_count)]
+            for item_id in item_ids:
+                tu.add_stock(item_id, subtracts)
+
+            start = perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as executor:
+                results = list(executor.map(lambda i: tu.subtract_stock(item_ids[i % item_count], 1), range(subtracts)))
+            elapsed = perf_counter() - start
+
+            succeeded = sum(tu.status_code_is_success(status_code) for status_code in results)
+            # Every successful subtract must be visible in the stock, the find of the engine answers from memory
+            left = sum(tu.find_item(item_id)['stock'] for item_id in item_ids)
+            print(f"{name:<12} {item_count:>4} items: {succeeded}/{subtracts} subtracts with {clients} clients in {elapsed:.2f}s "
+                  f"({subtracts / elapsed:.0f} subtracts/s), stock {'consistent' if left == subtracts * item_count - succeeded else 'INCONSISTENT'}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    recovery_parser = subparsers.add_parser("recovery", help="Time the recovery of a seeded backlog of unfinished transactions")
+    recovery_parser.add_argument("--transactions", type=int, default=100_000)
+
+    startup_parser = subparsers.add_parser("startup", help="Restart the services with a seeded backlog and time serving and readiness")
+    startup_parser.add_argument("--transactions", type=int, default=10_000)
+    startup_parser.add_argument("--timeout", type=float, default=600)
+
+    workers_parser = subparsers.add_parser("workers", help="Compare the checkout throughput of the sync, gthread and gevent worker classes")
+    workers_parser.add_argument("--checkouts", type=int, default=2000)
+    workers_parser.add_argument("--clients", type=int, default=64)
+    workers_parser.add_argument("--timeout", type=float, default=600)
+
+    asyncio_parser = subparsers.add_parser("asyncio", help="Compare the checkout throughput of the asyncio workers with gunicorn -w 2")
+    asyncio_parser.add_argument("--checkouts", type=int, default=5000)
+    asyncio_parser.add_argument("--clients", type=int, default=512)
+    asyncio_parser.add_argument("--timeout", type=float, default=600)
+
+    add_items_parser = subparsers.add_parser("additems", help="Compare filling baskets with one addItem per line against one addItems call")
+    add_items_parser.add_argument("--baskets", type=int, default=500)
+    add_items_parser.add_argument("--lines", type=int, default=20)
+    add_items_parser.add_argument("--clients", type=int, default=32)
+
+    rollback_images_parser = subparsers.add_parser("rollbackimages", help="Compare the CPU time per update of copied and raw rollback images")
+    rollback_images_parser.add_argument("--updates", type=int, default=20000)
+    rollback_images_parser.add_argument("--sizes", type=lambda sizes: [int(size) for size in sizes.split(",")], default=[1, 10, 100, 1000])
+
+    log_bytes_parser = subparsers.add_parser("logbytes", help="Compare the UPDATE log bytes of a basket with before-images and with deltas")
+    log_bytes_parser.add_argument("--sizes", type=lambda sizes: [int(size) for size in sizes.split(",")], default=[10, 100, 1000])
+
+    engine_parser = subparsers.add_parser("engine", help="Compare the subtract throughput of the partitioned stock engine with the RedLock path")
+    engine_parser.add_argument("--subtracts", type=int, default=20000)
+    engine_parser.add_argument("--items", type=lambda items: [int(item) for item in items.split(",")], default=[1, 100])
+    engine_parser.add_argument("--clients", type=int, default=64)
+    engine_parser.add_argument("--timeout", type=float, default=600)
+
+    args = parser.parse_args()
+    if args.benchmark == "recovery":
+        benchmark_recovery(args.transactions)
+    elif args.benchmark == "startup":
+        benchmark_startup(args.transactions, args.timeout)
+    elif args.benchmark == "workers":
+        benchmark_workers(args.checkouts, args.clients, args.timeout)
+    elif args.benchmark == "asyncio":
+        benchmark_asyncio(args.checkouts, args.clients, args.timeout)
+    elif args.benchmark == "additems":
+        benchmark_add_items(args.baskets, args.lines, args.clients)
+    elif args.benchmark == "rollbackimages":
+        benchmark_rollback_images(args.updates, args.sizes)
+    elif args.benchmark == "logbytes":
+        benchmark_log_bytes(args.sizes)
+    elif args.benchmark == "engine":
+        benchmark_engine(args.subtracts, args.items, args.clients, args.timeout)
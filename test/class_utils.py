@@ -1,4 +1,4 @@
-from msgspec import Struct
+from msgspec import Struct, Raw
 from enum import Enum
 
 ########################################################################################################################
@@ -20,9 +20,10 @@ class LogStatus(str, Enum):
 ########################################################################################################################
 #   STOCK MICROSERVICE DATA STRUCTURES
 ########################################################################################################################
-class StockValue(Struct):
+class StockValue(Struct, omit_defaults=True):
     stock: int
     price: int
+    escrow: int = 0
 
     def to_dict(self):
         return {f: getattr(self, f) for f in self.__struct_fields__}
@@ -34,7 +35,7 @@ class LogStockValue(Struct):
     type: LogType | None = None
     status: LogStatus | None = None
     stock_id: str | None = None
-    old_stockvalue: StockValue | None = None
+    old_stockvalue: StockValue | Raw | None = None
 
 
     def to_dict(self):
@@ -63,7 +64,7 @@ class LogUserValue(Struct):
     type: LogType | None = None
     status: LogStatus | None = None
     user_id: str | None = None
-    old_uservalue: UserValue | None = None
+    old_uservalue: UserValue | Raw | None = None
 
     def to_dict(self):
         result = {}
@@ -87,6 +88,16 @@ class OrderValue(Struct):
     def to_dict(self):
         return {f: getattr(self, f) for f in self.__struct_fields__}  
 
+
+
+class OrderDelta(Struct, omit_defaults=True):
+    items: list[tuple[str, int]] = []
+    cost: int = 0
+    old_paid: bool | None = None
+
+    def to_dict(self):
+        return {f: getattr(self, f) for f in self.__struct_fields__}
+
   
 class LogOrderValue(Struct):
     id: str
@@ -94,9 +105,10 @@ class LogOrderValue(Struct):
     type: LogType | None = None
     status: LogStatus | None = None
     order_id: str | None = None
-    old_ordervalue: OrderValue | None = None
+    old_ordervalue: OrderValue | Raw | None = None
     from_url: str | None = None
     to_url: str | None = None
+    delta: OrderDelta | None = None
     
     def to_dict(self):
         result = {}
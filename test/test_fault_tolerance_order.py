@@ -2,7 +2,7 @@ import unittest
 
 import uuid
 import utils as tu
-from class_utils import LogType, LogStatus, OrderValue
+from class_utils import LogType, LogStatus, OrderValue, OrderDelta
 
 class TestMicroservices(unittest.TestCase):
 
@@ -258,6 +258,37 @@ class TestMicroservices(unittest.TestCase):
         self.assertEqual(tu.find_order_benchmark(order_id).json()['items'], [])
     
         
+    def test_order_add_item_delta_is_reverted(self):
+        order_log_count = int(tu.get_order_log_count())
+        
+        # Create a user, an order and two items
+        user_id = tu.create_user_benchmark().json()['user_id']
+        order_id = tu.create_order_benchmark(user_id).json()['order_id']
+        first_item_id = tu.create_item_benchmark(2).json()['item_id']
+        second_item_id = tu.create_item_benchmark(5).json()['item_id']
+        
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order_benchmark(order_id, first_item_id, 3).status_code))
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order_benchmark(order_id, second_item_id, 1).status_code))
+        
+        # The second line was added but its transaction never finished, only its delta is undone
+        log_resp = tu.create_order_log(
+            log_id=str(uuid.uuid4()),
+            type=LogType.UPDATE,
+            order_id=order_id,
+            delta=OrderDelta(items=[(second_item_id, 1)], cost=5),
+        )
+        self.assertTrue(tu.status_code_is_success(log_resp.status_code))
+        self.assertEqual(int(tu.get_order_log_count()), order_log_count + 1)
+        
+        ft_resp = tu.fault_tolerance_order()
+        self.assertTrue(tu.status_code_is_success(ft_resp.status_code))
+        self.assertEqual(tu.get_order_log_count(), order_log_count)
+        
+        order_entry = tu.find_order_benchmark(order_id).json()
+        self.assertEqual(order_entry['items'], [[first_item_id, 3]])
+        self.assertEqual(order_entry['total_cost'], 6)
+        
+        
     def test_checkout_contains_faulty_log(self):
         # Get initial log count
         order_log_count = int(tu.get_order_log_count())
@@ -526,6 +557,31 @@ class TestMicroservices(unittest.TestCase):
         find_item2_stock = find_item2.json()['stock']
         self.assertEqual(find_item2_stock, item2_stock+1)
         
+    def test_failed_compensation_is_retried_later(self):
+        status = tu.get_compensation_status()
+        
+        log_id = str(uuid.uuid4())
+        checkout_url = f"{tu.ORDER_URL}/orders/checkout/1"
+        
+        # Create log for a rollback to an item that does not exist (failure)
+        log_resp = tu.create_order_log(
+            log_id=log_id,
+            type=LogType.RECEIVED,
+            from_url=f"{tu.STOCK_URL}/stock/add/{uuid.uuid4()}/1",
+            to_url=checkout_url,
+            status=LogStatus.FAILURE,
+        )
+        self.assertTrue(tu.status_code_is_success(log_resp.status_code))
+        
+        # The fault tolerance should not block on the failing rollback
+        ft_resp = tu.fault_tolerance_order()
+        self.assertTrue(tu.status_code_is_success(ft_resp.status_code))
+        
+        # The rollback is queued for another attempt
+        new_status = tu.get_compensation_status()
+        self.assertEqual(new_status['enqueued'], status.get('enqueued', 0) + 1)
+        self.assertEqual(new_status['retried'], status.get('retried', 0) + 1)
+        
         
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -262,6 +262,45 @@ class TestMicroservices(unittest.TestCase):
         self.assertTrue(tu.status_code_is_success(find_item_resp.status_code))
         
         self.assertEqual(find_item_resp.json()['stock'], amount)
+    
+    def test_stock_counter_contains_faulty_log(self):
+        # Get initial log count
+        stock_log_count = int(tu.get_stock_log_count())
+        self.assertIsNotNone(stock_log_count)
+        
+        log_id = str(uuid.uuid4())
+        amount = 7
+        
+        # An empty item split over one counter, the rebalancer leaves it alone
+        item_id: str = tu.create_item(5)['item_id']
+        stock_log_count += 2
+        self.assertTrue(tu.status_code_is_success(tu.split_stock(item_id, 1)))
+        stock_log_count += 2
+        
+        # Create an entry for the update log of the sub-counter, its key carries the hash tag of the counter
+        log_resp = tu.create_stock_log(
+            log_id=log_id,
+            type=LogType.UPDATE,
+            stock_id=f"escrow:0:{item_id}",
+            old_stockvalue=StockValue(stock=amount, price=5),
+        )
+        self.assertTrue(tu.status_code_is_success(log_resp.status_code))
+        
+        stock_log_count += 1
+        self.assertEqual(int(tu.get_stock_log_count()), stock_log_count)
+        
+        # The log falls in the time window of the fault tolerance
+        self.assertIn(log_id, tu.get_stock_log())
+        
+        # Run fault tolerance
+        ft_resp = tu.fault_tolerance_stock()
+        self.assertTrue(tu.status_code_is_success(ft_resp.status_code))
+        
+        stock_log_count -= 1
+        self.assertEqual(tu.get_stock_log_count(), stock_log_count)
+        
+        # Check whether the sub-counter was rolled back
+        self.assertEqual(tu.find_item(item_id)['stock'], amount)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,7 @@
+import time
 import unittest
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import utils as tu
 
@@ -34,6 +37,314 @@ class TestMicroservices(unittest.TestCase):
         stock_after_subtract: int = tu.find_item(item_id)['stock']
         self.assertEqual(stock_after_subtract, 35)
 
+    def test_log_export(self):
+        item: dict = tu.create_item(5)
+        self.assertIn('item_id', item)
+
+        item_id: str = item['item_id']
+
+        # Walk all pages of the log filtered on the item
+        paged_logs = []
+        cursor = 0
+        while True:
+            page = tu.get_stock_logs_page(cursor, stock_id=item_id)
+            paged_logs.extend(page['logs'])
+            cursor = page['cursor']
+            if cursor == 0:
+                break
+
+        # The create request writes a create and a sent log
+        self.assertEqual(len(paged_logs), 2)
+        self.assertTrue(all(log['log']['stock_id'] == item_id for log in paged_logs))
+
+        # The stream should return the same logs
+        streamed_logs = tu.stream_stock_logs(stock_id=item_id)
+        self.assertEqual(sorted(log['id'] for log in streamed_logs), sorted(log['id'] for log in paged_logs))
+
+        # Filters are combined
+        sent_logs = tu.stream_stock_logs(stock_id=item_id, type="Sent", status="Success")
+        self.assertEqual(len(sent_logs), 1)
+
+    def test_recovery_status(self):
+        status: dict = tu.get_stock_recovery_status()
+        self.assertIn('lag_seconds', status)
+        self.assertIn('checkpoint', status)
+        self.assertGreater(status['interval_seconds'], 0)
+
+        # The lag is reported exactly when a run stored a checkpoint, which is never in the future
+        if status['checkpoint'] is None:
+            self.assertIsNone(status['lag_seconds'])
+        else:
+            self.assertGreaterEqual(status['lag_seconds'], 0)
+
+    def test_reads_status(self):
+        item_id: str = tu.create_item(5)['item_id']
+        before: dict = tu.get_stock_reads_status()
+        tu.find_item(item_id)
+
+        # The workers share their read counts every half second
+        time.sleep(1)
+        after: dict = tu.get_stock_reads_status()
+        self.assertEqual(after['policy'], 'master')
+        self.assertGreater(after['reads_master'] + after['reads_replica'], before['reads_master'] + before['reads_replica'])
+
+    def test_cache_invalidation(self):
+        item_id: str = tu.create_item(5)['item_id']
+        tu.add_stock(item_id, 10)
+        self.assertEqual(tu.find_item(item_id)['stock'], 10)
+
+        # A write replaces the cached copy in every worker
+        tu.add_stock(item_id, 5)
+        time.sleep(0.1)
+        self.assertEqual(tu.find_item(item_id)['stock'], 15)
+        self.assertIn('enabled', tu.get_stock_cache_status())
+
+    def test_price_catalog(self):
+        item_id: str = tu.create_item(7)['item_id']
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+
+        # The writer pulls the price feed every second
+        time.sleep(2)
+        status: dict = tu.get_price_catalog_status()
+        if status['enabled']:
+            self.assertGreater(status['items'], 0)
+
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id, 3)))
+        self.assertEqual(tu.find_order(order_id)['total_cost'], 21)
+
+    def test_existence_checks(self):
+        # Missing users are rejected, also when the negative cache answers
+        for _ in range(2):
+            self.assertTrue(tu.status_code_is_failure(tu.create_order_response("missing-user").status_code))
+
+        user_id: str = tu.create_user()['user_id']
+        self.assertIn('order_id', tu.create_order(user_id))
+
+        # Once the user feed is pulled, the user is known without asking the payment service
+        time.sleep(2)
+        self.assertIn('order_id', tu.create_order(user_id))
+        self.assertIn('checks', tu.get_price_catalog_status())
+
+    def test_read_coalescing(self):
+        item_id: str = tu.create_item(5)['item_id']
+
+        # Concurrent reads of one item all get the item, whether or not they shared a fetch
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            items = list(executor.map(lambda _: tu.find_item(item_id), range(32)))
+        self.assertTrue(all(item['price'] == 5 for item in items))
+
+        status: dict = tu.get_stock_coalescing_status()
+        self.assertGreaterEqual(status['reads']['requests'], status['reads']['collapsed'])
+
+    def test_conditional_get(self):
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+
+        first = tu.find_order_response(order_id)
+        etag = first.headers['ETag']
+        self.assertEqual(tu.find_order_response(order_id, etag).status_code, 304)
+
+        # A changed order no longer matches its old ETag
+        item_id: str = tu.create_item(5)['item_id']
+        tu.add_stock(item_id, 1)
+        tu.add_item_to_order(order_id, item_id, 1)
+        changed = tu.find_order_response(order_id, etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers['ETag'], etag)
+
+    def test_find_many(self):
+        first: str = tu.create_item(5)['item_id']
+        second: str = tu.create_item(7)['item_id']
+        log_count: int = tu.get_stock_log_count()
+
+        items: list[dict] = tu.find_many_items([first, "missing-item", second])
+        self.assertEqual([item['item_id'] for item in items], [first, "missing-item", second])
+        self.assertEqual([item['found'] for item in items], [True, False, True])
+        self.assertEqual([items[0]['price'], items[2]['price']], [5, 7])
+
+        # A miss in a bulk read does not write a failure log
+        self.assertEqual(tu.get_stock_log_count(), log_count)
+
+    def test_add_items(self):
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+        first: str = tu.create_item(5)['item_id']
+        second: str = tu.create_item(7)['item_id']
+
+        self.assertTrue(tu.status_code_is_success(tu.add_items_to_order(order_id, [(first, 2), (second, 1), (first, 1)])))
+        order: dict = tu.find_order(order_id)
+        self.assertEqual(order['total_cost'], 22)
+        self.assertEqual(len(order['items']), 3)
+
+        # One missing item rejects the whole batch
+        self.assertTrue(tu.status_code_is_failure(tu.add_items_to_order(order_id, [(first, 1), ("missing-item", 1)])))
+        self.assertEqual(tu.find_order(order_id)['total_cost'], 22)
+
+    def test_checkout_many(self):
+        item_id: str = tu.create_item(5)['item_id']
+        tu.add_stock(item_id, 5)
+        rich_user: str = tu.create_user()['user_id']
+        tu.add_credit_to_user(rich_user, 100)
+        poor_user: str = tu.create_user()['user_id']
+        tu.add_credit_to_user(poor_user, 5)
+
+        # The first two orders fit the credit of their user, the third runs out of stock and the fourth out of credit
+        order_ids: list[str] = []
+        for user_id, quantity in [(rich_user, 1), (rich_user, 1), (rich_user, 4), (poor_user, 1)]:
+            order_id: str = tu.create_order(user_id)['order_id']
+            tu.add_item_to_order(order_id, item_id, quantity)
+            order_ids.append(order_id)
+        tu.add_item_to_order(order_ids[3], item_id, 1)
+
+        response = tu.checkout_orders(order_ids + ["missing-order"])
+        self.assertTrue(tu.status_code_is_success(response.status_code))
+        outcomes: list[dict] = response.json()
+        self.assertEqual([outcome['order_id'] for outcome in outcomes], order_ids + ["missing-order"])
+        self.assertEqual([outcome['success'] for outcome in outcomes], [True, True, False, False, False])
+
+        # The failed orders left the stock and the credit as they were
+        self.assertEqual(tu.find_item(item_id)['stock'], 3)
+        self.assertEqual(tu.find_user(rich_user)['credit'], 90)
+        self.assertEqual(tu.find_user(poor_user)['credit'], 5)
+        self.assertTrue(tu.find_order(order_ids[0])['paid'])
+        self.assertFalse(tu.find_order(order_ids[3])['paid'])
+
+    def test_stock_reservations(self):
+        item_id: str = tu.create_item(5)['item_id']
+        tu.add_stock(item_id, 5)
+
+        # A confirmed reservation keeps its stock, releasing it afterwards changes nothing
+        confirmed = str(uuid.uuid4())
+        self.assertTrue(tu.status_code_is_success(tu.reserve_stock(confirmed, [(item_id, 2)])))
+        self.assertEqual(tu.find_item(item_id)['stock'], 3)
+        self.assertTrue(tu.status_code_is_success(tu.confirm_reservation(confirmed)))
+        self.assertTrue(tu.status_code_is_success(tu.release_reservation(confirmed)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 3)
+
+        # Confirming again, as a checkout does when the answer was lost, succeeds and takes nothing more
+        self.assertTrue(tu.status_code_is_success(tu.confirm_reservation(confirmed)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 3)
+
+        # More than the available stock is not reserved
+        self.assertTrue(tu.status_code_is_failure(tu.reserve_stock(str(uuid.uuid4()), [(item_id, 4)])))
+
+        # An abandoned reservation is given back by the sweeper and can no longer be confirmed
+        abandoned = str(uuid.uuid4())
+        self.assertTrue(tu.status_code_is_success(tu.reserve_stock(abandoned, [(item_id, 3)], ttl=1)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 0)
+        time.sleep(4)
+        self.assertEqual(tu.find_item(item_id)['stock'], 3)
+        self.assertTrue(tu.status_code_is_failure(tu.confirm_reservation(abandoned)))
+
+    def test_escrow_counters(self):
+        item_id: str = tu.create_item(5)['item_id']
+        tu.add_stock(item_id, 100)
+        self.assertTrue(tu.status_code_is_success(tu.split_stock(item_id, 4)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 100)
+
+        # Concurrent subtracts of a split item take all of its stock and never more
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            statuses = list(executor.map(lambda _: tu.subtract_stock(item_id, 5), range(25)))
+        self.assertEqual(sum(tu.status_code_is_success(status) for status in statuses), 20)
+        self.assertEqual(tu.find_item(item_id)['stock'], 0)
+
+        # Stock added to the item is spread over the counters, putting it back on the item keeps the total
+        tu.add_stock(item_id, 30)
+        self.assertTrue(tu.status_code_is_success(tu.subtract_stock(item_id, 25)))
+        self.assertTrue(tu.status_code_is_success(tu.split_stock(item_id, 0)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 5)
+
+    def test_partitioned_stock(self):
+        # Runs against either mode, with docker-compose.engine.yml every partition has an owner
+        partitions: list[dict] = tu.get_stock_partitions_status()['partitions']
+        self.assertTrue(all(partition['owner'] for partition in partitions))
+
+        item_id: str = tu.create_item(5)['item_id']
+        tu.add_stock(item_id, 50)
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            statuses = list(executor.map(lambda _: tu.subtract_stock(item_id, 1), range(60)))
+        self.assertEqual(sum(tu.status_code_is_success(status) for status in statuses), 50)
+        self.assertEqual(tu.find_item(item_id)['stock'], 0)
+
+        # A reservation that one partition refuses holds nothing in the others
+        other_id: str = tu.create_item(5)['item_id']
+        tu.add_stock(other_id, 10)
+        self.assertTrue(tu.status_code_is_failure(tu.reserve_stock(str(uuid.uuid4()), [(other_id, 5), (item_id, 1)])))
+        self.assertEqual(tu.find_item(other_id)['stock'], 10)
+
+    def test_concurrent_stock_changes(self):
+        # With GROUP_COMMIT_WINDOW the changes are committed in batches, every request still gets its own answer
+        item_id: str = tu.create_item(5)['item_id']
+        tu.add_stock(item_id, 10)
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            subtracts = executor.map(lambda _: tu.subtract_stock(item_id, 3), range(10))
+            adds = executor.map(lambda _: tu.add_stock(item_id, 1), range(10))
+            subtracted = sum(tu.status_code_is_success(status) for status in subtracts)
+            self.assertTrue(all(tu.status_code_is_success(status) for status in adds))
+        self.assertLessEqual(subtracted, 6)
+        self.assertEqual(tu.find_item(item_id)['stock'], 20 - 3 * subtracted)
+
+    def test_checkout_saga(self):
+        # Runs against either mode, with docker-compose.saga.yml the checkout is decided by the events of stock and payment
+        user_id: str = tu.create_user()['user_id']
+        tu.add_credit_to_user(user_id, 10)
+        item_id: str = tu.create_item(5)['item_id']
+        tu.add_stock(item_id, 1)
+
+        order_id: str = tu.create_order(user_id)['order_id']
+        tu.add_item_to_order(order_id, item_id, 1)
+        self.assertTrue(tu.status_code_is_success(tu.checkout_order(order_id).status_code))
+        self.assertTrue(tu.find_order(order_id)['paid'])
+
+        # The second order finds no stock, the credit it held is given back
+        other_id: str = tu.create_order(user_id)['order_id']
+        tu.add_item_to_order(other_id, item_id, 1)
+        self.assertTrue(tu.status_code_is_failure(tu.checkout_order(other_id).status_code))
+        # With events the credit comes back after the answer, once payment reads the cancellation
+        for _ in range(50):
+            if tu.find_user(user_id)['credit'] == 5:
+                break
+            time.sleep(0.1)
+        self.assertEqual(tu.find_user(user_id)['credit'], 5)
+        self.assertEqual(tu.find_item(item_id)['stock'], 0)
+
+        status: dict = tu.get_saga_status()
+        if status['enabled']:
+            self.assertGreaterEqual(status.get('completed', 0), 1)
+            self.assertGreaterEqual(status.get('cancelled', 0), 1)
+
+    def test_payment_holds(self):
+        user_id: str = tu.create_user()['user_id']
+        tu.add_credit_to_user(user_id, 10)
+
+        # A captured hold keeps its credit, voiding it afterwards changes nothing
+        captured = str(uuid.uuid4())
+        self.assertTrue(tu.status_code_is_success(tu.authorize_payment(captured, user_id, 4)))
+        self.assertEqual(tu.find_user(user_id)['credit'], 6)
+        self.assertTrue(tu.status_code_is_success(tu.capture_payment(captured)))
+        self.assertTrue(tu.status_code_is_success(tu.void_payment(captured)))
+        self.assertEqual(tu.find_user(user_id)['credit'], 6)
+
+        # Capturing again, as a checkout does when the answer was lost, succeeds and takes nothing more
+        self.assertTrue(tu.status_code_is_success(tu.capture_payment(captured)))
+        self.assertEqual(tu.find_user(user_id)['credit'], 6)
+
+        # More than the available credit is not held, a voided hold gives its credit back
+        self.assertTrue(tu.status_code_is_failure(tu.authorize_payment(str(uuid.uuid4()), user_id, 7)))
+        voided = str(uuid.uuid4())
+        self.assertTrue(tu.status_code_is_success(tu.authorize_payment(voided, user_id, 2)))
+        self.assertTrue(tu.status_code_is_success(tu.void_payment(voided)))
+        self.assertEqual(tu.find_user(user_id)['credit'], 6)
+
+        # An abandoned hold is given back by the sweeper and can no longer be captured
+        abandoned = str(uuid.uuid4())
+        self.assertTrue(tu.status_code_is_success(tu.authorize_payment(abandoned, user_id, 6, ttl=1)))
+        self.assertEqual(tu.find_user(user_id)['credit'], 0)
+        time.sleep(4)
+        self.assertEqual(tu.find_user(user_id)['credit'], 6)
+        self.assertTrue(tu.status_code_is_failure(tu.capture_payment(abandoned)))
+
     def test_payment(self):
         # Test /payment/pay/<user_id>/<order_id>
         user: dict = tu.create_user()
@@ -1,10 +1,11 @@
+import json
 import requests
 
 from datetime import datetime
 from class_utils import (
     LogType, LogStatus, 
     StockValue, LogStockValue,
-    OrderValue, LogOrderValue,
+    OrderValue, OrderDelta, LogOrderValue,
     UserValue, LogUserValue
 )
 
@@ -45,7 +46,7 @@ def create_payment_log(log_id: int, type: LogType, status: LogStatus = None, use
     return requests.post(f"{PAYMENT_URL}/payment/log/create", json=log_entry.to_dict())
 
   
-def create_order_log(log_id: int, type: LogType, status: LogStatus = None, order_id: str = None, old_ordervalue: OrderValue = None, from_url: str = None, to_url: str = None):
+def create_order_log(log_id: int, type: LogType, status: LogStatus = None, order_id: str = None, old_ordervalue: OrderValue = None, from_url: str = None, to_url: str = None, delta: OrderDelta = None):
     log_entry = LogOrderValue(
         id=log_id,
         type=type if type else None,
@@ -54,6 +55,7 @@ def create_order_log(log_id: int, type: LogType, status: LogStatus = None, order
         old_ordervalue=old_ordervalue if old_ordervalue else None,
         from_url=from_url if from_url else None,
         to_url=to_url if to_url else None,
+        delta=delta,
         dateTime=datetime.now().strftime("%Y%m%d%H%M%S%f")
     )
     return requests.post(f"{ORDER_URL}/orders/log/create", json=log_entry.to_dict())
@@ -78,6 +80,11 @@ def find_item(item_id: str) -> dict:
     return requests.get(f"{STOCK_URL}/stock/find/{item_id}").json()
 
 
+def find_many_items(item_ids: list[str]) -> list[dict]:
+    response = requests.post(f"{STOCK_URL}/stock/find_many", json=item_ids, stream=True)
+    return [json.loads(line) for line in response.iter_lines() if line]
+
+
 def add_stock_benchmark(item_id: str, amount: int) -> int:
     return requests.post(f"{STOCK_URL}/stock/add/{item_id}/{amount}/benchmark")
 
@@ -94,6 +101,23 @@ def subtract_stock(item_id: str, amount: int) -> int:
     return requests.post(f"{STOCK_URL}/stock/subtract/{item_id}/{amount}").status_code
 
 
+def reserve_stock(reservation_id: str, items: list[tuple[str, int]], ttl: float | None = None) -> int:
+    params = {"ttl": ttl} if ttl is not None else {}
+    return requests.post(f"{STOCK_URL}/stock/reserve/{reservation_id}", json=items, params=params).status_code
+
+
+def confirm_reservation(reservation_id: str) -> int:
+    return requests.post(f"{STOCK_URL}/stock/confirm/{reservation_id}").status_code
+
+
+def release_reservation(reservation_id: str) -> int:
+    return requests.post(f"{STOCK_URL}/stock/release/{reservation_id}").status_code
+
+
+def split_stock(item_id: str, counters: int) -> int:
+    return requests.post(f"{STOCK_URL}/stock/escrow/{item_id}/{counters}").status_code
+
+
 def get_stock_log_count() -> dict:
     return requests.get(f"{STOCK_URL}/stock/log_count").json()
 
@@ -106,6 +130,35 @@ def fault_tolerance_stock():
     return requests.get(f"{STOCK_URL}/stock/fault_tolerance/1")
 
 
+def get_stock_recovery_status() -> dict:
+    return requests.get(f"{STOCK_URL}/stock/recovery/status").json()
+
+
+def get_stock_reads_status() -> dict:
+    return requests.get(f"{STOCK_URL}/stock/reads/status").json()
+
+
+def get_stock_cache_status() -> dict:
+    return requests.get(f"{STOCK_URL}/stock/cache/status").json()
+
+
+def get_stock_coalescing_status() -> dict:
+    return requests.get(f"{STOCK_URL}/stock/coalescing/status").json()
+
+
+def get_stock_partitions_status() -> dict:
+    return requests.get(f"{STOCK_URL}/stock/partitions/status").json()
+
+
+def get_stock_logs_page(cursor: int = 0, **filters) -> dict:
+    return requests.get(f"{STOCK_URL}/stock/logs/page", params={"cursor": cursor, **filters}).json()
+
+
+def stream_stock_logs(**filters) -> list[dict]:
+    response = requests.get(f"{STOCK_URL}/stock/logs/stream", params=filters, stream=True)
+    return [json.loads(line) for line in response.iter_lines() if line]
+
+
 ########################################################################################################################
 #   PAYMENT MICROSERVICE FUNCTIONS
 ########################################################################################################################
@@ -142,6 +195,19 @@ def add_credit_to_user_benchmark(user_id: str, amount: float) -> int:
     return requests.post(f"{PAYMENT_URL}/payment/add_funds/{user_id}/{amount}/benchmark")
 
 
+def authorize_payment(hold_id: str, user_id: str, amount: int, ttl: float | None = None) -> int:
+    params = {"ttl": ttl} if ttl is not None else {}
+    return requests.post(f"{PAYMENT_URL}/payment/authorize/{hold_id}/{user_id}/{amount}", params=params).status_code
+
+
+def capture_payment(hold_id: str) -> int:
+    return requests.post(f"{PAYMENT_URL}/payment/capture/{hold_id}").status_code
+
+
+def void_payment(hold_id: str) -> int:
+    return requests.post(f"{PAYMENT_URL}/payment/void/{hold_id}").status_code
+
+
 def get_payment_log_count() -> dict:
     return requests.get(f"{PAYMENT_URL}/payment/log_count").json()
 
@@ -162,6 +228,10 @@ def create_order(user_id: str) -> dict:
     return requests.post(f"{ORDER_URL}/orders/create/{user_id}").json()
 
 
+def create_order_response(user_id: str) -> requests.Response:
+    return requests.post(f"{ORDER_URL}/orders/create/{user_id}")
+
+
 def create_order_benchmark(user_id: str) -> dict:
     return requests.post(f"{ORDER_URL}/orders/create/{user_id}/benchmark")
 
@@ -170,6 +240,10 @@ def add_item_to_order(order_id: str, item_id: str, quantity: int) -> int:
     return requests.post(f"{ORDER_URL}/orders/addItem/{order_id}/{item_id}/{quantity}").status_code
 
 
+def add_items_to_order(order_id: str, items: list[tuple[str, int]]) -> int:
+    return requests.post(f"{ORDER_URL}/orders/addItems/{order_id}", json=items).status_code
+
+
 def add_item_to_order_benchmark(order_id: str, item_id: str, quantity: int) -> int:
     return requests.post(f"{ORDER_URL}/orders/addItem/{order_id}/{item_id}/{quantity}/benchmark")
 
@@ -181,6 +255,11 @@ def find_order(order_id: str) -> dict:
     return requests.get(f"{ORDER_URL}/orders/find/{order_id}").json()
 
 
+def find_order_response(order_id: str, etag: str | None = None) -> requests.Response:
+    headers = {"If-None-Match": etag} if etag else {}
+    return requests.get(f"{ORDER_URL}/orders/find/{order_id}", headers=headers)
+
+
 def find_order_benchmark(order_id: str) -> dict:
     return requests.get(f"{ORDER_URL}/orders/find/{order_id}/benchmark")
 
@@ -193,6 +272,14 @@ def checkout_order(order_id: str) -> requests.Response:
     return requests.post(f"{ORDER_URL}/orders/checkout/{order_id}")
 
 
+def get_saga_status() -> dict:
+    return requests.get(f"{ORDER_URL}/orders/saga/status").json()
+
+
+def checkout_orders(order_ids: list[str]) -> requests.Response:
+    return requests.post(f"{ORDER_URL}/orders/checkout_many", json=order_ids)
+
+
 def get_order_log_count() -> dict:
     return requests.get(f"{ORDER_URL}/orders/log_count").json()
 
@@ -200,6 +287,14 @@ def get_order_log_count() -> dict:
 def fault_tolerance_order():
     return requests.get(f"{ORDER_URL}/orders/fault_tolerance/1")
 
+
+def get_compensation_status() -> dict:
+    return requests.get(f"{ORDER_URL}/orders/compensations/status").json()
+
+
+def get_price_catalog_status() -> dict:
+    return requests.get(f"{ORDER_URL}/orders/catalog/status").json()
+
 ########################################################################################################################
 #   STATUS CHECKS
 ########################################################################################################################